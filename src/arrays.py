@@ -0,0 +1,127 @@
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Runtime values of Wabbit arrays. With NumPy installed they are NumPy
+# arrays, so element-wise arithmetic and reductions run as vectorized
+# loops in C; without it they are Python lists. Elements read from an
+# array are plain Python values either way.
+#
+# NumPy ints have 64 bits, so unlike the Python ints of the interpreters
+# array arithmetic wraps around past that.
+
+inf_int = 2147483647
+inf_float = 1.7e+308
+
+_numpy_types = {
+    'int': 'int64',
+    'float': 'float64',
+    'bool': 'bool',
+}
+
+_zero = {
+    'int': 0,
+    'float': 0.0,
+    'bool': False,
+}
+
+
+def zeros(dtype: str, size: int):
+    if numpy is not None:
+        return numpy.zeros(size, _numpy_types[dtype])
+    return [_zero[dtype]] * size
+
+def from_values(dtype: str, values: list):
+    if numpy is not None:
+        return numpy.array(values, _numpy_types[dtype])
+    return values
+
+def copy(array):
+    return array.copy()
+
+
+def get(array, index: int, lineno: int = 0):
+    if not 0 <= index < len(array):
+        raise RuntimeError(f"{lineno}: index {index} out of range for an array of {len(array)}")
+    value = array[index]
+    return value.item() if numpy is not None else value
+
+def store(array, index: int, value, lineno: int = 0):
+    if not 0 <= index < len(array):
+        raise RuntimeError(f"{lineno}: index {index} out of range for an array of {len(array)}")
+    array[index] = value
+
+
+def binop(op: str, dtype: str, left, right):
+    '''
+    Element-wise left op right, where dtype is the element type and either
+    operand may be a single value
+    '''
+    if numpy is not None:
+        return _numpy_binop(op, dtype, left, right)
+
+    if isinstance(left, list) and isinstance(right, list):
+        pairs = zip(left, right)
+    elif isinstance(left, list):
+        pairs = ( (l, right) for l in left )
+    else:
+        pairs = ( (left, r) for r in right )
+
+    match op:
+        case '+': return [ l + r for l, r in pairs ]
+        case '-': return [ l - r for l, r in pairs ]
+        case '*': return [ l * r for l, r in pairs ]
+        case '/' if dtype == 'int': return [ int(l / r) if r != 0 else inf_int for l, r in pairs ]
+        case '/': return [ l / r if r != 0 else inf_float for l, r in pairs ]
+
+def _numpy_binop(op: str, dtype: str, left, right):
+    match op:
+        case '+': return numpy.add(left, right)
+        case '-': return numpy.subtract(left, right)
+        case '*': return numpy.multiply(left, right)
+
+    # division by zero gives the largest value of the type, and int
+    # division truncates toward zero
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        if dtype == 'int':
+            quotient = numpy.abs(left) // numpy.abs(right)
+            quotient = numpy.where( (numpy.sign(left) * numpy.sign(right)) < 0, -quotient, quotient )
+            return numpy.where(numpy.equal(right, 0), inf_int, quotient).astype('int64')
+        return numpy.where(numpy.equal(right, 0), inf_float, numpy.divide(left, right))
+
+def unop(op: str, array):
+    # +a is a new array too, as arrays are values
+    if op != '-':
+        return copy(array)
+    if numpy is not None:
+        return numpy.negative(array)
+    return [ -v for v in array ]
+
+
+def reduce(name: str, array):
+    if name == 'len':
+        return len(array)
+    if numpy is not None:
+        match name:
+            case 'sum': return array.sum().item()
+            case 'min': return array.min().item()
+            case 'max': return array.max().item()
+
+    match name:
+        case 'sum': return sum(array)
+        case 'min': return min(array)
+        case 'max': return max(array)
+
+
+def format(array, dtype: str) -> str:
+    '''
+    Text printed by a print statement: [1, 2, 3]
+    '''
+    values = array.tolist() if numpy is not None else array
+    if dtype == 'bool':
+        items = ( 'true' if v else 'false' for v in values )
+    else:
+        items = ( str(v) for v in values )
+    return f"[{', '.join(items)}]\n"
@@ -0,0 +1,173 @@
+import argparse
+import contextlib
+import io
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import perf_counter
+
+from .tokenize import tokenize
+from .parse import WabbitParser
+from .typecheck import Diagnostic, check_program, check_source
+from .interp import interpret_program, interpret_closures
+from . import vm, pyast
+
+
+def _run_vm(model, types=None):
+    return vm.run_program(vm.compile_program(model, types))
+
+BACKENDS = {
+    'interp': interpret_program,
+    'closures': interpret_closures,
+    'vm': _run_vm,
+    'python': pyast.run_program,
+}
+
+
+class Result:
+    '''
+    Outcome of running one source file. ok is False when it didn't type
+    check or raised; output holds everything it printed and times the
+    seconds spent in each phase.
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self.ok = False
+        self.value = None
+        self.output = ''
+        self.error = None
+        self.times = {}
+
+    def __repr__(self):
+        return f'Result({self.path!r}, ok={self.ok})'
+
+
+# one parser per worker process, built by _init_worker
+_parser = None
+
+def _init_worker():
+    global _parser
+    _parser = WabbitParser()
+
+
+def run_file(path: str, backend: str = 'interp') -> Result:
+    '''
+    Run the whole pipeline on one source file, capturing what it prints
+    '''
+    result = Result(path)
+    out = io.StringIO()
+    parser = _parser or WabbitParser()
+
+    try:
+        with contextlib.redirect_stdout(out):
+            start = perf_counter()
+            with open(path, encoding='utf-8') as file:
+                model = parser.parse( tokenize(file.read()) )
+            result.times['parse'] = perf_counter() - start
+
+            start = perf_counter()
+            ok, model, types = check_program(model)
+            result.times['check'] = perf_counter() - start
+
+            if ok:
+                start = perf_counter()
+                result.value = BACKENDS[backend](model, types=types)
+                result.times['run'] = perf_counter() - start
+                result.ok = True
+            else:
+                result.error = 'type check failed'
+    except Exception:
+        result.error = traceback.format_exc()
+
+    result.output = out.getvalue()
+    return result
+
+
+def find_sources(paths: list[str]) -> list[str]:
+    '''
+    Expand directories into the .wb files below them
+    '''
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                sources += sorted( os.path.join(root, f) for f in files if f.endswith('.wb') )
+        else:
+            sources.append(path)
+    return sources
+
+
+def run_batch(paths: list[str], backend: str = 'interp', workers: int | None = None):
+    '''
+    Run many source files across a process pool, yielding a Result for
+    each one as it completes
+    '''
+    if backend not in BACKENDS:
+        raise RuntimeError(f"Unknown backend {backend}")
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker) as pool:
+        futures = [ pool.submit(run_file, path, backend) for path in find_sources(paths) ]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def check_file(path: str) -> list[Diagnostic]:
+    '''
+    Type check one source file, returning its errors with their path
+    '''
+    try:
+        with open(path, encoding='utf-8') as file:
+            (diagnostics, _, _) = check_source(file.read())
+    except Exception as e:
+        diagnostics = [ Diagnostic(0, f"Can't check: {e!r}") ]
+
+    for d in diagnostics:
+        d.path = path
+    return diagnostics
+
+
+def check_batch(paths: list[str], workers: int | None = None):
+    '''
+    Type check many source files across a process pool, yielding the path
+    and errors of each one in the order of paths
+    '''
+    sources = find_sources(paths)
+    chunksize = max(1, len(sources) // (4 * (workers or os.cpu_count() or 1)))
+    with ProcessPoolExecutor(workers) as pool:
+        yield from zip(sources, pool.map(check_file, sources, chunksize=chunksize))
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = argparse.ArgumentParser(prog='python -m src.batch',
+                                   description='Run Wabbit programs in parallel')
+    args.add_argument('paths', nargs='+', help='.wb files or directories')
+    args.add_argument('-b', '--backend', choices=BACKENDS, default='interp')
+    args.add_argument('-j', '--workers', type=int, default=None)
+    args.add_argument('-o', '--output', action='store_true', help='show what each program printed')
+    args.add_argument('-c', '--check', action='store_true', help='only type check, printing the errors')
+    args = args.parse_args(argv)
+
+    if args.check:
+        failed = 0
+        for (path, diagnostics) in check_batch(args.paths, args.workers):
+            for d in diagnostics:
+                print(d)
+            failed += bool(diagnostics)
+        return 1 if failed else 0
+
+    failed = 0
+    for result in run_batch(args.paths, args.backend, args.workers):
+        total = sum(result.times.values())
+        print(f"{'ok  ' if result.ok else 'FAIL'} {total * 1000:>10.3f} ms  {result.path}")
+        if args.output and result.output:
+            print(result.output, end='' if result.output.endswith('\n') else '\n')
+        if result.error:
+            failed += 1
+            print(result.error, file=sys.stderr)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,6 +2,8 @@ import re
 from functools import singledispatch
 
 from .model import *
+from .resolve import GLOBAL, resolve_program
+from .profiler import Profile
 
 
 class Env:
@@ -27,10 +29,23 @@ class Env:
 class Context:
     _counter_t = 0
     _counter_l = 0
-    def __init__(self):
+    def __init__(self, profile: Profile | None = None, types: Types | None = None):
         # You need some wabbit environment stuff for tracking names / objects
         self.env = Env()
 
+        # types of the checked model
+        self.types = types or Types()
+
+        # branch and loop counts of a training run, for __builtin_expect
+        self.profile = profile
+
+        # variables of the function being compiled, None at the top level
+        self.locals = None
+
+        # C functions, and their prototypes so calls can precede them
+        self.prototypes = []
+        self.functions = []
+
         # List that holds all the declarations
         self.declarations = []
 
@@ -42,6 +57,8 @@ class Context:
         self.return_label = None
 
     def type_transform(self, p_type: DType):
+        if is_array(p_type):
+            return f'{self.type_transform(element_type(p_type))}[{array_size(p_type)}]'
         match p_type:
             case 'float': return 'double'
             case 'bool': return 'int'
@@ -54,9 +71,18 @@ class Context:
         '''
         Context._counter_t += 1
         name = f'_t{Context._counter_t}'
-        self.declarations.append(f'\t{self.type_transform(c_type)} {name};')
+        self.declarations.append(f'\t{_declaration(self.type_transform(c_type), name)};')
         return name
 
+    def variable(self, node: Location) -> str:
+        '''
+        C name of a variable: each binding gets its own C variable, so
+        names shadowed or reused with another type never clash
+        '''
+        if node.frame == GLOBAL:
+            return f'g_{node.name}_{node.binding}'
+        return f'{node.name}_{node.binding}'
+
     def new_label(self):
         '''
         Declare a new label
@@ -70,24 +96,81 @@ class Context:
     def str_env(self):
         registers = ''
         for k in self.env.stack.keys():
-            registers += f'{self.env.stack[k]} {k};\n'
+            registers += f'{_declaration(self.env.stack[k], k)};\n'
         return registers
 
+    def str_locals(self):
+        return '\n'.join( f"\t{_declaration(c_type, name)} = {'{0}' if c_type.endswith(']') else 0};"
+                          for name, c_type in self.locals.stack.items() )
+
     def __str__(self):
         return ("\n".join(self.declarations) + "\n\n" + \
                 "\n".join(self.statements) + "\n")
 
 
-def compile_program(model):
-    ctx = Context()
-    _compile(model, ctx)
-    return ("#include <stdio.h>\n\n" +
+def _declaration(c_type: str, name: str) -> str:
+    # arrays are contiguous C arrays: int[8] a is declared as int a[8]
+    if c_type.endswith(']'):
+        (element, size) = c_type.split('[')
+        return f'{element} {name}[{size}'
+    return f'{c_type} {name}'
+
+
+_prelude = """#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+static int wabbit_idiv(int a, int b) { return b != 0 ? a / b : 2147483647; }
+static double wabbit_fdiv(double a, double b) { return b != 0 ? a / b : 1.7e+308; }
+
+static int wabbit_index(int i, int n, int lineno) {
+\tif (i < 0 || i >= n) {
+\t\tfprintf(stderr, "%d: index %d out of range for an array of %d\\n", lineno, i, n);
+\t\texit(1);
+\t}
+\treturn i;
+}
+
+"""
+
+def _compile_model(model: list[Node], profile: Profile | None, types: Types | None) -> Context:
+    resolve_program(model)
+
+    # number temporaries and labels from 1, so the same model gives the same C
+    Context._counter_t = Context._counter_l = 0
+    ctx = Context(profile, types)
+    for n in model:
+        _compile(n, ctx)
+    return ctx
+
+def _compile_unit(ctx: Context) -> str:
+    # the top-level statements initialize the globals
+    return (_prelude +
             ctx.str_env() + '\n' +
-            "int main() {\n" +
+            '\n'.join(ctx.prototypes) + '\n\n' +
+            '\n\n'.join(ctx.functions) + '\n\n' +
+            "void wabbit_init(void) {\n" +
             str(ctx) +
+            "\treturn;\n" +
+            "}\n")
+
+def compile_program(model, profile: Profile | None = None, types: Types | None = None):
+    ctx = _compile_model(model, profile, types)
+    has_main = any( isinstance(n, FunctionDefinition) and n.name == 'main' for n in model )
+    return (_compile_unit(ctx) + '\n' +
+            "int main() {\n" +
+            "\twabbit_init();\n" +
+            ("\twabbit_main();\n" if has_main else '') +
             "\treturn 0;\n" +
             "}")
 
+def compile_library(model, profile: Profile | None = None, types: Types | None = None):
+    '''
+    C source of a shared library: every Wabbit function f becomes the
+    exported wabbit_f, and wabbit_init runs the top-level statements
+    '''
+    return _compile_unit( _compile_model(model, profile, types) )
+
 
 @singledispatch
 def _compile(node: Node, ctx: Context):
@@ -113,14 +196,18 @@ def _compile_literal(node: LiteralT, ctx: Context):
 
 @rule(BinOp)
 def _compile_binop(node: BinOp, ctx: Context):
+    if is_array(ctx.types.get(node)):
+        return _compile_array_binop(node, ctx)
+
     lineno = node.lineno
     left_val = _compile(node.left, ctx)
-    tempname = ctx.new_temporary(node.p_type)
+    tempname = ctx.new_temporary(ctx.types.get(node))
 
     match node.op:
         case '+': resultval = f'{left_val} + {_compile(node.right, ctx)}'
         case '-': resultval = f'{left_val} - {_compile(node.right, ctx)}'
-        case '/': resultval = f'{left_val} / {_compile(node.right, ctx)}'
+        case '/' if ctx.types.get(node) == 'float': resultval = f'wabbit_fdiv({left_val}, {_compile(node.right, ctx)})'
+        case '/': resultval = f'wabbit_idiv({left_val}, {_compile(node.right, ctx)})'
         case '*': resultval = f'{left_val} * {_compile(node.right, ctx)}'
         case '<': resultval = f'{left_val} < {_compile(node.right, ctx)}'
         case '>': resultval = f'{left_val} > {_compile(node.right, ctx)}'
@@ -128,42 +215,17 @@ def _compile_binop(node: BinOp, ctx: Context):
         case '>=': resultval = f'{left_val} >= {_compile(node.right, ctx)}'
         case '==': resultval = f'{left_val} == {_compile(node.right, ctx)}'
         case '!=': resultval = f'{left_val} != {_compile(node.right, ctx)}'
-        case '&&':
-            _compile_ifstatement(
-                IfStatement(
-                    lineno,
-                    node.left,
-                    BlockStatement(
-                        lineno,
-                        [node.right if not isinstance(node.right, Bool) else \
-                            AssignmentStatement(lineno, Location(lineno, tempname), node.right)]
-                    ),
-                    BlockStatement(
-                        lineno,
-                        [AssignmentStatement(lineno, Location(lineno, tempname), Bool(lineno, False))]
-                    )
-                ), ctx
-            )
+        case '&&' | '||':
+            # the right operand is only evaluated when the left one doesn't decide
+            end_l = ctx.new_label()
+            ctx.append(f'{tempname} = {left_val};')
+            ctx.append(f"if ({'!' if node.op == '&&' else ''}{tempname}) goto {end_l};")
+            right_val = _compile(node.right, ctx)
+            ctx.append(f'{tempname} = {right_val};')
+            ctx.append(f'{end_l}:', True)
             return tempname
-        case '||':
-            _compile_ifstatement(
-                IfStatement(
-                    lineno,
-                    node.left,
-                    BlockStatement(
-                        lineno,
-                        [AssignmentStatement(lineno, Location(lineno, tempname), Bool(lineno, True))]
-                    ),
-                    BlockStatement(
-                        lineno,
-                        [node.right if not isinstance(node.right, Bool) else \
-                            AssignmentStatement(lineno, Location(lineno, tempname), node.right)]
-                    )
-                ), ctx
-            )
-
-    if not node.op == '||' and not node.op == '&&':
-        ctx.append(f'{tempname} = {resultval};')
+
+    ctx.append(f'{tempname} = {resultval};')
 
     return tempname
 
@@ -171,6 +233,12 @@ def _compile_binop(node: BinOp, ctx: Context):
 def _compile_unop(node: UnOp, ctx: Context):
     expr_value = _compile(node.expr, ctx)
 
+    if is_array(ctx.types.get(node)):
+        tempname = ctx.new_temporary(ctx.types.get(node))
+        ctx.append(f'for (int _i = 0; _i < {array_size(ctx.types.get(node))}; _i++) '
+                   f'{tempname}[_i] = {node.op}{expr_value}[_i];')
+        return tempname
+
     if node.op == '-':
         resultval = f'-{expr_value}'
     elif node.op == '!':
@@ -178,26 +246,37 @@ def _compile_unop(node: UnOp, ctx: Context):
     else:
         resultval = f'+{expr_value}'
 
-    tempname = ctx.new_temporary(node.p_type)
+    tempname = ctx.new_temporary(ctx.types.get(node))
     ctx.append(f'{tempname} = {resultval};')
     return tempname
 
 @rule(PrintStatement)
 def _compile_print_statement(node: PrintStatement, ctx: Context):
     expr_value = _compile(node.expr, ctx)
+
+    if is_array(ctx.types.get(node.expr)):
+        match element_type(ctx.types.get(node.expr)):
+            case 'bool': element = f'printf("%s", {expr_value}[_i] ? "true" : "false");'
+            case 'float': element = f'printf("%f", {expr_value}[_i]);'
+            case _: element = f'printf("%d", {expr_value}[_i]);'
+        ctx.append('printf("[");')
+        ctx.append(f'for (int _i = 0; _i < {array_size(ctx.types.get(node.expr))}; _i++) '
+                   f'{{ if (_i) printf(", "); {element} }}')
+        ctx.append('printf("]\\n");')
+        return
     if not re.match(r'_t\d', repr(expr_value)):
-        name = ctx.new_temporary(node.expr.p_type)
+        name = ctx.new_temporary(ctx.types.get(node.expr))
         ctx.append(f'{name} = {expr_value};')
         expr_value = name
 
-    match node.expr.p_type:
+    match ctx.types.get(node.expr):
         case 'char': format_specifier = 'c'
         case 'float': format_specifier = 'f'
         case 'int': format_specifier = 'd'
 
-    if node.expr.p_type == 'unit':
+    if ctx.types.get(node.expr) == 'unit':
         ctx.append(f'printf("()\\n");')
-    elif node.expr.p_type == 'bool':
+    elif ctx.types.get(node.expr) == 'bool':
         block_true_l = ctx.new_label()
         block_false_l = ctx.new_label()
         return_l = ctx.new_label()
@@ -223,29 +302,105 @@ def _compile_print_statement(node: PrintStatement, ctx: Context):
 
 @rule(Location)
 def _compile_location(node: Location, ctx: Context):
-    value = node.name
-    return value
+    return ctx.variable(node)
 
 @rule(VarDefinition)
 @rule(ConstDefinition)
 def _interpret_definition(node: VarDefinition | ConstDefinition, ctx: Context):
-    name = _compile_location(node.location, ctx)
-
     if node.value:
         value = _compile(node.value, ctx)
-        dtype = ctx.type_transform(node.value.p_type)
+        dtype = ctx.types.get(node.value)
     else:
-        dtype = ctx.type_transform(node.dtype)
-
-    if node.value:
+        dtype = node.dtype
+
+    name = ctx.variable(node.location)
+    env = ctx.env if node.location.frame == GLOBAL else ctx.locals
+    env.createRegister(name, ctx.type_transform(dtype))
+
+    if is_array(dtype):
+        # arrays are values: every definition gets a fresh copy
+        if node.value:
+            ctx.append(f'memcpy({name}, {value}, sizeof {name});')
+        else:
+            ctx.append(f'memset({name}, 0, sizeof {name});')
+    elif node.value:
         ctx.append(f'{name} = {value};')
 
-    ctx.env.createRegister(name, dtype)
-
 @rule(AssignmentStatement)
 def _compile_assignmentstatement(node: AssignmentStatement, ctx: Context):
     value = _compile(node.value, ctx)
-    ctx.append(f'{_compile_location(node.location, ctx)} = {value};')
+    name = _compile_location(node.location, ctx)
+    if is_array(ctx.types.get(node.location)):
+        ctx.append(f'memcpy({name}, {value}, sizeof {name});')
+    else:
+        ctx.append(f'{name} = {value};')
+
+@rule(IndexAssignment)
+def _compile_indexassignment(node: IndexAssignment, ctx: Context):
+    index = _compile(node.index, ctx)
+    value = _compile(node.value, ctx)
+    name = _compile_location(node.location, ctx)
+    size = array_size(ctx.types.get(node.location))
+    ctx.append(f'{name}[wabbit_index({index}, {size}, {node.lineno})] = {value};')
+
+@rule(ArrayLiteral)
+def _compile_arrayliteral(node: ArrayLiteral, ctx: Context):
+    values = [ _compile(e, ctx) for e in node.elements ]
+    tempname = ctx.new_temporary(ctx.types.get(node))
+    for i, value in enumerate(values):
+        ctx.append(f'{tempname}[{i}] = {value};')
+    return tempname
+
+@rule(Index)
+def _compile_index(node: Index, ctx: Context):
+    array = _compile(node.array, ctx)
+    index = _compile(node.index, ctx)
+    size = array_size(ctx.types.get(node.array))
+    tempname = ctx.new_temporary(ctx.types.get(node))
+    ctx.append(f'{tempname} = {array}[wabbit_index({index}, {size}, {node.lineno})];')
+    return tempname
+
+@rule(ArrayFunction)
+def _compile_arrayfunction(node: ArrayFunction, ctx: Context):
+    array = _compile(node.expr, ctx)
+    size = array_size(ctx.types.get(node.expr))
+    if node.name == 'len':
+        return size
+
+    tempname = ctx.new_temporary(ctx.types.get(node))
+    if node.name == 'sum':
+        ctx.append(f'{tempname} = 0;')
+        ctx.append(f'for (int _i = 0; _i < {size}; _i++) {tempname} += {array}[_i];')
+    else:
+        cmp = '<' if node.name == 'min' else '>'
+        ctx.append(f'{tempname} = {array}[0];')
+        ctx.append(f'for (int _i = 1; _i < {size}; _i++) '
+                   f'if ({array}[_i] {cmp} {tempname}) {tempname} = {array}[_i];')
+    return tempname
+
+def _compile_array_binop(node: BinOp, ctx: Context):
+    '''
+    Element-wise arithmetic as a loop over the elements; a single value
+    operand is used for every element
+    '''
+    left = _compile(node.left, ctx)
+    right = _compile(node.right, ctx)
+    if is_array(ctx.types.get(node.left)): left = f'{left}[_i]'
+    if is_array(ctx.types.get(node.right)): right = f'{right}[_i]'
+
+    match node.op:
+        case '/' if element_type(ctx.types.get(node)) == 'float': value = f'wabbit_fdiv({left}, {right})'
+        case '/': value = f'wabbit_idiv({left}, {right})'
+        case op: value = f'{left} {op} {right}'
+
+    tempname = ctx.new_temporary(ctx.types.get(node))
+    ctx.append(f'for (int _i = 0; _i < {array_size(ctx.types.get(node))}; _i++) {tempname}[_i] = {value};')
+    return tempname
+
+def _expect(cmp, likely: bool | None) -> str:
+    if likely is None:
+        return cmp
+    return f'__builtin_expect(!!({cmp}), {int(likely)})'
 
 @rule(IfStatement)
 def _compile_ifstatement(node: IfStatement, ctx: Context):
@@ -253,8 +408,24 @@ def _compile_ifstatement(node: IfStatement, ctx: Context):
     if node.block_else: block_false_l = ctx.new_label()
     return_l = ctx.new_label()
 
+    likely = ctx.profile.likely(node.lineno) if ctx.profile else None
+
     cmp = _compile(node.cmp, ctx)
-    ctx.append(f'if ({cmp}) goto {block_true_l};')
+    ctx.append(f'if ({_expect(cmp, likely)}) goto {block_true_l};')
+
+    if node.block_else and likely is False:
+        # lay the hot else block out first, falling through from the test
+        ctx.append(f'{block_false_l}:', True)
+        _compile_blockstatement(node.block_else, ctx)
+        ctx.append(f'goto {return_l};')
+
+        ctx.append(f'{block_true_l}:', True)
+        _compile_blockstatement(node.block_if, ctx)
+        ctx.append(f'goto {return_l};')
+
+        ctx.append(f'{return_l}:', True)
+        return
+
     ctx.append(f'goto {block_false_l if node.block_else else return_l};')
 
     ctx.append(f'{block_true_l}:', True)
@@ -280,9 +451,12 @@ def _compile_whilestatement(node: WhileStatement, ctx: Context):
     cmp_l_temp = ctx.cmp_label
     ctx.cmp_label = cmp_l
 
+    # a loop that usually runs more than once usually goes around again
+    likely = True if ctx.profile and ctx.profile.trips(node.lineno) >= 2 else None
+
     ctx.append(f'{cmp_l}:', True)
     cmp = _compile(node.cmp, ctx)
-    ctx.append(f'if ({cmp}) goto {body_l};')
+    ctx.append(f'if ({_expect(cmp, likely)}) goto {body_l};')
     ctx.append(f'goto {return_l};')
 
     ctx.append(f'{body_l}:', True)
@@ -321,4 +495,58 @@ def _compile_blockstatement(node: BlockStatement, ctx: Context):
     for inst in node.instructions:
         _compile(inst, ctx)
 
-    # ctx.env.popScope()
\ No newline at end of file
+    # ctx.env.popScope()
+
+@rule(FunctionDefinition)
+def _compile_functiondefinition(node: FunctionDefinition, ctx: Context):
+    saved = (ctx.declarations, ctx.statements, ctx.locals)
+    ctx.declarations = []
+    ctx.statements = []
+    ctx.locals = Env()
+
+    if is_array(node.ret):
+        raise RuntimeError(f"{node.lineno}: The C backend can't return arrays")
+
+    params = []
+    for p in node.params:
+        name = f'{p.name}_{p.binding}'
+        ctx.locals.createRegister(name, ctx.type_transform(p.dtype))
+        if is_array(p.dtype):
+            # the callee works on its own copy of an array argument
+            params.append(f'const {ctx.type_transform(element_type(p.dtype))} *{name}_arg')
+            ctx.append(f'memcpy({name}, {name}_arg, sizeof {name});')
+        else:
+            params.append(f'{ctx.type_transform(p.dtype)} {name}')
+
+    _compile_blockstatement(node.body, ctx)
+
+    # locals are declared by their definition, so skip the parameters,
+    # except the copies of arrays
+    for p in node.params:
+        if not is_array(p.dtype):
+            del ctx.locals.stack[f'{p.name}_{p.binding}']
+
+    ret = ctx.type_transform(node.ret)
+    signature = f"{ret} wabbit_{node.name}({', '.join(params) or 'void'})"
+    ctx.prototypes.append(signature + ';')
+    ctx.functions.append(
+        signature + ' {\n' +
+        ctx.str_locals() + '\n' +
+        str(ctx) +
+        f"\treturn {'NULL' if node.ret == 'unit' else 0};\n" +
+        '}'
+    )
+
+    (ctx.declarations, ctx.statements, ctx.locals) = saved
+
+@rule(FunctionCall)
+def _compile_functioncall(node: FunctionCall, ctx: Context):
+    args = [ _compile(a, ctx) for a in node.args ]
+    tempname = ctx.new_temporary(ctx.types.get(node))
+    ctx.append(f"{tempname} = wabbit_{node.name}({', '.join( str(a) for a in args )});")
+    return tempname
+
+@rule(ReturnStatement)
+def _compile_returnstatement(node: ReturnStatement, ctx: Context):
+    value = _compile(node.expr, ctx) if node.expr is not None else 'NULL'
+    ctx.append(f'return {value};')
@@ -0,0 +1,153 @@
+import argparse
+import os
+import pickle
+import signal
+import struct
+import sys
+
+from .vm import VM
+from .wbc import dump_program, load_buffer, compile_file
+
+
+# Checkpoints of VM runs. Only the VM can be checkpointed: the tree
+# walker of interpret_program keeps its frames and loop positions on the
+# Python stack, while the VM holds all of its state in plain lists: the
+# globals, the running function, pc, frame and operand stack, and the
+# pending calls. Programs the VM can't run, such as those using arrays,
+# are rejected by vm.compile_program when they are compiled.
+#
+#   header    magic, version, size of the program
+#   program   the compiled program, in the .wbc format
+#   state     pickle of (globals, steps, state)
+#
+# A checkpoint is self-contained, so any process can resume it.
+
+MAGIC = b'WCK\x00'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sHI')
+
+# set by request_checkpoint, possibly from a signal handler
+_requested = False
+_stop = False
+
+
+def dump_checkpoint(vm: VM, source: str = '') -> bytes:
+    program = dump_program(vm.program, source)
+    state = pickle.dumps( (vm.globals, vm.steps, vm.state), pickle.HIGHEST_PROTOCOL )
+    return _HEADER.pack(MAGIC, VERSION, len(program)) + program + state
+
+def load_checkpoint_buffer(data: bytes, source: str | None = None) -> VM | None:
+    '''
+    Rebuild a VM from a checkpoint. Returns None when it was written by
+    another version or, if source is given, of a different source.
+    '''
+    if len(data) < _HEADER.size:
+        return None
+    (magic, version, size) = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        return None
+
+    start = _HEADER.size
+    program = load_buffer(data[start:start + size], source)
+    if not program:
+        return None
+
+    vm = VM(program)
+    # the top-level frame is the globals list, which pickle keeps shared
+    (vm.globals, vm.steps, vm.state) = pickle.loads(data[start + size:])
+    return vm
+
+
+def save_checkpoint(path: str, vm: VM, source: str = ''):
+    # what the program printed so far must not be printed again on resume
+    vm.out.flush()
+
+    data = dump_checkpoint(vm, source)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as file:
+        file.write(data)
+    os.replace(tmp, path)
+
+def load_checkpoint(path: str, source: str | None = None) -> VM | None:
+    try:
+        with open(path, 'rb') as file:
+            data = file.read()
+    except OSError:
+        return None
+    return load_checkpoint_buffer(data, source)
+
+
+def request_checkpoint(stop: bool = False):
+    '''
+    Ask run_checkpointed to write a checkpoint at its next safe point, and
+    to return there if stop is True. Safe to call from a signal handler.
+    '''
+    global _requested, _stop
+    _requested = True
+    _stop = _stop or stop
+
+
+def run_checkpointed(vm: VM, path: str, every: int = 10_000_000, slice: int = 100_000,
+                     source: str = '') -> bool:
+    '''
+    Run vm, writing a checkpoint to path every about every instructions and
+    when one is requested. Interpreted runs can't be checkpointed, so the
+    program must be compiled for the VM. Returns True when the program finished and
+    False when it stopped on request; the checkpoint is removed once the
+    program finishes.
+    '''
+    global _requested, _stop
+
+    last = vm.steps
+    while not vm.resume(slice):
+        if _requested or vm.steps - last >= every:
+            save_checkpoint(path, vm, source)
+            last = vm.steps
+            _requested = False
+            if _stop:
+                _stop = False
+                return False
+
+    if os.path.exists(path):
+        os.remove(path)
+    return True
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = argparse.ArgumentParser(prog='python -m src.checkpoint',
+                                   description='Run a Wabbit program on the VM, resuming from its checkpoint. '
+                                               'Only the VM can be checkpointed, so programs using arrays '
+                                               'are rejected.')
+    args.add_argument('path', help='.wb source file')
+    args.add_argument('-e', '--every', type=int, default=10_000_000, help='instructions between checkpoints')
+    args = args.parse_args(argv)
+
+    with open(args.path, encoding='utf-8') as file:
+        source = file.read()
+
+    checkpoint = os.path.splitext(args.path)[0] + '.wck'
+    vm = load_checkpoint(checkpoint, source)
+    if not vm:
+        try:
+            program = compile_file(args.path)
+        except RuntimeError as e:
+            print(f"{args.path}: can't checkpoint this program: {e}", file=sys.stderr)
+            return 1
+        if not program:
+            return 1
+        vm = VM(program)
+
+    # preemption: checkpoint and leave
+    signal.signal(signal.SIGTERM, lambda signum, frame: request_checkpoint(stop=True))
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: request_checkpoint())
+
+    if not run_checkpointed(vm, checkpoint, args.every, source=source):
+        return 3
+    print(vm.result)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
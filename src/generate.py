@@ -3,6 +3,8 @@ from functools import singledispatch
 import struct
 
 from .model import *
+from .profiler import Profile
+from .resolve import resolve_program
 
 
 class WasmType:
@@ -19,11 +21,22 @@ class WabbitWasmModule:
         self.functions: list[WasmFunction] = [ ]
         self.global_variables: list[WasmGlobalVariable] = [ ]
         self.countLabels = 0
+        # binding of a variable -> its local
         self.env = {}
+        # bytes of linear memory taken by arrays, laid out at compile time
+        self.memory = 0
 
     def encode(self):
         return Encode.module(self)
 
+    def alloc(self, size: int) -> int:
+        '''
+        Reserve size bytes of linear memory, returning their address
+        '''
+        address = self.memory
+        self.memory += (size + 7) // 8 * 8
+        return address
+
 class WasmImportedFunction:
     '''
     A function defined outside of the Wasm environment
@@ -133,6 +146,18 @@ class WasmFunction:
     def ref_null(self):
         self.code += b'\xd0'
 
+    def iload(self):
+        self.code += b'\x28\x02\x00'
+
+    def fload(self):
+        self.code += b'\x2b\x03\x00'
+
+    def istore(self):
+        self.code += b'\x36\x02\x00'
+
+    def fstore(self):
+        self.code += b'\x39\x03\x00'
+
     def ret(self):
         self.code += b'\x0f'
 
@@ -268,6 +293,10 @@ class Encode:
     def export_function(func):
         return Encode.string(func.name) + b'\x00' + Encode.unsigned(func.idx)
 
+    def memory(size: int):
+        pages = max(1, (size + 65535) // 65536)
+        return Encode.vector([ b'\x00' + Encode.unsigned(pages) ])
+
     def function_code(func):
         localtypes = [ b'\x01' + ltype for ltype in func.local_types ]
         if not func.code[-1:] == b'\x0b':
@@ -294,12 +323,17 @@ def encode_module(module):
     # section 3 - Functions
     section3 = Encode.section(3, Encode.vector([Encode.unsigned(f.idx) for f in module.functions]))
 
+    # section 5 - Memory, holding the arrays
+    section5 = Encode.section(5, Encode.memory(module.memory)) if module.memory else b''
+
     # section 6 - Globals
     all_globals = [ Encode.vglobal(gvar) for gvar in module.global_variables ]
     section6 = Encode.section(6, Encode.vector(all_globals))
 
     # section 7 - Exports
     all_exports = [ Encode.export_function(func) for func in module.functions ]
+    if module.memory:
+        all_exports.append( Encode.string('memory') + b'\x02' + Encode.unsigned(0) )
     section7 = Encode.section(7, Encode.vector(all_exports))
 
     # section 10 - Code
@@ -310,13 +344,18 @@ def encode_module(module):
                     section1,
                     section2,
                     section3,
+                    section5,
                     section6,
                     section7,
                     section10])
 
 # Top-level function for generating code from the model
-def generate_program(model):
+def generate_program(model, profile: Profile | None = None, types: Types | None = None):
     mod = WabbitWasmModule('wabbit')
+    # branch counts of a training run, to put the hot arm of an if first
+    mod.profile = profile
+    # types of the checked model
+    mod.types = types or Types()
     WasmImportedFunction(
         mod,
         'runtime',
@@ -358,7 +397,10 @@ def generate_program(model):
         [ ],
         [ WasmType.i32 ]
     )
-    _generate(model, mod)
+    model = model if isinstance(model, list) else [model]
+    resolve_program(model)
+    for n in model:
+        _generate(n, mod)
     main.iconst(0)
     main.ret()
     return mod
@@ -377,19 +419,22 @@ rule = _generate.register
 @rule(Bool)
 @rule(Unit)
 def _generate_literal(node: LiteralT, mod: WabbitWasmModule):
-    if node.p_type == 'int':
+    if mod.types.get(node) == 'int':
         mod.functions[-1].iconst(node.value)
-    if node.p_type == 'float':
+    if mod.types.get(node) == 'float':
         mod.functions[-1].fconst(node.value)
-    if node.p_type == 'bool':
+    if mod.types.get(node) == 'bool':
         mod.functions[-1].iconst(1 if node.value else 0)
-    if node.p_type == 'char':
+    if mod.types.get(node) == 'char':
         mod.functions[-1].iconst(ord(node.value) if node.value != '\\n' else 10)
-    if node.p_type == 'unit':
+    if mod.types.get(node) == 'unit':
         mod.functions[-1].iconst(0)
 
 @rule(BinOp)
 def _generate_binop(node: BinOp, mod: WabbitWasmModule):
+    if is_array(mod.types.get(node)):
+        return _generate_array_binop(node, mod)
+
     lineno = node.lineno
 
     if not node.op in ['&&', '||']:
@@ -397,53 +442,53 @@ def _generate_binop(node: BinOp, mod: WabbitWasmModule):
         _generate(node.right, mod)
 
     false = Bool(lineno, False)
-    false.p_type = 'bool'
+    mod.types.set(false, 'bool')
 
     true = Bool(lineno, True)
-    true.p_type = 'bool'
+    mod.types.set(true, 'bool')
 
     truecmp = BinOp(lineno, '==', node.left, true)
-    truecmp.p_type = 'bool'
+    mod.types.set(truecmp, 'bool')
 
     block_exec_right = BlockStatement( lineno, [ node.right ] )
-    block_exec_right.p_type = 'bool'
+    mod.types.set(block_exec_right, 'bool')
 
     block_true = BlockStatement( lineno, [ true ] )
-    block_true.p_type = 'bool'
+    mod.types.set(block_true, 'bool')
 
     block_false = BlockStatement( lineno, [ false ] )
-    block_false.p_type = 'bool'
+    mod.types.set(block_false, 'bool')
 
     match node.op:
         case '+':
-            if node.left.p_type == 'int': mod.functions[-1].iadd()
+            if mod.types.get(node.left) == 'int': mod.functions[-1].iadd()
             else: mod.functions[-1].fadd()
         case '-':
-            if node.left.p_type == 'int': mod.functions[-1].isub()
+            if mod.types.get(node.left) == 'int': mod.functions[-1].isub()
             else: mod.functions[-1].fsub()
         case '/':
-            if node.left.p_type == 'int': mod.functions[-1].idiv()
+            if mod.types.get(node.left) == 'int': mod.functions[-1].idiv()
             else: mod.functions[-1].fdiv()
         case '*':
-            if node.left.p_type == 'int': mod.functions[-1].imul()
+            if mod.types.get(node.left) == 'int': mod.functions[-1].imul()
             else: mod.functions[-1].fmul()
         case '<':
-            if node.left.p_type == 'float': mod.functions[-1].flt()
+            if mod.types.get(node.left) == 'float': mod.functions[-1].flt()
             else: mod.functions[-1].ilt()
         case '>':
-            if node.left.p_type == 'float': mod.functions[-1].fgt()
+            if mod.types.get(node.left) == 'float': mod.functions[-1].fgt()
             else: mod.functions[-1].igt()
         case '<=':
-            if node.left.p_type == 'float': mod.functions[-1].fle()
+            if mod.types.get(node.left) == 'float': mod.functions[-1].fle()
             else: mod.functions[-1].ile()
         case '>=':
-            if node.left.p_type == 'float': mod.functions[-1].fge()
+            if mod.types.get(node.left) == 'float': mod.functions[-1].fge()
             else: mod.functions[-1].ige()
         case '==':
-            if node.left.p_type == 'float': mod.functions[-1].feq()
+            if mod.types.get(node.left) == 'float': mod.functions[-1].feq()
             else: mod.functions[-1].ieq()
         case '!=':
-            if node.left.p_type == 'float': mod.functions[-1].fneq()
+            if mod.types.get(node.left) == 'float': mod.functions[-1].fneq()
             else: mod.functions[-1].ineq()
         case '&&':
             _generate_ifstatement(
@@ -466,26 +511,32 @@ def _generate_binop(node: BinOp, mod: WabbitWasmModule):
 
 @rule(UnOp)
 def _generate_unop(node: UnOp, mod: WabbitWasmModule):
+    if is_array(mod.types.get(node)):
+        return _generate_array_unop(node, mod)
+
     _generate(node.expr, mod)
 
     if node.op == '!':
         mod.functions[-1].ieqz()
-    elif node.op == '-' and node.p_type == 'int':
+    elif node.op == '-' and mod.types.get(node) == 'int':
         mod.functions[-1].iconst(-1)
         mod.functions[-1].imul()
-    elif node.op == '-' and node.p_type == 'float':
+    elif node.op == '-' and mod.types.get(node) == 'float':
         mod.functions[-1].fconst(-1)
         mod.functions[-1].fmul()
 
 @rule(PrintStatement)
 def _generate_print_statement(node: PrintStatement, mod: WabbitWasmModule):
+    if is_array(mod.types.get(node.expr)):
+        raise RuntimeError(f"{node.lineno}: Can't print arrays in wasm")
+
     _generate(node.expr, mod)
     for f in mod.imported_functions:
-        if  node.expr.p_type == 'int' and f.name == '_printi' or \
-            node.expr.p_type == 'float' and f.name == '_printf' or \
-            node.expr.p_type == 'bool' and f.name == '_printb' or \
-            node.expr.p_type == 'char' and f.name == '_printc' or \
-            node.expr.p_type == 'unit' and f.name == '_printu':
+        if  mod.types.get(node.expr) == 'int' and f.name == '_printi' or \
+            mod.types.get(node.expr) == 'float' and f.name == '_printf' or \
+            mod.types.get(node.expr) == 'bool' and f.name == '_printb' or \
+            mod.types.get(node.expr) == 'char' and f.name == '_printc' or \
+            mod.types.get(node.expr) == 'unit' and f.name == '_printu':
             mod.functions[-1].call(f)
         else:
             continue
@@ -493,18 +544,29 @@ def _generate_print_statement(node: PrintStatement, mod: WabbitWasmModule):
 
 @rule(Location)
 def _generate_location(node: Location, mod: WabbitWasmModule):
-    idx = mod.env.get(node.name)
+    idx = mod.env.get(node.binding)
     mod.functions[-1].local_get(idx)
 
 @rule(VarDefinition)
 @rule(ConstDefinition)
 def _generate_definition(node: VarDefinition | ConstDefinition, mod: WabbitWasmModule):
-    name = node.location.name
+    binding = node.location.binding
+
+    dtype = mod.types.get(node.value) if node.value else node.dtype
+    if is_array(dtype):
+        # the variable holds the address of its own elements
+        idx = _new_array(dtype, mod)
+        if node.value:
+            _copy_array(idx, _array_local(node.value, mod), dtype, mod)
+        else:
+            _copy_array(idx, None, dtype, mod)
+        mod.env[binding] = idx
+        return
 
     if node.value != None:
         _generate(node.value, mod)
 
-    if node.dtype == 'float' or node.value and node.value.p_type == 'float':
+    if node.dtype == 'float' or node.value and mod.types.get(node.value) == 'float':
         idx = mod.functions[-1].alloca(WasmType.f64)
         if node.value == None: mod.functions[-1].fconst(0)
     else:
@@ -513,11 +575,15 @@ def _generate_definition(node: VarDefinition | ConstDefinition, mod: WabbitWasmM
 
     mod.functions[-1].local_set(idx)
 
-    mod.env[name] = idx
+    mod.env[binding] = idx
 
 @rule(AssignmentStatement)
 def _generate_assignmentstatement(node: AssignmentStatement, mod: WabbitWasmModule):
-    idx = mod.env.get(node.location.name)
+    idx = mod.env.get(node.location.binding)
+
+    if is_array(mod.types.get(node.location)):
+        _copy_array(idx, _array_local(node.value, mod), mod.types.get(node.location), mod)
+        return
 
     _generate(node.value, mod)
 
@@ -525,17 +591,28 @@ def _generate_assignmentstatement(node: AssignmentStatement, mod: WabbitWasmModu
 
 @rule(IfStatement)
 def _generate_ifstatement(node: IfStatement, mod: WabbitWasmModule):
+    block_if, block_else = node.block_if, node.block_else
+
     _generate(node.cmp, mod)
-    mod.functions[-1].if_start(
-        WasmType.f64 if node.block_if.p_type == 'float' else WasmType.i32
-    )
+    if block_else and mod.profile and mod.profile.likely(node.lineno) is False:
+        # the else branch is the hot one: test the negated condition
+        mod.functions[-1].ieqz()
+        block_if, block_else = block_else, block_if
+
+    # an if of statements leaves no value
+    if mod.types.get(node.block_if) is None:
+        mod.functions[-1].if_start()
+    else:
+        mod.functions[-1].if_start(
+            WasmType.f64 if mod.types.get(node.block_if) == 'float' else WasmType.i32
+        )
 
     mod.countLabels += 1
-    _generate_blockstatement(node.block_if, mod)
+    _generate_blockstatement(block_if, mod)
 
-    if (node.block_else):
+    if (block_else):
         mod.functions[-1].else_block()
-        _generate_blockstatement(node.block_else, mod)
+        _generate_blockstatement(block_else, mod)
 
     mod.functions[-1].end()
     mod.countLabels -= 1
@@ -582,4 +659,215 @@ def _generate_blockstatement(node: BlockStatement, mod: WabbitWasmModule):
     for inst in node.instructions:
         _generate(inst, mod)
 
-    # env.popScope()
\ No newline at end of file
+    # env.popScope()
+
+
+# Arrays live in linear memory, their elements one after the other: 4
+# bytes for int and bool, 8 for float. All code is in main, so every
+# array expression gets a fixed place, laid out at compile time, and its
+# value on the stack is the address.
+
+def _width(dtype: DType) -> int:
+    return 8 if element_type(dtype) == 'float' else 4
+
+def _array_local(node: Expression, mod: WabbitWasmModule) -> int:
+    '''
+    Evaluate node into a new local
+    '''
+    _generate(node, mod)
+    idx = mod.functions[-1].alloca(WasmType.f64 if mod.types.get(node) == 'float' else WasmType.i32)
+    mod.functions[-1].local_set(idx)
+    return idx
+
+def _element(array: int, i: int, dtype: DType, mod: WabbitWasmModule):
+    '''
+    Push the address of element i of the array held by local array
+    '''
+    f = mod.functions[-1]
+    f.local_get(array)
+    f.local_get(i)
+    f.iconst(_width(dtype))
+    f.imul()
+    f.iadd()
+
+def _load(dtype: DType, mod: WabbitWasmModule):
+    if element_type(dtype) == 'float': mod.functions[-1].fload()
+    else: mod.functions[-1].iload()
+
+def _store(dtype: DType, mod: WabbitWasmModule):
+    if element_type(dtype) == 'float': mod.functions[-1].fstore()
+    else: mod.functions[-1].istore()
+
+def _array_loop(size: int, body, mod: WabbitWasmModule, start: int = 0):
+    '''
+    Emit body(i) for every i from start up to size, where i is the local
+    holding the index
+    '''
+    f = mod.functions[-1]
+    i = f.alloca(WasmType.i32)
+    f.iconst(start)
+    f.local_set(i)
+    f.block()
+    f.loop()
+    f.local_get(i)
+    f.iconst(size)
+    f.ige()
+    f.br_if(1)
+    body(i)
+    f.local_get(i)
+    f.iconst(1)
+    f.iadd()
+    f.local_set(i)
+    f.br(0)
+    f.end()
+    f.end()
+
+def _copy_array(dest: int, source: int | None, dtype: DType, mod: WabbitWasmModule):
+    '''
+    Copy the elements of the array at local source into the one at local
+    dest, or zero them when source is None
+    '''
+    def body(i):
+        _element(dest, i, dtype, mod)
+        if source is None:
+            if element_type(dtype) == 'float': mod.functions[-1].fconst(0)
+            else: mod.functions[-1].iconst(0)
+        else:
+            _element(source, i, dtype, mod)
+            _load(dtype, mod)
+        _store(dtype, mod)
+    _array_loop(array_size(dtype), body, mod)
+
+def _new_array(dtype: DType, mod: WabbitWasmModule) -> int:
+    idx = mod.functions[-1].alloca(WasmType.i32)
+    mod.functions[-1].iconst(mod.alloc(_width(dtype) * array_size(dtype)))
+    mod.functions[-1].local_set(idx)
+    return idx
+
+def _generate_array_binop(node: BinOp, mod: WabbitWasmModule):
+    left = _array_local(node.left, mod)
+    right = _array_local(node.right, mod)
+    result = _new_array(mod.types.get(node), mod)
+    f = mod.functions[-1]
+    is_float = element_type(mod.types.get(node)) == 'float'
+
+    def operand(operand: Expression, idx: int, i: int):
+        if is_array(mod.types.get(operand)):
+            _element(idx, i, mod.types.get(node), mod)
+            _load(mod.types.get(node), mod)
+        else:
+            f.local_get(idx)
+
+    def body(i):
+        _element(result, i, mod.types.get(node), mod)
+        operand(node.left, left, i)
+        operand(node.right, right, i)
+        match node.op:
+            case '+': f.fadd() if is_float else f.iadd()
+            case '-': f.fsub() if is_float else f.isub()
+            case '*': f.fmul() if is_float else f.imul()
+            case '/': f.fdiv() if is_float else f.idiv()
+        _store(mod.types.get(node), mod)
+
+    _array_loop(array_size(mod.types.get(node)), body, mod)
+    f.local_get(result)
+
+def _generate_array_unop(node: UnOp, mod: WabbitWasmModule):
+    expr = _array_local(node.expr, mod)
+    if node.op != '-':
+        mod.functions[-1].local_get(expr)
+        return
+
+    result = _new_array(mod.types.get(node), mod)
+    f = mod.functions[-1]
+
+    def body(i):
+        _element(result, i, mod.types.get(node), mod)
+        _element(expr, i, mod.types.get(node), mod)
+        _load(mod.types.get(node), mod)
+        if element_type(mod.types.get(node)) == 'float':
+            f.fconst(-1)
+            f.fmul()
+        else:
+            f.iconst(-1)
+            f.imul()
+        _store(mod.types.get(node), mod)
+
+    _array_loop(array_size(mod.types.get(node)), body, mod)
+    f.local_get(result)
+
+@rule(ArrayLiteral)
+def _generate_arrayliteral(node: ArrayLiteral, mod: WabbitWasmModule):
+    result = _new_array(mod.types.get(node), mod)
+    f = mod.functions[-1]
+    for i, e in enumerate(node.elements):
+        f.local_get(result)
+        f.iconst(i * _width(mod.types.get(node)))
+        f.iadd()
+        _generate(e, mod)
+        _store(mod.types.get(node), mod)
+    f.local_get(result)
+
+@rule(Index)
+def _generate_index(node: Index, mod: WabbitWasmModule):
+    dtype = mod.types.get(node.array)
+    _generate(node.array, mod)
+    _generate(node.index, mod)
+    mod.functions[-1].iconst(_width(dtype))
+    mod.functions[-1].imul()
+    mod.functions[-1].iadd()
+    _load(dtype, mod)
+
+@rule(IndexAssignment)
+def _generate_indexassignment(node: IndexAssignment, mod: WabbitWasmModule):
+    dtype = mod.types.get(node.location)
+    mod.functions[-1].local_get(mod.env.get(node.location.binding))
+    _generate(node.index, mod)
+    mod.functions[-1].iconst(_width(dtype))
+    mod.functions[-1].imul()
+    mod.functions[-1].iadd()
+    _generate(node.value, mod)
+    _store(dtype, mod)
+
+@rule(ArrayFunction)
+def _generate_arrayfunction(node: ArrayFunction, mod: WabbitWasmModule):
+    dtype = mod.types.get(node.expr)
+    array = _array_local(node.expr, mod)
+    f = mod.functions[-1]
+    if node.name == 'len':
+        f.iconst(array_size(dtype))
+        return
+
+    is_float = element_type(dtype) == 'float'
+    total = f.alloca(WasmType.f64 if is_float else WasmType.i32)
+
+    if node.name == 'sum':
+        f.fconst(0) if is_float else f.iconst(0)
+        f.local_set(total)
+
+        def body(i):
+            f.local_get(total)
+            _element(array, i, dtype, mod)
+            _load(dtype, mod)
+            f.fadd() if is_float else f.iadd()
+            f.local_set(total)
+        _array_loop(array_size(dtype), body, mod)
+    else:
+        f.local_get(array)
+        _load(dtype, mod)
+        f.local_set(total)
+
+        def body(i):
+            _element(array, i, dtype, mod)
+            _load(dtype, mod)
+            f.local_get(total)
+            if node.name == 'min': f.flt() if is_float else f.ilt()
+            else: f.fgt() if is_float else f.igt()
+            f.if_start()
+            _element(array, i, dtype, mod)
+            _load(dtype, mod)
+            f.local_set(total)
+            f.end()
+        _array_loop(array_size(dtype), body, mod, 1)
+
+    f.local_get(total)
@@ -1,68 +1,247 @@
+import os
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from functools import singledispatch
 
 from .model import *
+from . import arrays
+from .resolve import resolve_program
+from .purity import pure_functions, function_costs
+from .profiler import Profile
+from .output import Output, BufferedOutput, CollectOutput
+from .tier import Tier, HOT_ITERATIONS
 
 class Env:
-    def __init__(self):
-        self.stack = [{}]
-        self.global_vars = {}
-        self.registers = []
+    def __init__(self, size: int = 0):
+        # frames are flat lists indexed by the slots given by resolve_program
+        self.globals = [None] * size
+        self.frame = self.globals
         self.functions = {}
-        self.returnValue = []
-
-    def newScope(self):
-        self.stack.insert(0, {})
-
-    def popScope(self):
-        self.stack.pop(0)
-
-    def pushRegister(self):
-        self.registers.append( self.stack )
-        self.stack = [{}]
-
-    def popRegister(self):
-        self.stack = self.registers.pop()
-
-    def createRegister(self, name: str, data: Node | None):
-        self.stack[0][name] = data
-
-    def setRegister(self, name: str, data: Node):
-        for i in range( len(self.stack) ):
-            if self.stack[i].get(name):
-                self.stack[i][name] = data
-                break
-
-    def getRegister(self, name: str) -> Node | None:
-        for i in range( len(self.stack) ):
-            reg = self.stack[i].get(name)
-            if reg: return reg
-        return self.global_vars.get(name)
-
-
-def interpret_program(model: list[Node]):
-    env = Env()
-
-    for s in model:
-        _interpret(s, env)
-
-        for key in list(env.stack[0]):
-            env.global_vars[key] = env.stack[0].get(key)
-        env.stack[0] = {}
-
-    (_, main) = env.functions['main']
-
-    getLiteralFromExpr(main, env)
-    resp = env.returnValue.pop().value
-    return resp
+        self.returnValue = None
+        self.memo = None
+        self.profile = None
+        self.tier = None
+        self.out = None
+        self.parallel = None
+        self.types = Types()
+
+    def pushFrame(self, frame: list) -> list:
+        caller = self.frame
+        self.frame = frame
+        return caller
+
+    def popFrame(self, caller: list):
+        self.frame = caller
+
+    def setRegister(self, location: Location, data):
+        if location.frame:
+            self.frame[location.slot] = data
+        else:
+            self.globals[location.slot] = data
+
+    def getRegister(self, location: Location):
+        if location.frame:
+            return self.frame[location.slot]
+        return self.globals[location.slot]
+
+
+class Memo:
+    '''
+    Bounded LRU cache of the results of pure functions, keyed by the
+    function and its arguments. Pass one to interpret_program to enable
+    memoization for that run.
+    '''
+    MISSING = object()
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.pure = set()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f'Memo(hits={self.hits}, misses={self.misses}, size={len(self.cache)}/{self.maxsize})'
+
+    def get(self, key: tuple):
+        value = self.cache.get(key, Memo.MISSING)
+        if value is Memo.MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.cache.move_to_end(key)
+        return value
+
+    def put(self, key: tuple, value):
+        self.cache[key] = value
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
+
+class Parallel:
+    '''
+    Evaluates calls of pure functions costing at least threshold (see
+    function_costs) in a pool of worker processes, while the interpreter
+    goes on with the other operands of the same BinOp or argument list.
+    A call is only sent off while a worker is idle; otherwise it runs
+    inline. Only code run by the tree walker sends calls off, which is
+    the top of a divide-and-conquer recursion, before the function gets
+    hot and compiled. Pass one to interpret_program to enable it.
+    '''
+    def __init__(self, workers: int | None = None, threshold: float = 64):
+        self.workers = workers or os.cpu_count()
+        self.threshold = threshold
+        self.expensive = set()
+        self.index = {}
+        self.pool = None
+        self.pending = 0
+        self.forks = 0
+
+    def __repr__(self):
+        return f'Parallel(workers={self.workers}, forks={self.forks})'
+
+    def start(self, model: list[Node], size: int, types: Types):
+        functions = [ n for n in model if isinstance(n, FunctionDefinition) ]
+        self.index = { f: i for i, f in enumerate(functions) }
+
+        costs = function_costs(model)
+        self.expensive = { f for f in pure_functions(model) if costs[f] >= self.threshold }
+
+        self.pool = ProcessPoolExecutor(self.workers, initializer=_start_worker, initargs=(model, size, types))
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+        self.pending = 0
+
+    def isExpensive(self, expr: Expression) -> bool:
+        '''
+        Whether expr is a call that may be sent to a worker
+        '''
+        return isinstance(expr, FunctionCall) and expr.function in self.expensive
+
+    def evaluate(self, exprs: list[Expression], env: Env) -> list:
+        '''
+        Values of exprs, evaluated left to right except that the bodies of
+        expensive pure calls may run in a worker. The results and every
+        side effect are the same as evaluating them in order.
+        '''
+        values = []
+        futures = []
+        last = len(exprs) - 1
+        for i, e in enumerate(exprs):
+            if i < last and self.isExpensive(e) and self.pending < self.workers:
+                args = [ _interpret(a, env) for a in e.args ]
+                futures.append( (i, self.pool.submit(_run_pure, self.index[e.function], args, env.globals)) )
+                self.pending += 1
+                self.forks += 1
+                values.append(None)
+            else:
+                values.append( _interpret_value(e, env) )
+
+        for (i, future) in futures:
+            values[i] = future.result()
+            self.pending -= 1
+
+        return values
+
+# the interpreter state of a worker process of Parallel
+_worker = None
+
+def _start_worker(model: list[Node], size: int, types: Types):
+    global _worker
+    env = Env(size)
+    env.out = CollectOutput()
+    env.types = types
+    env.tier = Tier(env.globals, lambda function, frame: _call(function, frame, env), None, types)
+    functions = [ n for n in model if isinstance(n, FunctionDefinition) ]
+    _worker = (env, functions)
+
+def _run_pure(index: int, args: list, globals: list):
+    (env, functions) = _worker
+    # pure functions only read constants, but those can be anywhere
+    env.globals[:] = globals
+    return _call(functions[index], args, env)
+
+
+def interpret_program(model: list[Node], memo: Memo | None = None, profile: Profile | None = None,
+                      tiered: bool = True, out: Output | None = None, parallel: Parallel | None = None,
+                      types: Types | None = None):
+    '''
+    Run the model, printing to out, a BufferedOutput on sys.stdout by
+    default. types are those check_model found for the model. Unless
+    tiered is False, hot functions and loops are compiled to Python on
+    the way; memoizing or profiling runs stay in the tree walker, since
+    they observe every call and statement.
+    '''
+    size = resolve_program(model)
+    env = Env(size)
+    env.out = out = out if out is not None else BufferedOutput()
+    env.types = types = types or Types()
+
+    if memo is not None:
+        memo.pure = pure_functions(model)
+        env.memo = memo
+    env.profile = profile
+
+    if parallel is not None:
+        parallel.start(model, size, types)
+        # without expensive calls, nothing is sent off
+        if parallel.expensive:
+            env.parallel = parallel
+
+    if tiered and memo is None and profile is None:
+        write = out.write
+        env.tier = Tier(env.globals, lambda function, frame: _call(function, frame, env),
+                        lambda value, p_type: write(formatValue(value, p_type)), types)
+
+    try:
+        if profile is not None:
+            _interpret_profiled(model, env)
+        else:
+            for s in model:
+                _interpret(s, env)
+
+        main = env.functions['main']
+        # unit when main ends without a return
+        value = _call(main, [], env)
+    finally:
+        out.flush()
+        if parallel is not None:
+            parallel.stop()
+
+    return value
 
 inf_int = 2147483647
 inf_float = 1.7e+308
 
-def getLiteralFromExpr(node: Expression, env):
-    return node if isinstance(node, LiteralT) else _interpret(node, env)
-
-def copyLiteral(node: LiteralT):
-    return node.__class__(node.lineno, node.value)
+# Runtime values are plain Python values: int, float, bool, a str for
+# char and '()' for unit, and arrays are those of the arrays module. Their
+# type comes from the Types typecheck found; valueType covers models
+# that were not checked.
+
+def valueType(value) -> DType | None:
+    if isinstance(value, bool): return 'bool'
+    if isinstance(value, int): return 'int'
+    if isinstance(value, float): return 'float'
+    if value == '()': return 'unit'
+    if isinstance(value, str): return 'char'
+    return None
+
+def formatValue(value, p_type: DType | None) -> str:
+    '''
+    Text printed by a print statement
+    '''
+    match p_type or valueType(value):
+        case 'bool': return 'true\n' if value else 'false\n'
+        case 'char': return value if value != '\\n' else '\n'
+        case str() as dtype if is_array(dtype): return arrays.format(value, element_type(dtype))
+        case _: return f'{value}\n'
+
+def printValue(value, p_type: DType | None):
+    sys.stdout.write( formatValue(value, p_type) )
 
 
 @singledispatch
@@ -86,173 +265,541 @@ def _interpret_breakcontinue(node: Break | Continue, env: Env):
 
 @rule(PrintStatement)
 def _interpret_print(node: PrintStatement, env):
-    expr = getLiteralFromExpr( node.expr , env )
-    if isinstance(expr, Char):
-        print(expr if expr.value != '\\n' else '\n', end='')
-    else:
-        print( expr )
+    env.out.write( formatValue(_interpret(node.expr, env), env.types.get(node)) )
 
 @rule(UnOp)
-def _interpret_unop(node: UnOp, env: Env) -> LiteralT:
-    expr = copyLiteral( getLiteralFromExpr(node.expr, env) )
+def _interpret_unop(node: UnOp, env: Env):
+    value = _interpret(node.expr, env)
+
+    if is_array(env.types.get(node)):
+        return arrays.unop(node.op, value)
 
     if node.op == '-':
-        expr.value = -1 * expr.value
+        return -value
     elif node.op == '!':
-        expr.value = not expr.value
+        return not value
 
-    return expr
+    return value
 
 @rule(BinOp)
 def _interpret_binop(node: BinOp, env: Env):
-    left = getLiteralFromExpr(node.left, env)
-    right = getLiteralFromExpr(node.right, env)
+    if env.parallel is not None and env.parallel.isExpensive(node.left) and node.op != '&&' and node.op != '||':
+        (left, right) = env.parallel.evaluate([node.left, node.right], env)
+    else:
+        left = _interpret(node.left, env)
+
+        match node.op:
+            case '&&': return left and _interpret(node.right, env)
+            case '||': return left or _interpret(node.right, env)
+
+        right = _interpret(node.right, env)
 
-    res = copyLiteral(left)
+    p_type = env.types.get(node)
+    if is_array(p_type):
+        return arrays.binop(node.op, element_type(p_type), left, right)
 
     match node.op:
-        case '+': res.value = left.value + right.value
-        case '-': res.value = left.value - right.value
+        case '+': return left + right
+        case '-': return left - right
+        case '*': return left * right
+        case '<': return left < right
+        case '>': return left > right
+        case '<=': return left <= right
+        case '>=': return left >= right
+        case '==': return left == right
+        case '!=': return left != right
         case '/':
-            if right.value == 0:
-                res.value = inf_int if isinstance(right, Integer) else inf_float
-            else:
-                res.value = left.value / right.value
-                if isinstance(left, Integer): res.value = int(res.value)
-        case '*': res.value = left.value * right.value
-        case '<': res = Bool(node.lineno, left.value < right.value)
-        case '>': res = Bool(node.lineno, left.value > right.value)
-        case '<=': res = Bool(node.lineno, left.value <= right.value)
-        case '>=': res = Bool(node.lineno, left.value >= right.value)
-        case '==': res = Bool(node.lineno, left.value == right.value)
-        case '!=': res = Bool(node.lineno, left.value != right.value)
-        case '&&': res = Bool(node.lineno, left.value and right.value)
-        case '||': res = Bool(node.lineno, left.value or right.value)
-
-    return res
+            if (p_type or valueType(left)) == 'int':
+                return int(left / right) if right != 0 else inf_int
+            return left / right if right != 0 else inf_float
 
 @rule(Location)
 def _interpret_location(node: Location, env: Env):
-    return env.getRegister(node.name)
+    return env.getRegister(node)
+
+def _interpret_value(node: Expression, env: Env):
+    '''
+    Value of node to store or pass on. Arrays are values, so the array of
+    a variable is copied.
+    '''
+    value = _interpret(node, env)
+    if isinstance(node, Location | CompoundExpression) and is_array(env.types.get(node)):
+        return arrays.copy(value)
+    return value
 
 @rule(VarDefinition)
 @rule(ConstDefinition)
 def _interpret_definition(node: VarDefinition | ConstDefinition, env: Env):
-    name = node.location.name
-
     if node.value:
-        value = getLiteralFromExpr(node.value, env)
+        value = _interpret_value(node.value, env)
+    elif is_array(node.dtype):
+        value = arrays.zeros(element_type(node.dtype), array_size(node.dtype))
     else:
-        dtype: DType = node.dtype
-        match dtype:
-            case 'int': value = Integer(node.lineno, None)
-            case 'float': value = Float(node.lineno, None)
-            case 'char': value = Char(node.lineno, None)
-            case 'bool': value = Bool(node.lineno, None)
-            case 'unit': value = Unit(node.lineno)
+        value = '()' if node.dtype == 'unit' else None
 
-    env.createRegister(name, value)
+    env.setRegister(node.location, value)
 
 @rule(AssignmentStatement)
 def _interpret_assignment(node: AssignmentStatement, env: Env):
-    nodeval = getLiteralFromExpr(node.value, env)
-    env.setRegister( node.location.name, nodeval )
+    env.setRegister( node.location, _interpret_value(node.value, env) )
+
+@rule(ArrayLiteral)
+def _interpret_arrayliteral(node: ArrayLiteral, env: Env):
+    values = [ _interpret(e, env) for e in node.elements ]
+    return arrays.from_values(element_type(env.types.get(node)), values)
+
+@rule(Index)
+def _interpret_index(node: Index, env: Env):
+    array = _interpret(node.array, env)
+    return arrays.get(array, _interpret(node.index, env), node.lineno)
+
+@rule(IndexAssignment)
+def _interpret_indexassignment(node: IndexAssignment, env: Env):
+    index = _interpret(node.index, env)
+    value = _interpret(node.value, env)
+    arrays.store(env.getRegister(node.location), index, value, node.lineno)
+
+@rule(ArrayFunction)
+def _interpret_arrayfunction(node: ArrayFunction, env: Env):
+    return arrays.reduce(node.name, _interpret(node.expr, env))
 
 @rule(BlockStatement)
 def _interpret_blockstatement(node: BlockStatement, env: Env):
-    resp = None
-    env.newScope()
+    if env.profile is not None:
+        return _interpret_profiled(node.instructions, env)
 
     for inst in node.instructions:
         resp = _interpret(inst, env)
         if isinstance(resp, Break) or \
                 isinstance(resp, Continue) or \
                 isinstance(resp, ReturnStatement):
-            break
+            return resp
 
-    env.popScope()
-    return resp if resp else Unit(node.lineno)
+    return None
 
 @rule(IfStatement)
 def _interpret_Ifstatement(node: IfStatement, env: Env):
-    resp = None
-    cmp = getLiteralFromExpr(node.cmp, env)
-    if _interpret(cmp, env):
-        resp = _interpret_blockstatement(node.block_if, env)
+    taken = _interpret(node.cmp, env)
+    if env.profile is not None:
+        env.profile.branch(node.lineno, bool(taken))
+
+    if taken:
+        return _interpret_blockstatement(node.block_if, env)
     elif node.block_else:
-        resp = _interpret_blockstatement(node.block_else, env)
+        return _interpret_blockstatement(node.block_else, env)
 
-    return resp
+    return None
 
 @rule(WhileStatement)
 def _interpret_whilestatement(node: WhileStatement, env: Env):
-    cmp = getLiteralFromExpr(node.cmp, env)
-    while _interpret(cmp, env):
+    tier = env.tier
+    if tier is not None and tier.compiled.get(node):
+        return _run_compiled_loop(node, env)
+
+    iterations = 0
+    resp = None
+    while _interpret(node.cmp, env):
         resp = _interpret_blockstatement(node.body, env)
-        if isinstance(resp, Break) or isinstance(resp, ReturnStatement): break
-        if isinstance(resp, Continue): continue
-        cmp = getLiteralFromExpr(node.cmp, env)
+        iterations += 1
+        if isinstance(resp, Break | ReturnStatement): break
+
+        # a loop that failed to compile is marked False and not tried again
+        if iterations == HOT_ITERATIONS and tier is not None and node not in tier.compiled \
+                and tier.compileLoop(node):
+            # carry on from the next check of the condition
+            return _run_compiled_loop(node, env)
+
+    if env.profile is not None:
+        env.profile.loop(node.lineno, iterations)
     return resp if isinstance(resp, ReturnStatement) else None
 
+# stands for the return statement a compiled loop ran
+_returned = ReturnStatement(0, None)
+
+def _run_compiled_loop(node: WhileStatement, env: Env):
+    resp = env.tier.compiled[node](env.frame)
+    if resp is not None:
+        env.returnValue = resp[0]
+        return _returned
+    return None
+
 @rule(CompoundExpression)
 def _interpret_compoundexpression(node: CompoundExpression, env: Env):
-    env.newScope()
-
     for inst in node.instructions[:-1]:
         _interpret(inst, env)
 
-    expr = getLiteralFromExpr( node.instructions[-1], env )
-
-    env.popScope()
-    return expr
-
-@rule(FunctionParam)
-def _interpret_functionparam(node: FunctionParam, env: Env):
-    return (node.name, node.dtype)
+    return _interpret( node.instructions[-1], env )
 
 @rule(FunctionDefinition)
 def _interpret_functiondefinition(node: FunctionDefinition, env: Env):
-    params = []
-    for p in node.params:
-        params.append( _interpret_functionparam(p, env) )
-
-    function = node.body
-    env.functions[node.name] = (params, function)
+    env.functions[node.name] = node
 
 @rule(FunctionCall)
 def _interpret_functioncall(node: FunctionCall, env: Env):
-    (params, function) = env.functions[node.name]
-    lin = node.lineno
+    function = node.function
+
+    # the arguments are evaluated straight into the callee's frame
+    if env.parallel is not None and any( env.parallel.isExpensive(a) for a in node.args[:-1] ):
+        frame = env.parallel.evaluate(node.args, env)
+    else:
+        frame = [ _interpret_value(a, env) for a in node.args ]
 
-    args_interp = []
-    for i in range( len(params) ):
-        (name, dtype) = params[i]
-        args_interp.append(
-            VarDefinition(
-                lin,
-                Location(lin, name, dtype),
-                getLiteralFromExpr(node.args[i], env),
-                dtype
-            )
-        )
+    if env.profile is not None:
+        env.profile.call(node.lineno, node.name)
 
-    env.pushRegister()
+    memo = env.memo
+    if memo is not None and function in memo.pure:
+        key = (function, *frame)
+        value = memo.get(key)
+        if value is Memo.MISSING:
+            value = _call(function, frame, env)
+            memo.put(key, value)
+        return value
 
-    args_interp.extend(function.instructions)
-    function_body = BlockStatement(lin, args_interp)
-    resp = _interpret_blockstatement(function_body, env)
+    return _call(function, frame, env)
 
-    env.popRegister()
+def _call(function: FunctionDefinition, frame: list, env: Env):
+    tier = env.tier
+    if tier is not None:
+        compiled = tier.enter(function)
+        if compiled:
+            env.returnValue = compiled(*frame)
+            return env.returnValue
+
+    frame += function.locals
+
+    profile = env.profile
+    if profile is not None: profile.enter(function.name)
+
+    caller = env.pushFrame(frame)
+    resp = _interpret_blockstatement(function.body, env)
+    env.popFrame(caller)
+
+    if profile is not None: profile.exit()
 
     if isinstance(resp, ReturnStatement):
-        resp = env.returnValue.pop()
-    else:
-        resp = Unit(node.lineno)
+        return env.returnValue
+    return '()'
 
-    return resp
+def _interpret_profiled(instructions: list[Node], env: Env):
+    profile = env.profile
+
+    for inst in instructions:
+        start = profile.begin(inst.lineno)
+        resp = _interpret(inst, env)
+        profile.end(inst.lineno, start)
+
+        if isinstance(resp, Break) or \
+                isinstance(resp, Continue) or \
+                isinstance(resp, ReturnStatement):
+            return resp
+
+    return None
 
 @rule(ReturnStatement)
 def _interpret_ReturnStatement(node: ReturnStatement, env: Env):
-    ret_literal = getLiteralFromExpr(node.expr, env)
-    env.returnValue.append(ret_literal)
-    return node
\ No newline at end of file
+    env.returnValue = _interpret_value(node.expr, env) if node.expr is not None else '()'
+    return node
+
+# Closure-compiling engine: the model is walked once and every node becomes
+# a specialized Python closure, so running the program does no type dispatch.
+
+_BREAK = 1
+_CONTINUE = 2
+_RETURN = 3
+
+class _Function:
+    '''
+    Compiled FunctionDefinition, shared by all of its call sites
+    '''
+    __slots__ = ('locals', 'body')
+
+    def __init__(self):
+        self.locals = []
+        self.body = None
+
+
+class Context:
+    def __init__(self, memo: Memo | None = None, types: Types | None = None):
+        self.functions: dict[FunctionDefinition, _Function] = {}
+        self.memo = memo
+        self.types = types or Types()
+
+    def getFunction(self, node: FunctionDefinition) -> _Function:
+        if node not in self.functions:
+            self.functions[node] = _Function()
+        return self.functions[node]
+
+
+def interpret_closures(model: list[Node], memo: Memo | None = None, out: Output | None = None,
+                       types: Types | None = None):
+    return compile_closures(model, memo, types)(out)
+
+def compile_closures(model: list[Node], memo: Memo | None = None, types: Types | None = None):
+    '''
+    Compile the model into a callable that runs the program, printing to
+    its optional out argument, and returns the value returned by main,
+    like interpret_program.
+    '''
+    size = resolve_program(model)
+    if memo is not None:
+        memo.pure = pure_functions(model)
+
+    ctx = Context(memo, types)
+    statements = [ _statement(s, ctx) for s in model ]
+
+    def program(out: Output | None = None):
+        env = Env(size)
+        env.out = out = out if out is not None else BufferedOutput()
+
+        try:
+            for run in statements:
+                run(env)
+
+            main = ctx.getFunction(env.functions['main'])
+
+            caller = env.pushFrame(list(main.locals))
+            resp = main.body(env)
+            env.popFrame(caller)
+        finally:
+            out.flush()
+
+        return env.returnValue if resp == _RETURN else '()'
+
+    return program
+
+def _statement(node: Node, ctx: Context):
+    run = _closure(node, ctx)
+    if not isinstance(node, Expression):
+        return run
+
+    def discard(env: Env):
+        run(env)
+    return discard
+
+@singledispatch
+def _closure(node: Node, ctx: Context):
+    raise RuntimeError(f"Can't compile {node}")
+
+closure_rule = _closure.register
+
+@closure_rule(Integer)
+@closure_rule(Float)
+@closure_rule(Char)
+@closure_rule(Bool)
+@closure_rule(Unit)
+def _closure_literal(node: LiteralT, ctx: Context):
+    value = node.value
+    return lambda env: value
+
+@closure_rule(Break)
+def _closure_break(node: Break, ctx: Context):
+    return lambda env: _BREAK
+
+@closure_rule(Continue)
+def _closure_continue(node: Continue, ctx: Context):
+    return lambda env: _CONTINUE
+
+@closure_rule(PrintStatement)
+def _closure_print(node: PrintStatement, ctx: Context):
+    expr = _closure(node.expr, ctx)
+    p_type = ctx.types.get(node)
+
+    def run(env: Env):
+        env.out.write( formatValue(expr(env), p_type) )
+    return run
+
+@closure_rule(UnOp)
+def _closure_unop(node: UnOp, ctx: Context):
+    expr = _closure(node.expr, ctx)
+
+    match node.op:
+        case '-': return lambda env: -expr(env)
+        case '!': return lambda env: not expr(env)
+        case _: return expr
+
+@closure_rule(BinOp)
+def _closure_binop(node: BinOp, ctx: Context):
+    left = _closure(node.left, ctx)
+    right = _closure(node.right, ctx)
+    p_type = ctx.types.get(node)
+
+    match node.op:
+        case '+': return lambda env: left(env) + right(env)
+        case '-': return lambda env: left(env) - right(env)
+        case '*': return lambda env: left(env) * right(env)
+        case '<': return lambda env: left(env) < right(env)
+        case '>': return lambda env: left(env) > right(env)
+        case '<=': return lambda env: left(env) <= right(env)
+        case '>=': return lambda env: left(env) >= right(env)
+        case '==': return lambda env: left(env) == right(env)
+        case '!=': return lambda env: left(env) != right(env)
+        case '&&': return lambda env: left(env) and right(env)
+        case '||': return lambda env: left(env) or right(env)
+        case '/' if p_type == 'int':
+            def divide(env: Env):
+                r = right(env)
+                return int(left(env) / r) if r != 0 else inf_int
+            return divide
+        case '/' if p_type == 'float':
+            def divide(env: Env):
+                r = right(env)
+                return left(env) / r if r != 0 else inf_float
+            return divide
+        case '/':
+            def divide(env: Env):
+                l = left(env)
+                r = right(env)
+                if valueType(l) == 'int':
+                    return int(l / r) if r != 0 else inf_int
+                return l / r if r != 0 else inf_float
+            return divide
+
+@closure_rule(Location)
+def _closure_location(node: Location, ctx: Context):
+    slot = node.slot
+    if node.frame:
+        return lambda env: env.frame[slot]
+    return lambda env: env.globals[slot]
+
+def _closure_store(node: Location, value):
+    slot = node.slot
+    if node.frame:
+        def store(env: Env):
+            env.frame[slot] = value(env)
+    else:
+        def store(env: Env):
+            env.globals[slot] = value(env)
+    return store
+
+@closure_rule(VarDefinition)
+@closure_rule(ConstDefinition)
+def _closure_definition(node: VarDefinition | ConstDefinition, ctx: Context):
+    if node.value:
+        value = _closure(node.value, ctx)
+    elif is_array(node.dtype):
+        raise RuntimeError(f"{node.lineno}: Can't compile arrays, use interpret_program")
+    else:
+        default = '()' if node.dtype == 'unit' else None
+        value = lambda env: default
+
+    return _closure_store(node.location, value)
+
+@closure_rule(AssignmentStatement)
+def _closure_assignment(node: AssignmentStatement, ctx: Context):
+    return _closure_store(node.location, _closure(node.value, ctx))
+
+@closure_rule(BlockStatement)
+def _closure_blockstatement(node: BlockStatement, ctx: Context):
+    instructions = tuple( _statement(inst, ctx) for inst in node.instructions )
+
+    def run(env: Env):
+        for inst in instructions:
+            resp = inst(env)
+            if resp:
+                return resp
+    return run
+
+@closure_rule(IfStatement)
+def _closure_ifstatement(node: IfStatement, ctx: Context):
+    cmp = _closure(node.cmp, ctx)
+    block_if = _closure_blockstatement(node.block_if, ctx)
+
+    if not node.block_else:
+        def run(env: Env):
+            if cmp(env):
+                return block_if(env)
+        return run
+
+    block_else = _closure_blockstatement(node.block_else, ctx)
+
+    def run(env: Env):
+        if cmp(env):
+            return block_if(env)
+        return block_else(env)
+    return run
+
+@closure_rule(WhileStatement)
+def _closure_whilestatement(node: WhileStatement, ctx: Context):
+    cmp = _closure(node.cmp, ctx)
+    body = _closure_blockstatement(node.body, ctx)
+
+    def run(env: Env):
+        while cmp(env):
+            resp = body(env)
+            if resp == _BREAK: break
+            if resp == _RETURN: return resp
+    return run
+
+@closure_rule(CompoundExpression)
+def _closure_compoundexpression(node: CompoundExpression, ctx: Context):
+    instructions = tuple( _statement(inst, ctx) for inst in node.instructions[:-1] )
+    last = node.instructions[-1]
+    expr = _closure(last, ctx) if isinstance(last, Expression) else _statement(last, ctx)
+
+    def run(env: Env):
+        for inst in instructions:
+            inst(env)
+        return expr(env)
+    return run
+
+@closure_rule(FunctionDefinition)
+def _closure_functiondefinition(node: FunctionDefinition, ctx: Context):
+    function = ctx.getFunction(node)
+    function.locals = node.locals
+    function.body = _closure_blockstatement(node.body, ctx)
+
+    def run(env: Env):
+        env.functions[node.name] = node
+    return run
+
+@closure_rule(FunctionCall)
+def _closure_functioncall(node: FunctionCall, ctx: Context):
+    # resolved once here; the body is filled in when the definition compiles
+    function = ctx.getFunction(node.function)
+    args = tuple( _closure(a, ctx) for a in node.args )
+
+    def run(env: Env):
+        frame = [ a(env) for a in args ]
+        frame += function.locals
+
+        caller = env.frame
+        env.frame = frame
+        resp = function.body(env)
+        env.frame = caller
+
+        return env.returnValue if resp == _RETURN else '()'
+
+    memo = ctx.memo
+    if memo is None or node.function not in memo.pure:
+        return run
+
+    key = node.function
+    def memoized(env: Env):
+        values = tuple( a(env) for a in args )
+        value = memo.get( (key, *values) )
+        if value is Memo.MISSING:
+            value = call(env, values)
+            memo.put( (key, *values), value )
+        return value
+
+    def call(env: Env, values: tuple):
+        frame = list(values)
+        frame += function.locals
+
+        caller = env.frame
+        env.frame = frame
+        resp = function.body(env)
+        env.frame = caller
+
+        return env.returnValue if resp == _RETURN else '()'
+    return memoized
+
+@closure_rule(ReturnStatement)
+def _closure_returnstatement(node: ReturnStatement, ctx: Context):
+    expr = _closure(node.expr, ctx) if node.expr is not None else lambda env: '()'
+
+    def run(env: Env):
+        env.returnValue = expr(env)
+        return _RETURN
+    return run
@@ -9,6 +9,23 @@ UnOpType = Literal['+', '-', '!']
 BinOpType = Literal['+', '-', '/', '*', '<', '>', '<=', '>=', '==', '!=', '&&', '||']
 DType = Literal['int', 'float', 'bool', 'unit', 'char']
 
+# Arrays have a fixed size, part of their type: [8]float holds 8 floats
+ArrayElementTypes = ['int', 'float', 'bool']
+ArrayFunctions = ['len', 'sum', 'min', 'max']
+
+
+def array_type(size: int, dtype: DType) -> str:
+    return f'[{size}]{dtype}'
+
+def is_array(dtype: str | None) -> bool:
+    return dtype is not None and dtype[:1] == '['
+
+def element_type(dtype: str) -> DType:
+    return dtype[dtype.index(']') + 1:]
+
+def array_size(dtype: str) -> int:
+    return int(dtype[1:dtype.index(']')])
+
 
 class Node:
     def __init__(self, lineno: int):
@@ -288,4 +305,76 @@ class ReturnStatement(Statement):
         self.p_type = p_type
 
     def __repr__(self):
-        return f'ReturnStatement({self.expr})'
\ No newline at end of file
+        return f'ReturnStatement({self.expr})'
+
+class ArrayLiteral(Expression):
+    '''
+    Example: [1, 2, 3]
+    '''
+    def __init__(self, lineno: int, elements: list[Expression], p_type: str = None):
+        super().__init__(lineno)
+        self.elements = elements
+        self.p_type = p_type
+
+    def __repr__(self):
+        return f'ArrayLiteral({self.elements})'
+
+class Index(Expression):
+    '''
+    Example: a[i]
+    '''
+    def __init__(self, lineno: int, array: Expression, index: Expression, p_type: DType = None):
+        super().__init__(lineno)
+        self.array = array
+        self.index = index
+        self.p_type = p_type
+
+    def __repr__(self):
+        return f'Index({self.array}, {self.index})'
+
+class IndexAssignment(Statement):
+    '''
+    Example: a[i] = 2.0;
+    '''
+    def __init__(self, lineno: int, location: Location, index: Expression, value: Expression, p_type: DType = None):
+        super().__init__(lineno)
+        self.location = location
+        self.index = index
+        self.value = value
+        self.p_type = p_type
+
+    def __repr__(self):
+        return f'IndexAssignment({self.location}, {self.index}, {self.value})'
+
+class ArrayFunction(Expression):
+    '''
+    Example: len(a)
+             sum(a * b)
+    '''
+    def __init__(self, lineno: int, name: str, expr: Expression, p_type: DType = None):
+        super().__init__(lineno)
+        self.name = name
+        self.expr = expr
+        self.p_type = p_type
+
+    def __repr__(self):
+        return f'{self.name}({self.expr})'
+
+
+class Types:
+    '''
+    Side table of the types found by the checker, keyed by node identity,
+    so checking doesn't write them into the model. The transform adds the
+    nodes it makes. Backends read types only from here.
+    '''
+    def __init__(self):
+        self.table = {}
+
+    def __repr__(self):
+        return f'Types(size={len(self.table)})'
+
+    def get(self, node: Node) -> DType | None:
+        return self.table.get(node)
+
+    def set(self, node: Node, dtype: DType | None):
+        self.table[node] = dtype
@@ -0,0 +1,128 @@
+import ctypes
+import os
+import subprocess
+import tempfile
+
+from .model import *
+from .tokenize import tokenize
+from .parse import WabbitParser
+from .typecheck import check_model
+from .c import compile_library
+from .wbc import source_hash
+
+
+# ctypes type of every Wabbit type; bool travels as a C int and unit as a
+# NULL pointer
+_ctypes = {
+    'int': ctypes.c_int,
+    'float': ctypes.c_double,
+    'bool': ctypes.c_int,
+    'char': ctypes.c_char,
+    'unit': ctypes.c_void_p,
+}
+
+def _ctype(dtype: DType):
+    # arrays are passed as a pointer to their first element
+    if is_array(dtype):
+        return ctypes.POINTER(_ctypes[element_type(dtype)])
+    return _ctypes[dtype]
+
+
+class Library:
+    '''
+    Wabbit functions compiled to native code. Every FunctionDefinition is
+    an attribute taking and returning Python values: int, float, bool, a
+    one-character str for char and '()' for unit. Array arguments are
+    sequences of their size, such as lists or NumPy arrays.
+    '''
+    def __init__(self, path: str, model: list[Node]):
+        self.path = path
+        self.dll = ctypes.CDLL(path)
+        self.functions = {}
+
+        for n in model:
+            if isinstance(n, FunctionDefinition):
+                self.functions[n.name] = _wrap(getattr(self.dll, f'wabbit_{n.name}'), n)
+
+        # the top-level statements set the globals
+        self.dll.wabbit_init()
+
+    def __getattr__(self, name: str):
+        try:
+            return self.functions[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+def _wrap(function, node: FunctionDefinition):
+    function.argtypes = [ _ctype(p.dtype) for p in node.params ]
+    function.restype = _ctypes[node.ret]
+    dtypes = [ p.dtype for p in node.params ]
+
+    def call(*args):
+        if len(args) != len(dtypes):
+            raise TypeError(f'{node.name} takes {len(dtypes)} arguments, got {len(args)}')
+        values = [ _argument(value, dtype) for value, dtype in zip(args, dtypes) ]
+        return _result(function(*values), node.ret)
+
+    call.__name__ = node.name
+    return call
+
+def _argument(value, dtype: DType):
+    if is_array(dtype):
+        (element, size) = (element_type(dtype), array_size(dtype))
+        if len(value) != size:
+            raise TypeError(f'expected {size} elements, got {len(value)}')
+        return (_ctypes[element] * size)(*( _argument(v, element) for v in value ))
+
+    match dtype:
+        case 'char': return value.encode('latin-1') if isinstance(value, str) else value
+        case 'unit': return None
+        case 'bool': return int(bool(value))
+        case _: return value
+
+def _result(value, dtype: DType):
+    match dtype:
+        case 'char': return value.decode('latin-1')
+        case 'unit': return '()'
+        case 'bool': return bool(value)
+        case _: return value
+
+
+def load_library(source: str, cc: str = 'cc', directory: str | None = None) -> Library | None:
+    '''
+    Compile Wabbit source into a shared library with the C backend and
+    load it. The library is kept in directory, the temporary directory by
+    default, under the hash of the C code, so later loads skip the C
+    compiler. Returns None when the source doesn't type check.
+
+    Wabbit int is a C int here: unlike the interpreters, results that
+    don't fit in 32 bits wrap around.
+    '''
+    model = WabbitParser().parse( tokenize(source) )
+    (diagnostics, types) = check_model(model)
+    if diagnostics:
+        for d in diagnostics:
+            print(d)
+        return None
+
+    code = compile_library(model, types=types)
+
+    directory = directory or tempfile.gettempdir()
+    path = os.path.join(directory, f'wabbit-{source_hash(code).hex()[:16]}.so')
+    if not os.path.exists(path):
+        c_path = path[:-3] + f'.{os.getpid()}.c'
+        with open(c_path, 'w') as file:
+            file.write(code)
+
+        tmp = f'{path}.{os.getpid()}.tmp'
+        try:
+            subprocess.run([cc, '-O2', '-shared', '-fPIC', '-w', '-o', tmp, c_path],
+                           check=True, capture_output=True, text=True)
+        except subprocess.CalledProcessError as e:
+            raise RuntimeError(f'{cc} failed:\n{e.stderr}') from None
+        finally:
+            os.remove(c_path)
+        os.replace(tmp, path)
+
+    return Library(path, model)
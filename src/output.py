@@ -0,0 +1,70 @@
+import sys
+from abc import ABC, abstractmethod
+
+
+class Output(ABC):
+    '''
+    Destination of the text a program prints. Interpreters call write
+    once per print statement and flush when the program ends.
+    '''
+    @abstractmethod
+    def write(self, text: str):
+        ...
+
+    def flush(self):
+        pass
+
+
+class BufferedOutput(Output):
+    '''
+    Collects text and writes it to stream, sys.stdout by default, in
+    chunks of at least size characters
+    '''
+    def __init__(self, stream=None, size: int = 8192):
+        self.stream = stream if stream is not None else sys.stdout
+        self.size = size
+        self.parts = []
+        self.pending = 0
+
+    def write(self, text: str):
+        self.parts.append(text)
+        self.pending += len(text)
+        if self.pending >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.parts:
+            self.stream.write(''.join(self.parts))
+            self.parts = []
+            self.pending = 0
+        self.stream.flush()
+
+
+class CollectOutput(Output):
+    '''
+    Keeps everything in memory; getvalue returns it
+    '''
+    def __init__(self):
+        self.parts = []
+
+    def write(self, text: str):
+        self.parts.append(text)
+
+    def getvalue(self) -> str:
+        return ''.join(self.parts)
+
+
+class StreamOutput(BufferedOutput):
+    '''
+    Hands the text to consume in chunks of at least size characters. A
+    primed generator can consume it through its send method.
+    '''
+    def __init__(self, consume, size: int = 8192):
+        super().__init__(None, size)
+        self.consume = consume
+
+    def flush(self):
+        if self.parts:
+            self.consume(''.join(self.parts))
+            self.parts = []
+            self.pending = 0
@@ -12,9 +12,24 @@ class WabbitParser(Parser):
         ('left', LT, LE, GT, GE, EQ, NE),
         ('left', PLUS, MINUS),
         ('left', TIMES, DIVIDE),
-        ('left', UOP)
+        ('left', UOP),
+        ('left', LBRACKET)
     )
 
+    def parse(self, tokens, builtins: set[str] | None = None):
+        '''
+        Parse tokens into the list of top-level nodes. Calls of one
+        argument to len, sum, min and max are the array builtins, unless
+        builtins, the names the program doesn't define functions of, leaves
+        them out; by default the tokens are read first to find those.
+        '''
+        if builtins is None:
+            tokens = list(tokens)
+            builtins = array_builtins( name.value for (func, name) in zip(tokens, tokens[1:])
+                                       if func.type == 'FUNC' and name.type == 'NAME' )
+        self.builtins = builtins
+        return super().parse(iter(tokens))
+
     @_('{ statement }')
     def global_scope(self, p):
         return p.statement
@@ -77,6 +92,10 @@ class WabbitParser(Parser):
     def assignment_statement(self, p):
         return AssignmentStatement(p.lineno, p.location, p.expr)
 
+    @_('location LBRACKET expr RBRACKET ASSIGN expr SEMI')
+    def assignment_statement(self, p):
+        return IndexAssignment(p.lineno, p.location, p.expr0, p.expr1)
+
     @_('CONST location dtype ASSIGN expr SEMI',
        'CONST location ASSIGN expr SEMI',
        )
@@ -117,11 +136,10 @@ class WabbitParser(Parser):
        'NAME LPAREN RPAREN'
        )
     def function_call(self, p):
-        return FunctionCall(
-            p.lineno,
-            p.NAME,
-            p.functioncall_argument if hasattr(p, 'functioncall_argument') else []
-        )
+        args = p.functioncall_argument if hasattr(p, 'functioncall_argument') else []
+        if p.NAME in self.builtins and len(args) == 1:
+            return ArrayFunction(p.lineno, p.NAME, args[0])
+        return FunctionCall(p.lineno, p.NAME, args)
 
     @_('expr COMMA functioncall_argument',
        'expr',
@@ -158,15 +176,22 @@ class WabbitParser(Parser):
        'LNOT expr %prec UOP',
        'LPAREN expr RPAREN',
        'LBRACE compound_expression RBRACE',
+       'expr LBRACKET expr RBRACKET',
+       'LBRACKET functioncall_argument RBRACKET',
        'literal',
        'function_call',
-       'location',
+       # a[ at the start of a statement begins an index assignment
+       'location %prec UOP',
        )
     def expr(self, p):
         if hasattr(p, 'literal') or hasattr(p, 'location') or hasattr(p, 'function_call'):
             return p[0]
         elif hasattr(p, 'LPAREN') or hasattr(p, 'LBRACE'):
             return p[1]
+        elif hasattr(p, 'functioncall_argument'):
+            return ArrayLiteral(p.lineno, p.functioncall_argument)
+        elif hasattr(p, 'LBRACKET'):
+            return Index(p.lineno, p.expr0, p.expr1)
         elif len(p) == 3:
             return BinOp(p.lineno, p[1], p.expr0, p.expr1)
         else:
@@ -195,6 +220,18 @@ class WabbitParser(Parser):
     def location(self, p):
         return Location(p.lineno, p[0])
 
-    @_('NAME')
+    @_('NAME',
+       'LBRACKET INTEGER RBRACKET NAME',
+       )
     def dtype(self, p):
-        return p[0]
\ No newline at end of file
+        if hasattr(p, 'INTEGER'):
+            return array_type(int(p.INTEGER), p.NAME)
+        return p[0]
+
+
+def array_builtins(functions) -> set[str]:
+    '''
+    The names of ArrayFunctions that are builtins in a program, given the
+    names of the functions it defines
+    '''
+    return set(ArrayFunctions).difference(functions)
@@ -0,0 +1,166 @@
+import json
+from time import perf_counter_ns
+
+
+# Thresholds of the profile-guided decisions
+BIASED = 0.9
+
+
+class Profile:
+    '''
+    Execution profile of an interpreted program. Statements are keyed by
+    Node.lineno and functions by name; times are in nanoseconds. Pass one
+    to interpret_program to record it.
+    '''
+    def __init__(self):
+        # lineno -> [executions, time]
+        self.lines = {}
+        # name -> [calls, inclusive time, exclusive time]
+        self.functions = {}
+        # call stack as a tuple of names -> exclusive time
+        self.stacks = {}
+
+        # counts for profile-guided optimization, saved by save:
+        # lineno of an if -> [times true, times false]
+        self.branches = {}
+        # lineno of a while -> [entries, iterations]
+        self.loops = {}
+        # (lineno, name) of a call site -> calls
+        self.calls = {}
+
+        # activations of the running statements and functions; time is
+        # only accumulated by the outermost one, so recursion counts once
+        self._lines = {}
+        self._active = {}
+        self._calls = []
+
+    def begin(self, lineno: int) -> int:
+        self._lines[lineno] = self._lines.get(lineno, 0) + 1
+        return perf_counter_ns()
+
+    def end(self, lineno: int, start: int):
+        elapsed = perf_counter_ns() - start
+
+        line = self.lines.get(lineno)
+        if not line:
+            line = self.lines[lineno] = [0, 0]
+        line[0] += 1
+
+        self._lines[lineno] -= 1
+        if not self._lines[lineno]:
+            line[1] += elapsed
+
+    def enter(self, name: str):
+        self._active[name] = self._active.get(name, 0) + 1
+        stack = (self._calls[-1][0] if self._calls else ()) + (name, )
+        # [stack, start, time spent in callees]
+        self._calls.append( [stack, perf_counter_ns(), 0] )
+
+    def exit(self):
+        (stack, start, children) = self._calls.pop()
+        elapsed = perf_counter_ns() - start
+        name = stack[-1]
+
+        function = self.functions.get(name)
+        if not function:
+            function = self.functions[name] = [0, 0, 0]
+        function[0] += 1
+        function[2] += elapsed - children
+
+        self._active[name] -= 1
+        if not self._active[name]:
+            function[1] += elapsed
+
+        self.stacks[stack] = self.stacks.get(stack, 0) + elapsed - children
+        if self._calls:
+            self._calls[-1][2] += elapsed
+
+    def branch(self, lineno: int, taken: bool):
+        counts = self.branches.get(lineno)
+        if not counts:
+            counts = self.branches[lineno] = [0, 0]
+        counts[0 if taken else 1] += 1
+
+    def loop(self, lineno: int, iterations: int):
+        counts = self.loops.get(lineno)
+        if not counts:
+            counts = self.loops[lineno] = [0, 0]
+        counts[0] += 1
+        counts[1] += iterations
+
+    def call(self, lineno: int, name: str):
+        key = (lineno, name)
+        self.calls[key] = self.calls.get(key, 0) + 1
+
+    def likely(self, lineno: int) -> bool | None:
+        '''
+        Whether the if at lineno is almost always true (True), almost
+        always false (False) or neither or not seen (None)
+        '''
+        counts = self.branches.get(lineno)
+        if not counts:
+            return None
+        bias = counts[0] / (counts[0] + counts[1])
+        if bias >= BIASED: return True
+        if bias <= 1 - BIASED: return False
+        return None
+
+    def trips(self, lineno: int) -> float:
+        '''
+        Mean iterations of the while at lineno per entry
+        '''
+        counts = self.loops.get(lineno)
+        return counts[1] / counts[0] if counts else 0
+
+    def callsAt(self, lineno: int, name: str) -> int:
+        return self.calls.get((lineno, name), 0)
+
+    def save(self, path: str):
+        '''
+        Write the counts used by profile-guided optimization as JSON
+        '''
+        data = {
+            'branches': [ [lineno, *counts] for lineno, counts in self.branches.items() ],
+            'loops': [ [lineno, *counts] for lineno, counts in self.loops.items() ],
+            'calls': [ [lineno, name, count] for (lineno, name), count in self.calls.items() ],
+        }
+        with open(path, 'w') as file:
+            json.dump(data, file)
+
+    @classmethod
+    def load(cls, path: str) -> 'Profile':
+        with open(path) as file:
+            data = json.load(file)
+
+        profile = cls()
+        profile.branches = { lineno: [true, false] for lineno, true, false in data['branches'] }
+        profile.loops = { lineno: [entries, iterations] for lineno, entries, iterations in data['loops'] }
+        profile.calls = { (lineno, name): count for lineno, name, count in data['calls'] }
+        return profile
+
+    def report(self) -> str:
+        total = sum( f[2] for f in self.functions.values() ) or 1
+
+        lines = [ 'function               calls   inclusive ms   exclusive ms      %' ]
+        for name, (calls, inclusive, exclusive) in sorted(
+                self.functions.items(), key=lambda f: -f[1][2]):
+            lines.append(f'{name:20} {calls:>7} {inclusive / 1e6:>14.3f} '
+                         f'{exclusive / 1e6:>14.3f} {100 * exclusive / total:>6.1f}')
+
+        lines.append('')
+        lines.append('line          count        time ms')
+        for lineno, (count, elapsed) in sorted(
+                self.lines.items(), key=lambda l: -l[1][1]):
+            lines.append(f'{lineno:>4} {count:>14} {elapsed / 1e6:>14.3f}')
+
+        return '\n'.join(lines)
+
+    def collapsed(self) -> str:
+        '''
+        Exclusive time per call stack in microseconds, in the collapsed
+        format read by flamegraph.pl and speedscope
+        '''
+        return '\n'.join(
+            f"{';'.join(stack)} {elapsed // 1000}"
+            for stack, elapsed in sorted(self.stacks.items())
+        )
@@ -0,0 +1,195 @@
+from functools import singledispatch
+
+from .model import *
+from .resolve import GLOBAL
+
+
+class Context:
+    def __init__(self, consts: set[int]):
+        # global slots that can't change once defined
+        self.consts = consts
+        self.effects = False
+        self.calls = set()
+
+
+def pure_functions(model: list[Node]) -> set[FunctionDefinition]:
+    '''
+    Find the functions whose result depends only on their arguments: no
+    print, no writes or reads of global variables (constants are fine)
+    and calls only to other pure functions. Functions taking or returning
+    arrays don't count, since a cached array would be shared by callers.
+    The model must have been through resolve_program.
+    '''
+    consts = set()
+    variables = set()
+    functions = []
+    for n in model:
+        if isinstance(n, ConstDefinition):
+            consts.add(n.location.slot)
+        elif isinstance(n, VarDefinition):
+            variables.add(n.location.slot)
+        elif isinstance(n, FunctionDefinition):
+            functions.append(n)
+
+    calls = {}
+    pure = set()
+    for f in functions:
+        ctx = Context(consts - variables)
+        _effects(f.body, ctx)
+        calls[f] = ctx.calls
+        arrays = is_array(f.ret) or any( is_array(p.dtype) for p in f.params )
+        if not ctx.effects and not arrays:
+            pure.add(f)
+
+    # a function calling an impure one is impure too
+    changed = True
+    while changed:
+        changed = False
+        for f in list(pure):
+            if not calls[f] <= pure:
+                pure.discard(f)
+                changed = True
+
+    return pure
+
+
+@singledispatch
+def _effects(node: Node, ctx: Context):
+    raise RuntimeError(f"Can't analyze {node}")
+
+rule = _effects.register
+
+@rule(Integer)
+@rule(Float)
+@rule(Char)
+@rule(Bool)
+@rule(Unit)
+@rule(Break)
+@rule(Continue)
+@rule(FunctionDefinition)
+def _effects_none(node: Node, ctx: Context):
+    pass
+
+@rule(PrintStatement)
+def _effects_print(node: PrintStatement, ctx: Context):
+    ctx.effects = True
+
+@rule(UnOp)
+def _effects_unop(node: UnOp, ctx: Context):
+    _effects(node.expr, ctx)
+
+@rule(BinOp)
+def _effects_binop(node: BinOp, ctx: Context):
+    _effects(node.left, ctx)
+    _effects(node.right, ctx)
+
+@rule(Location)
+def _effects_location(node: Location, ctx: Context):
+    if node.frame == GLOBAL and node.slot not in ctx.consts:
+        ctx.effects = True
+
+@rule(VarDefinition)
+@rule(ConstDefinition)
+def _effects_definition(node: VarDefinition | ConstDefinition, ctx: Context):
+    if node.value:
+        _effects(node.value, ctx)
+
+@rule(AssignmentStatement)
+def _effects_assignment(node: AssignmentStatement, ctx: Context):
+    if node.location.frame == GLOBAL:
+        ctx.effects = True
+    _effects(node.value, ctx)
+
+@rule(IndexAssignment)
+def _effects_indexassignment(node: IndexAssignment, ctx: Context):
+    if node.location.frame == GLOBAL:
+        ctx.effects = True
+    _effects(node.index, ctx)
+    _effects(node.value, ctx)
+
+@rule(ArrayLiteral)
+def _effects_arrayliteral(node: ArrayLiteral, ctx: Context):
+    for e in node.elements:
+        _effects(e, ctx)
+
+@rule(Index)
+def _effects_index(node: Index, ctx: Context):
+    _effects(node.array, ctx)
+    _effects(node.index, ctx)
+
+@rule(ArrayFunction)
+def _effects_arrayfunction(node: ArrayFunction, ctx: Context):
+    _effects(node.expr, ctx)
+
+@rule(BlockStatement)
+@rule(CompoundExpression)
+def _effects_block(node: BlockStatement | CompoundExpression, ctx: Context):
+    for inst in node.instructions:
+        _effects(inst, ctx)
+
+@rule(IfStatement)
+def _effects_ifstatement(node: IfStatement, ctx: Context):
+    _effects(node.cmp, ctx)
+    _effects_block(node.block_if, ctx)
+    if node.block_else:
+        _effects_block(node.block_else, ctx)
+
+@rule(WhileStatement)
+def _effects_whilestatement(node: WhileStatement, ctx: Context):
+    _effects(node.cmp, ctx)
+    _effects_block(node.body, ctx)
+
+@rule(FunctionCall)
+def _effects_functioncall(node: FunctionCall, ctx: Context):
+    ctx.calls.add(node.function)
+    for a in node.args:
+        _effects(a, ctx)
+
+@rule(ReturnStatement)
+def _effects_returnstatement(node: ReturnStatement, ctx: Context):
+    if node.expr is not None:
+        _effects(node.expr, ctx)
+
+
+# a loop counts as this many runs of its body, and calls are followed
+# this many levels deep, so that loops and recursion cost finitely
+LOOP_ITERATIONS = 10
+CALL_DEPTH = 3
+
+def function_costs(model: list[Node]) -> dict[FunctionDefinition, float]:
+    '''
+    Static estimate of the work of a call: the number of nodes it runs,
+    counting LOOP_ITERATIONS runs of every loop and the cost of the
+    functions it calls, followed CALL_DEPTH levels deep. A recursive
+    function thus costs more the more calls it makes of itself, while a
+    call chain ending in trivial work stays cheap.
+    '''
+    memo = {}
+    costs = {}
+    for n in model:
+        if isinstance(n, FunctionDefinition):
+            costs[n] = _function_cost(n, CALL_DEPTH, memo)
+    return costs
+
+def _function_cost(function: FunctionDefinition, depth: int, memo: dict) -> float:
+    key = (function, depth)
+    if key not in memo:
+        memo[key] = _cost(function.body, depth, memo)
+    return memo[key]
+
+def _cost(node: Node, depth: int, memo: dict) -> float:
+    size = 1
+    for value in vars(node).values():
+        # the callee the resolver gives calls is counted below
+        if isinstance(value, FunctionDefinition):
+            continue
+        if isinstance(value, Node):
+            size += _cost(value, depth, memo)
+        elif isinstance(value, list):
+            size += sum( _cost(v, depth, memo) for v in value if isinstance(v, Node) )
+
+    if isinstance(node, WhileStatement):
+        size *= LOOP_ITERATIONS
+    elif isinstance(node, FunctionCall) and node.function is not None and depth > 0:
+        size += _function_cost(node.function, depth - 1, memo)
+    return size
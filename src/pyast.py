@@ -0,0 +1,336 @@
+import ast
+from functools import singledispatch
+
+from .model import *
+from .resolve import GLOBAL, resolve_program
+from .interp import printValue
+from .tier import divide_int, divide_float, divide
+
+
+# Python backend: the checked model becomes an ast.Module that CPython
+# compiles and runs. Wabbit functions become Python functions named
+# w_<name>, local slots Python locals v<slot> and global slots module
+# globals g<slot>.
+
+class Context:
+    def __init__(self, types: Types):
+        self.types = types
+        # global slots assigned by the function being lowered
+        self.writes = set()
+        # statements hoisted out of the expressions of the statement being
+        # lowered, to run before it, and the temporaries they use
+        self.before = []
+        self.temporaries = 0
+
+    def flush(self) -> list[ast.stmt]:
+        (before, self.before) = (self.before, [])
+        return before
+
+    def spill(self, value: ast.expr, at: int) -> ast.expr:
+        '''
+        Evaluate value into a temporary by a statement hoisted at position
+        at, so statements hoisted after it don't run before it
+        '''
+        if isinstance(value, ast.Constant):
+            return value
+        name = f't{self.temporaries}'
+        self.temporaries += 1
+        self.before.insert(at, ast.Assign([ast.Name(name, ast.Store())], value))
+        return ast.Name(name, ast.Load())
+
+def _at(stmt: ast.stmt, node: Node) -> ast.stmt:
+    stmt.lineno = stmt.end_lineno = node.lineno or 1
+    stmt.col_offset = stmt.end_col_offset = 0
+    return stmt
+
+def _name(node: Location, ctx: Context, store: bool = False) -> ast.Name:
+    if node.frame == GLOBAL:
+        name = f'g{node.slot}'
+        if store:
+            ctx.writes.add(name)
+    else:
+        name = f'v{node.slot}'
+    return ast.Name(name, ast.Store() if store else ast.Load())
+
+def _call(name: str, *args: ast.expr) -> ast.Call:
+    return ast.Call(ast.Name(name, ast.Load()), list(args), [])
+
+
+def generate_module(model: list[Node], types: Types | None = None) -> ast.Module:
+    '''
+    Lower a checked model, of the given types, into a Python module.
+    Running the module runs the top-level statements and then main,
+    leaving its value in _result.
+    '''
+    resolve_program(model)
+    types = types or Types()
+
+    functions = []
+    statements = []
+    ctx = Context(types)
+    for n in model:
+        if isinstance(n, FunctionDefinition):
+            functions.append( _function(n, types) )
+        else:
+            statements += _statement(n, ctx)
+
+    # the resolver lets statements call functions defined after them
+    body = functions + statements
+    if any( isinstance(n, FunctionDefinition) and n.name == 'main' for n in model ):
+        body.append( ast.Assign([ast.Name('_result', ast.Store())], _call('w_main')) )
+
+    module = ast.Module(body or [ast.Pass()], [])
+    return ast.fix_missing_locations(module)
+
+def compile_program(model: list[Node], types: Types | None = None):
+    return compile(generate_module(model, types), '<wabbit>', 'exec')
+
+def run_program(model: list[Node], types: Types | None = None):
+    namespace = {
+        '_print': printValue,
+        '_idiv': divide_int,
+        '_fdiv': divide_float,
+        '_div': divide,
+        '_result': None,
+    }
+    exec(compile_program(model, types), namespace)
+    return namespace['_result']
+
+
+def _function(node: FunctionDefinition, types: Types) -> ast.FunctionDef:
+    ctx = Context(types)
+    nparams = len(node.params)
+
+    args = ast.arguments([], [ ast.arg(f'v{p.slot}') for p in node.params ], None, [], [], None, [])
+    body = [ ast.Assign([ast.Name(f'v{slot}', ast.Store())], ast.Constant(None))
+             for slot in range(nparams, node.frame_size) ]
+    body += _block(node.body, ctx)
+    body.append( ast.Return(ast.Constant('()')) )
+
+    if ctx.writes:
+        body.insert(0, ast.Global(sorted(ctx.writes)))
+
+    function = ast.FunctionDef(f'w_{node.name}', args, body, [], None)
+    return _at(function, node)
+
+def _block(node: BlockStatement, ctx: Context) -> list[ast.stmt]:
+    body = []
+    for inst in node.instructions:
+        body += _statement(inst, ctx)
+    return body or [ast.Pass()]
+
+
+@singledispatch
+def _statement(node: Node, ctx: Context) -> list[ast.stmt]:
+    raise RuntimeError(f"Can't compile {node}")
+
+rule = _statement.register
+
+@rule(Integer)
+@rule(Float)
+@rule(Char)
+@rule(Bool)
+@rule(Unit)
+@rule(Location)
+@rule(UnOp)
+@rule(BinOp)
+@rule(CompoundExpression)
+@rule(FunctionCall)
+def _statement_expression(node: Expression, ctx: Context) -> list[ast.stmt]:
+    value = _expression(node, ctx)
+    return ctx.flush() + [ _at(ast.Expr(value), node) ]
+
+@rule(Break)
+def _statement_break(node: Break, ctx: Context) -> list[ast.stmt]:
+    return [ _at(ast.Break(), node) ]
+
+@rule(Continue)
+def _statement_continue(node: Continue, ctx: Context) -> list[ast.stmt]:
+    return [ _at(ast.Continue(), node) ]
+
+@rule(PrintStatement)
+def _statement_print(node: PrintStatement, ctx: Context) -> list[ast.stmt]:
+    value = _call('_print', _expression(node.expr, ctx), ast.Constant(ctx.types.get(node)))
+    return ctx.flush() + [ _at(ast.Expr(value), node) ]
+
+@rule(VarDefinition)
+@rule(ConstDefinition)
+def _statement_definition(node: VarDefinition | ConstDefinition, ctx: Context) -> list[ast.stmt]:
+    if node.value:
+        value = _expression(node.value, ctx)
+    elif is_array(node.dtype):
+        raise RuntimeError(f"{node.lineno}: Can't compile arrays, use interpret_program")
+    else:
+        value = ast.Constant('()' if node.dtype == 'unit' else None)
+    return ctx.flush() + [ _at(ast.Assign([_name(node.location, ctx, True)], value), node) ]
+
+@rule(AssignmentStatement)
+def _statement_assignment(node: AssignmentStatement, ctx: Context) -> list[ast.stmt]:
+    value = _expression(node.value, ctx)
+    return ctx.flush() + [ _at(ast.Assign([_name(node.location, ctx, True)], value), node) ]
+
+@rule(BlockStatement)
+def _statement_block(node: BlockStatement, ctx: Context) -> list[ast.stmt]:
+    return _block(node, ctx)
+
+@rule(IfStatement)
+def _statement_if(node: IfStatement, ctx: Context) -> list[ast.stmt]:
+    cmp = _expression(node.cmp, ctx)
+    before = ctx.flush()
+    orelse = _block(node.block_else, ctx) if node.block_else else []
+    stmt = ast.If(cmp, _block(node.block_if, ctx), orelse)
+    return before + [ _at(stmt, node) ]
+
+@rule(WhileStatement)
+def _statement_while(node: WhileStatement, ctx: Context) -> list[ast.stmt]:
+    mark = len(ctx.before)
+    cmp = _expression(node.cmp, ctx)
+    hoisted = ctx.before[mark:]
+    del ctx.before[mark:]
+    before = ctx.flush()
+    if not hoisted:
+        stmt = ast.While(cmp, _block(node.body, ctx), [])
+        return before + [ _at(stmt, node) ]
+
+    # the statements hoisted out of the condition run on every check of it
+    test = ast.If(ast.UnaryOp(ast.Not(), cmp), [ast.Break()], [])
+    stmt = ast.While(ast.Constant(True), hoisted + [test] + _block(node.body, ctx), [])
+    return before + [ _at(stmt, node) ]
+
+@rule(ReturnStatement)
+def _statement_return(node: ReturnStatement, ctx: Context) -> list[ast.stmt]:
+    value = _expression(node.expr, ctx) if node.expr is not None else ast.Constant('()')
+    return ctx.flush() + [ _at(ast.Return(value), node) ]
+
+
+_operators = {
+    '+': ast.Add, '-': ast.Sub, '*': ast.Mult,
+    '<': ast.Lt, '>': ast.Gt, '<=': ast.LtE, '>=': ast.GtE, '==': ast.Eq, '!=': ast.NotEq,
+}
+
+@singledispatch
+def _expression(node: Node, ctx: Context) -> ast.expr:
+    raise RuntimeError(f"Can't compile {node}")
+
+expression_rule = _expression.register
+
+@expression_rule(Integer)
+@expression_rule(Float)
+@expression_rule(Char)
+@expression_rule(Bool)
+@expression_rule(Unit)
+def _expression_literal(node: LiteralT, ctx: Context) -> ast.expr:
+    return ast.Constant(node.value)
+
+@expression_rule(Location)
+def _expression_location(node: Location, ctx: Context) -> ast.expr:
+    return _name(node, ctx)
+
+@expression_rule(UnOp)
+def _expression_unop(node: UnOp, ctx: Context) -> ast.expr:
+    expr = _expression(node.expr, ctx)
+
+    match node.op:
+        case '-': return ast.UnaryOp(ast.USub(), expr)
+        case '!': return ast.UnaryOp(ast.Not(), expr)
+        case _: return expr
+
+@expression_rule(BinOp)
+def _expression_binop(node: BinOp, ctx: Context) -> ast.expr:
+    left = _expression(node.left, ctx)
+    mark = len(ctx.before)
+    right = _expression(node.right, ctx)
+
+    if len(ctx.before) > mark:
+        if node.op in ('&&', '||'):
+            return _shortcircuit(node.op, left, right, mark, ctx)
+        left = ctx.spill(left, mark)
+    p_type = ctx.types.get(node)
+
+    match node.op:
+        case '&&': return ast.BoolOp(ast.And(), [left, right])
+        case '||': return ast.BoolOp(ast.Or(), [left, right])
+        case '/' if p_type == 'int': return _call('_idiv', left, right)
+        case '/' if p_type == 'float': return _call('_fdiv', left, right)
+        case '/': return _call('_div', left, right)
+        case '+' | '-' | '*': return ast.BinOp(left, _operators[node.op](), right)
+        case op: return ast.Compare(left, [_operators[op]()], [right])
+
+def _shortcircuit(op: str, left: ast.expr, right: ast.expr, mark: int, ctx: Context) -> ast.expr:
+    # the statements hoisted out of the right operand only run when it is
+    # evaluated: t = left; if t (or not t): ...; t = right
+    hoisted = ctx.before[mark:]
+    del ctx.before[mark:]
+    name = f't{ctx.temporaries}'
+    ctx.temporaries += 1
+    ctx.before.append( ast.Assign([ast.Name(name, ast.Store())], left) )
+    test = ast.Name(name, ast.Load())
+    if op == '||':
+        test = ast.UnaryOp(ast.Not(), test)
+    ctx.before.append( ast.If(test, hoisted + [ast.Assign([ast.Name(name, ast.Store())], right)], []) )
+    return ast.Name(name, ast.Load())
+
+@expression_rule(CompoundExpression)
+def _expression_compoundexpression(node: CompoundExpression, ctx: Context) -> ast.expr:
+    if not _has_statements(node):
+        # { a; b; c } evaluates as the last item of the tuple (a, b, c)
+        items = [ _inline(inst, ctx) for inst in node.instructions ]
+        return ast.Subscript(ast.Tuple(items, ast.Load()), ast.Constant(-1), ast.Load())
+
+    # control flow can't be an expression, so the instructions are hoisted
+    # before the statement, as the tier does, and the last one gives the
+    # value
+    for inst in node.instructions[:-1]:
+        _hoist(inst, ctx)
+    last = node.instructions[-1]
+    if isinstance(last, Expression):
+        return _expression(last, ctx)
+    _hoist(last, ctx)
+    return ast.Constant(None)
+
+def _hoist(node: Node, ctx: Context):
+    # lowering node flushes what was hoisted before it into its statements
+    statements = _statement(node, ctx)
+    ctx.before.extend(statements)
+
+def _inline(node: Node, ctx: Context) -> ast.expr:
+    if isinstance(node, Expression):
+        return _expression(node, ctx)
+    if isinstance(node, PrintStatement):
+        return _call('_print', _expression(node.expr, ctx), ast.Constant(ctx.types.get(node)))
+    (stmt, ) = _statement(node, ctx)
+    return ast.NamedExpr(stmt.targets[0], stmt.value)
+
+def _has_statements(node: Node) -> bool:
+    '''
+    Whether node holds a compound expression with instructions other than
+    expressions, prints, definitions and assignments
+    '''
+    if isinstance(node, CompoundExpression) and not all(
+            isinstance(inst, Expression | PrintStatement | VarDefinition | ConstDefinition | AssignmentStatement)
+            for inst in node.instructions ):
+        return True
+    for value in vars(node).values():
+        # the callee the resolver gives calls isn't part of the expression
+        if isinstance(value, FunctionDefinition):
+            continue
+        if isinstance(value, Node) and _has_statements(value):
+            return True
+        if isinstance(value, list) and any( isinstance(v, Node) and _has_statements(v) for v in value ):
+            return True
+    return False
+
+@expression_rule(FunctionCall)
+def _expression_functioncall(node: FunctionCall, ctx: Context) -> ast.expr:
+    args = []
+    for a in node.args:
+        mark = len(ctx.before)
+        value = _expression(a, ctx)
+        if len(ctx.before) > mark:
+            # the arguments before it are evaluated first, in order
+            for (i, arg) in enumerate(args):
+                size = len(ctx.before)
+                args[i] = ctx.spill(arg, mark)
+                mark += len(ctx.before) - size
+        args.append(value)
+    return _call(f'w_{node.name}', *args)
@@ -0,0 +1,229 @@
+from functools import singledispatch
+
+from .model import *
+
+
+# Frames a Location can be addressed in
+GLOBAL = 0
+LOCAL = 1
+
+
+class Env:
+    def __init__(self, strict: bool = True):
+        self.stack = [{}]
+        self.marks = []
+        self.frame = GLOBAL
+        self.next = 0
+        self.size = 0
+        self.functions = {}
+        self.strict = strict
+        self.bindings = 0
+        # bindings whose definition was already reached, in program order
+        self.defined = set()
+
+    def newScope(self):
+        self.stack.append({})
+        self.marks.append(self.next)
+
+    def popScope(self):
+        self.stack.pop()
+        # slots of a finished block are reused by its siblings
+        self.next = self.marks.pop()
+
+    def newFrame(self):
+        saved = (self.stack, self.marks, self.frame, self.next, self.size)
+        self.stack = [self.stack[0], {}]
+        self.marks = []
+        self.frame = LOCAL
+        self.next = 0
+        self.size = 0
+        return saved
+
+    def popFrame(self, saved):
+        size = self.size
+        (self.stack, self.marks, self.frame, self.next, self.size) = saved
+        return size
+
+    def createRegister(self, name: str) -> tuple[int, int, int]:
+        address = (self.frame, self.next, self.bindings)
+        self.next += 1
+        self.bindings += 1
+        self.size = max(self.size, self.next)
+        self.stack[-1][name] = address
+        return address
+
+    def getRegister(self, name: str) -> tuple[int, int, int] | None:
+        for scope in reversed(self.stack):
+            if name in scope:
+                return scope[name]
+        return None
+
+    def setFunction(self, node: FunctionDefinition):
+        self.functions[node.name] = node
+
+    def getFunction(self, name: str) -> FunctionDefinition | None:
+        return self.functions.get(name)
+
+
+def resolve_program(model: list[Node], strict: bool = True) -> int:
+    '''
+    Give every Location a fixed (frame, slot) address, where frame is
+    GLOBAL or LOCAL and slot indexes a flat list, and the binding it
+    refers to: an int unique in the program for each definition and
+    parameter, so later passes can key their tables on it whatever the
+    scope. FunctionParams get slot and binding too, and definitions
+    redefines, True when the name was already defined where they are.
+
+    Each FunctionDefinition receives the size of its frame in frame_size
+    and each FunctionCall the FunctionDefinition it calls in function; the
+    size of the global frame is returned. Unless strict, unknown names
+    are left with a binding of None for the type checker to report.
+    '''
+    env = Env(strict)
+
+    # globals and functions are visible to every function body, wherever
+    # they are defined
+    for n in model:
+        if isinstance(n, VarDefinition | ConstDefinition):
+            if not env.getRegister(n.location.name):
+                env.createRegister(n.location.name)
+        elif isinstance(n, FunctionDefinition):
+            env.setFunction(n)
+
+    for n in model:
+        _resolve(n, env)
+
+    return env.size
+
+
+def _address(node: Location, address: tuple[int, int, int] | None):
+    (node.frame, node.slot, node.binding) = address or (None, None, None)
+
+
+@singledispatch
+def _resolve(node: Node, env: Env):
+    raise RuntimeError(f"Can't resolve {node}")
+
+rule = _resolve.register
+
+@rule(Integer)
+@rule(Float)
+@rule(Char)
+@rule(Bool)
+@rule(Unit)
+@rule(Break)
+@rule(Continue)
+def _resolve_leaf(node: Node, env: Env):
+    pass
+
+@rule(PrintStatement)
+def _resolve_print(node: PrintStatement, env: Env):
+    _resolve(node.expr, env)
+
+@rule(UnOp)
+def _resolve_unop(node: UnOp, env: Env):
+    _resolve(node.expr, env)
+
+@rule(BinOp)
+def _resolve_binop(node: BinOp, env: Env):
+    _resolve(node.left, env)
+    _resolve(node.right, env)
+
+@rule(Location)
+def _resolve_location(node: Location, env: Env):
+    address = env.getRegister(node.name)
+    if not address and env.strict:
+        raise RuntimeError(f"{node.lineno}: {node.name} not defined!")
+    _address(node, address)
+
+@rule(VarDefinition)
+@rule(ConstDefinition)
+def _resolve_definition(node: VarDefinition | ConstDefinition, env: Env):
+    if node.value:
+        _resolve(node.value, env)
+
+    name = node.location.name
+    visible = env.getRegister(name)
+    node.redefines = visible is not None and visible[2] in env.defined
+
+    if env.frame == GLOBAL and len(env.stack) == 1:
+        address = visible
+    else:
+        address = env.createRegister(name)
+    _address(node.location, address)
+    env.defined.add(address[2])
+
+@rule(AssignmentStatement)
+def _resolve_assignment(node: AssignmentStatement, env: Env):
+    _resolve(node.value, env)
+    _resolve_location(node.location, env)
+
+@rule(BlockStatement)
+@rule(CompoundExpression)
+def _resolve_block(node: BlockStatement | CompoundExpression, env: Env):
+    env.newScope()
+    for inst in node.instructions:
+        _resolve(inst, env)
+    env.popScope()
+
+@rule(IfStatement)
+def _resolve_ifstatement(node: IfStatement, env: Env):
+    _resolve(node.cmp, env)
+    _resolve_block(node.block_if, env)
+    if node.block_else:
+        _resolve_block(node.block_else, env)
+
+@rule(WhileStatement)
+def _resolve_whilestatement(node: WhileStatement, env: Env):
+    _resolve(node.cmp, env)
+    _resolve_block(node.body, env)
+
+@rule(FunctionDefinition)
+def _resolve_functiondefinition(node: FunctionDefinition, env: Env):
+    env.setFunction(node)
+    saved = env.newFrame()
+
+    # parameters take the first slots of the frame
+    for p in node.params:
+        (_, p.slot, p.binding) = env.createRegister(p.name)
+        env.defined.add(p.binding)
+
+    _resolve_block(node.body, env)
+    node.frame_size = env.popFrame(saved)
+
+    # a call frame is the arguments followed by these unset locals
+    node.locals = [None] * (node.frame_size - len(node.params))
+
+@rule(FunctionCall)
+def _resolve_functioncall(node: FunctionCall, env: Env):
+    node.function = env.getFunction(node.name)
+    if not node.function and env.strict:
+        raise RuntimeError(f"{node.lineno}: {node.name} not defined!")
+
+    for a in node.args:
+        _resolve(a, env)
+
+@rule(ReturnStatement)
+def _resolve_returnstatement(node: ReturnStatement, env: Env):
+    if node.expr is not None:
+        _resolve(node.expr, env)
+
+@rule(ArrayLiteral)
+def _resolve_arrayliteral(node: ArrayLiteral, env: Env):
+    for e in node.elements:
+        _resolve(e, env)
+
+@rule(Index)
+def _resolve_index(node: Index, env: Env):
+    _resolve(node.array, env)
+    _resolve(node.index, env)
+
+@rule(IndexAssignment)
+def _resolve_indexassignment(node: IndexAssignment, env: Env):
+    _resolve(node.index, env)
+    _resolve(node.value, env)
+    _resolve_location(node.location, env)
+
+@rule(ArrayFunction)
+def _resolve_arrayfunction(node: ArrayFunction, env: Env):
+    _resolve(node.expr, env)
@@ -0,0 +1,206 @@
+import argparse
+import re
+import sys
+from array import array
+from time import perf_counter
+
+from sly.lex import Token
+
+from .tokenize import WabbitLexer, tokenize
+
+
+# A lexer for large sources. Where WabbitLexer makes a Token per lexeme,
+# scan matches one master pattern and keeps the tokens as parallel arrays
+# of kind codes, offsets and line numbers; their text is only sliced from
+# the source when asked for. It finds the same tokens as WabbitLexer.
+
+# kind code -> token type, the index of the type in KINDS
+KINDS = tuple(sorted(WabbitLexer.tokens))
+CODES = { kind: code for (code, kind) in enumerate(KINDS) }
+
+# keywords and operators -> their code, where any other word is a NAME
+_WORDS = {
+    'const': CODES['CONST'], 'var': CODES['VAR'], 'print': CODES['PRINT'],
+    'break': CODES['BREAK'], 'continue': CODES['CONTINUE'], 'if': CODES['IF'],
+    'else': CODES['ELSE'], 'while': CODES['WHILE'], 'true': CODES['TRUE'],
+    'false': CODES['FALSE'], 'func': CODES['FUNC'], 'return': CODES['RETURN'],
+
+    '+': CODES['PLUS'], '-': CODES['MINUS'], '*': CODES['TIMES'],
+    '<=': CODES['LE'], '<': CODES['LT'], '>=': CODES['GE'], '>': CODES['GT'],
+    '==': CODES['EQ'], '!=': CODES['NE'], '&&': CODES['LAND'], '||': CODES['LOR'],
+    '!': CODES['LNOT'], '=': CODES['ASSIGN'], ',': CODES['COMMA'], ';': CODES['SEMI'],
+    '(': CODES['LPAREN'], ')': CODES['RPAREN'], '{': CODES['LBRACE'], '}': CODES['RBRACE'],
+    '[': CODES['LBRACKET'], ']': CODES['RBRACKET'],
+}
+
+# One group per rule, the most common first. Only the comments and DIVIDE
+# can match at the same place, and they come in the order WabbitLexer
+# tries them, so the order of the others doesn't change what matches.
+# The blanks before a token are skipped by the same match.
+_MASTER = re.compile(
+    r'[ \t]*(?:'
+    r'([a-zA-Z_][a-zA-Z0-9_]*|<=|>=|==|!=|&&|\|\||[-+*<>!=,;(){}\[\]])'     # 1 words and operators
+    r'|(\n+)'                                                               # 2 newlines
+    r'|([0-9]+\.[0-9]+)'                                                    # 3 FLOAT
+    r'|([0-9]+)'                                                            # 4 INTEGER
+    r'|(//.*)'                                                              # 5 comment
+    r'|(/\*[\s\S]*?\*/)'                                                    # 6 comment block
+    r'|(/\*[\s\S]*)'                                                        # 7 unterminated comment, to the end
+    r'|(/)'                                                                 # 8 DIVIDE
+    r"|('(?:.|\\x[0-9a-fA-F]{2}|\\[abfnrtv])')"                             # 9 CHAR
+    r"|('(?:.|\\x[0-9a-fA-F]{2}|\\[abfnrtv]))"                              # 10 unterminated CHAR
+    r'|([^ \t\n])'                                                          # 11 illegal character
+    r')'
+)
+
+(_WORD, _NEWLINE, _FLOAT, _INTEGER, _COMMENT, _COMMENTBLOCK, _UNCOMMENTBLOCK,
+ _DIVIDE, _CHAR, _UNCHAR, _ILLEGAL) = range(1, 12)
+
+# messages of the groups that are errors, as WabbitLexer prints them
+_ERRORS = {
+    _UNCOMMENTBLOCK: 'Unterminated comment',
+    _UNCHAR: 'Unterminated character constant',
+    _ILLEGAL: "Illegal character '{}'",
+}
+
+
+class Tokens:
+    '''
+    Tokens of text as parallel arrays: the kind code, the start and end
+    offsets in text and the line number of each one. Iterating gives sly
+    Tokens, made one at a time, so a Tokens can be parsed as is; errors
+    holds the (lineno, message) of what couldn't be lexed.
+    '''
+    def __init__(self, text: str):
+        self.text = text
+        self.kinds = array('B')
+        self.starts = array('I')
+        self.ends = array('I')
+        self.linenos = array('I')
+        self.errors: list[tuple[int, str]] = []
+
+    def __repr__(self):
+        return f'Tokens(size={len(self.kinds)}, errors={len(self.errors)})'
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def kind(self, i: int) -> str:
+        return KINDS[self.kinds[i]]
+
+    def value(self, i: int) -> str:
+        return self.text[self.starts[i]:self.ends[i]]
+
+    def __iter__(self):
+        return self.tokens()
+
+    def tokens(self, first: int = 0, last: int | None = None):
+        '''
+        sly Tokens of the tokens first to last, excluded, made as they are
+        asked for
+        '''
+        text = self.text
+        span = slice(first, last)
+        for (kind, start, end, lineno) in zip(self.kinds[span], self.starts[span],
+                                              self.ends[span], self.linenos[span]):
+            tok = Token()
+            tok.type = KINDS[kind]
+            tok.value = text[start:end]
+            tok.lineno = lineno
+            tok.index = start
+            tok.end = end
+            yield tok
+
+    def functions(self):
+        '''
+        The names after each FUNC, those of the functions defined
+        '''
+        kinds = self.kinds.tobytes()
+        (func, name) = (bytes([CODES['FUNC']]), CODES['NAME'])
+        i = kinds.find(func)
+        while i != -1:
+            if i + 1 < len(kinds) and kinds[i + 1] == name:
+                yield self.value(i + 1)
+            i = kinds.find(func, i + 1)
+
+
+def scan(text: str) -> Tokens:
+    '''
+    Lex text into a Tokens, collecting the errors instead of printing them
+    '''
+    tokens = Tokens(text)
+    (kinds, starts, ends, linenos) = (tokens.kinds.append, tokens.starts.append,
+                                      tokens.ends.append, tokens.linenos.append)
+    words = _WORDS.get
+    (name, float_, integer, divide, char) = (CODES['NAME'], CODES['FLOAT'], CODES['INTEGER'],
+                                            CODES['DIVIDE'], CODES['CHAR'])
+    lineno = 1
+
+    for m in _MASTER.finditer(text):
+        group = m.lastindex
+        if group == _WORD:
+            (start, end) = m.span(group)
+            kinds(words(text[start:end], name))
+        elif group == _NEWLINE:
+            (start, end) = m.span(group)
+            lineno += end - start
+            continue
+        elif group == _FLOAT:
+            (start, end) = m.span(group)
+            kinds(float_)
+        elif group == _INTEGER:
+            (start, end) = m.span(group)
+            kinds(integer)
+        elif group == _DIVIDE:
+            (start, end) = m.span(group)
+            kinds(divide)
+        elif group == _CHAR:
+            (start, end) = m.span(group)
+            kinds(char)
+        elif group == _COMMENT:
+            continue
+        elif group == _COMMENTBLOCK:
+            lineno += m[group].count('\n')
+            continue
+        else:
+            tokens.errors.append( (lineno, _ERRORS[group].format(m[group])) )
+            continue
+
+        starts(start)
+        ends(end)
+        linenos(lineno)
+
+    return tokens
+
+
+def _rate(lex, text: str, repeat: int) -> tuple[int, float]:
+    # best of repeat runs, in tokens per second
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        count = lex(text)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return count, count / best if best else float('inf')
+
+def main(argv: list[str] | None = None) -> int:
+    args = argparse.ArgumentParser(prog='python -m src.scan',
+                                   description='Compare the lexing speed of scan and sly')
+    args.add_argument('paths', nargs='+', help='.wb files')
+    args.add_argument('-r', '--repeat', type=int, default=3, help='runs of each lexer, the best counts')
+    args = args.parse_args(argv)
+
+    for path in args.paths:
+        with open(path, encoding='utf-8') as file:
+            text = file.read()
+
+        (count, sly_rate) = _rate(lambda text: sum( 1 for _ in tokenize(text) ), text, args.repeat)
+        (_, scan_rate) = _rate(lambda text: len(scan(text)), text, args.repeat)
+        print(f'{path}: {count} tokens, sly {sly_rate:,.0f}/s, scan {scan_rate:,.0f}/s, '
+              f'{scan_rate / sly_rate:.1f}x')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,41 @@
+import asyncio
+from time import monotonic
+
+from .vm import Program, VM
+from .output import Output
+
+
+class BudgetExceeded(RuntimeError):
+    pass
+
+
+async def run_async(program: Program, slice: int = 10000,
+                    max_steps: int | None = None,
+                    timeout: float | None = None,
+                    out: Output | None = None):
+    '''
+    Run a program on the VM as an asyncio task, yielding to the event loop
+    every slice instructions so many programs can share one thread.
+    Raises BudgetExceeded once max_steps instructions or timeout seconds
+    are spent; cancelling the task stops the program at its next slice.
+    Either way out is flushed first.
+
+    Each program prints to its own out, a BufferedOutput on sys.stdout by
+    default; pass a CollectOutput to capture it. Programs come from
+    vm.compile_program, which rejects those using arrays.
+    '''
+    vm = VM(program, out)
+    deadline = None if timeout is None else monotonic() + timeout
+
+    try:
+        while not vm.resume(slice):
+            if max_steps is not None and vm.steps >= max_steps:
+                raise BudgetExceeded(f"Program exceeded {max_steps} steps")
+            if deadline is not None and monotonic() >= deadline:
+                raise BudgetExceeded(f"Program exceeded {timeout} seconds")
+            await asyncio.sleep(0)
+    finally:
+        # keep what was printed before the budget ran out or a cancel
+        vm.out.flush()
+
+    return vm.result
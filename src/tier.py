@@ -0,0 +1,362 @@
+from functools import singledispatch
+
+from .model import *
+from . import arrays
+from .resolve import GLOBAL
+
+
+# Second execution tier of the tree walker: functions called HOT_CALLS
+# times and loops running HOT_ITERATIONS times in a row are translated to
+# Python source and compiled once. Local slots become Python locals named
+# v<slot> and the global frame is the list G.
+
+HOT_CALLS = 100
+HOT_ITERATIONS = 1000
+
+inf_int = 2147483647
+inf_float = 1.7e+308
+
+
+class Unsupported(Exception):
+    pass
+
+
+# Wabbit division: int division truncates toward zero and dividing by
+# zero gives the largest value of the type
+
+def divide_int(left, right):
+    return int(left / right) if right != 0 else inf_int
+
+def divide_float(left, right):
+    return left / right if right != 0 else inf_float
+
+def divide(left, right):
+    if isinstance(left, int) and not isinstance(left, bool):
+        return divide_int(left, right)
+    return divide_float(left, right)
+
+
+class Tier:
+    '''
+    Compiled code of one run of the interpreter. Every function has a name
+    in the shared namespace: a stub calling back into the interpreter
+    until it gets hot, then its compiled version, so compiled callers pick
+    it up without being compiled again.
+    '''
+    def __init__(self, globals: list, call, printValue, types: Types | None = None):
+        self.call = call
+        self.types = types or Types()
+        self.namespace = {
+            'G': globals,
+            '_print': printValue,
+            '_idiv': divide_int,
+            '_fdiv': divide_float,
+            '_div': divide,
+            '_array': arrays.from_values,
+            '_zeros': arrays.zeros,
+            '_copy': arrays.copy,
+            '_get': arrays.get,
+            '_store': arrays.store,
+            '_abinop': arrays.binop,
+            '_aunop': arrays.unop,
+            '_reduce': arrays.reduce,
+        }
+        self.names = {}
+        self.calls = {}
+        # FunctionDefinition or WhileStatement -> compiled code, or False
+        # when it can't be translated
+        self.compiled = {}
+
+    def getName(self, function: FunctionDefinition) -> str:
+        name = self.names.get(function)
+        if not name:
+            name = self.names[function] = f'f{len(self.names)}_{function.name}'
+            call = self.call
+            self.namespace[name] = lambda *args: call(function, list(args))
+        return name
+
+    def enter(self, function: FunctionDefinition):
+        '''
+        Count a call, returning the compiled function once there is one
+        '''
+        compiled = self.compiled.get(function)
+        if compiled is None:
+            calls = self.calls[function] = self.calls.get(function, 0) + 1
+            if calls >= HOT_CALLS:
+                compiled = self.compileFunction(function)
+        return compiled
+
+    def compileFunction(self, function: FunctionDefinition):
+        name = self.getName(function)
+        nparams = len(function.params)
+
+        ctx = Context(self)
+        ctx.emit(f"def {name}({', '.join( f'v{p.slot}' for p in function.params )}):")
+        ctx.indent += 1
+        for slot in range(nparams, function.frame_size):
+            ctx.emit(f'v{slot} = None')
+        try:
+            _block(function.body, ctx)
+        except Unsupported:
+            self.compiled[function] = False
+            return False
+        ctx.emit("return '()'")
+
+        compiled = self.compiled[function] = self.load(ctx, name)
+        return compiled
+
+    def compileLoop(self, node: WhileStatement):
+        '''
+        Compile a loop into a function of the frame it runs in. It returns
+        None when the loop ends and a 1-tuple holding the value when it
+        returns from the enclosing function.
+        '''
+        ctx = Context(self)
+        ctx.loop = True
+        ctx.indent = 2
+        try:
+            _statement(node, ctx)
+        except Unsupported:
+            self.compiled[node] = False
+            return False
+
+        # locals are cached in Python variables for the duration of the loop
+        slots = sorted(ctx.slots)
+        body = ctx.lines
+        ctx.lines = []
+        ctx.indent = 0
+        ctx.emit('def _loop(F):')
+        ctx.indent = 1
+        for slot in slots:
+            ctx.emit(f'v{slot} = F[{slot}]')
+        ctx.emit('if True:')
+        ctx.lines += body
+        for slot in slots:
+            ctx.emit(f'F[{slot}] = v{slot}')
+
+        compiled = self.compiled[node] = self.load(ctx, '_loop')
+        del self.namespace['_loop']
+        return compiled
+
+    def load(self, ctx: 'Context', name: str):
+        source = '\n'.join(ctx.lines)
+        exec(compile(source, f'<wabbit {name}>', 'exec'), self.namespace)
+        return self.namespace[name]
+
+
+class Context:
+    def __init__(self, tier: Tier):
+        self.tier = tier
+        self.types = tier.types
+        self.lines = []
+        self.indent = 0
+        # local slots used, and whether return leaves a loop rather than
+        # a function
+        self.slots = set()
+        self.loop = False
+
+    def emit(self, line: str):
+        self.lines.append('    ' * self.indent + line)
+
+
+def _block(node: BlockStatement, ctx: Context):
+    if not node.instructions:
+        ctx.emit('pass')
+    for inst in node.instructions:
+        _statement(inst, ctx)
+
+def _value(node: Expression, ctx: Context) -> str:
+    '''
+    Translate the whole value of a statement. The leading statements of a
+    compound expression are emitted before it, since nothing else of the
+    statement has been evaluated yet.
+    '''
+    if isinstance(node, CompoundExpression):
+        for inst in node.instructions[:-1]:
+            _statement(inst, ctx)
+        node = node.instructions[-1]
+    return _expression(node, ctx)
+
+def _copied(node: Expression, ctx: Context) -> str:
+    '''
+    _value of a value stored or passed on: the array of a variable is
+    copied, as arrays are values
+    '''
+    value = _value(node, ctx)
+    if isinstance(node, Location | CompoundExpression) and is_array(ctx.types.get(node)):
+        return f'_copy({value})'
+    return value
+
+def _variable(node: Location, ctx: Context) -> str:
+    if node.frame == GLOBAL:
+        return f'G[{node.slot}]'
+    ctx.slots.add(node.slot)
+    return f'v{node.slot}'
+
+
+@singledispatch
+def _statement(node: Node, ctx: Context):
+    raise Unsupported(node)
+
+rule = _statement.register
+
+@rule(Integer)
+@rule(Float)
+@rule(Char)
+@rule(Bool)
+@rule(Unit)
+@rule(Location)
+@rule(UnOp)
+@rule(BinOp)
+@rule(CompoundExpression)
+@rule(FunctionCall)
+@rule(ArrayLiteral)
+@rule(Index)
+@rule(ArrayFunction)
+def _statement_expression(node: Expression, ctx: Context):
+    ctx.emit( _value(node, ctx) )
+
+@rule(Break)
+def _statement_break(node: Break, ctx: Context):
+    ctx.emit('break')
+
+@rule(Continue)
+def _statement_continue(node: Continue, ctx: Context):
+    ctx.emit('continue')
+
+@rule(PrintStatement)
+def _statement_print(node: PrintStatement, ctx: Context):
+    ctx.emit(f'_print({_value(node.expr, ctx)}, {ctx.types.get(node)!r})')
+
+@rule(VarDefinition)
+@rule(ConstDefinition)
+def _statement_definition(node: VarDefinition | ConstDefinition, ctx: Context):
+    if node.value:
+        value = _copied(node.value, ctx)
+    elif is_array(node.dtype):
+        value = f'_zeros({element_type(node.dtype)!r}, {array_size(node.dtype)})'
+    else:
+        value = repr('()' if node.dtype == 'unit' else None)
+    ctx.emit(f'{_variable(node.location, ctx)} = {value}')
+
+@rule(AssignmentStatement)
+def _statement_assignment(node: AssignmentStatement, ctx: Context):
+    value = _copied(node.value, ctx)
+    ctx.emit(f'{_variable(node.location, ctx)} = {value}')
+
+@rule(IndexAssignment)
+def _statement_indexassignment(node: IndexAssignment, ctx: Context):
+    # the index is evaluated first, so nothing of the value may be hoisted
+    if isinstance(node.value, CompoundExpression):
+        raise Unsupported(node)
+
+    array = _variable(node.location, ctx)
+    index = _expression(node.index, ctx)
+    ctx.emit(f'_store({array}, {index}, {_expression(node.value, ctx)}, {node.lineno})')
+
+@rule(BlockStatement)
+def _statement_block(node: BlockStatement, ctx: Context):
+    ctx.emit('if True:')
+    ctx.indent += 1
+    _block(node, ctx)
+    ctx.indent -= 1
+
+@rule(IfStatement)
+def _statement_if(node: IfStatement, ctx: Context):
+    ctx.emit(f'if {_value(node.cmp, ctx)}:')
+    ctx.indent += 1
+    _block(node.block_if, ctx)
+    ctx.indent -= 1
+    if node.block_else:
+        ctx.emit('else:')
+        ctx.indent += 1
+        _block(node.block_else, ctx)
+        ctx.indent -= 1
+
+@rule(WhileStatement)
+def _statement_while(node: WhileStatement, ctx: Context):
+    # the condition is evaluated on every iteration, so it can't hoist
+    if isinstance(node.cmp, CompoundExpression):
+        raise Unsupported(node)
+
+    ctx.emit(f'while {_expression(node.cmp, ctx)}:')
+    ctx.indent += 1
+    _block(node.body, ctx)
+    ctx.indent -= 1
+
+@rule(ReturnStatement)
+def _statement_return(node: ReturnStatement, ctx: Context):
+    value = _copied(node.expr, ctx) if node.expr is not None else repr('()')
+    ctx.emit(f'return ({value}, )' if ctx.loop else f'return {value}')
+
+
+@singledispatch
+def _expression(node: Node, ctx: Context) -> str:
+    raise Unsupported(node)
+
+expression_rule = _expression.register
+
+@expression_rule(Integer)
+@expression_rule(Float)
+@expression_rule(Char)
+@expression_rule(Bool)
+@expression_rule(Unit)
+def _expression_literal(node: LiteralT, ctx: Context) -> str:
+    return repr(node.value)
+
+@expression_rule(Location)
+def _expression_location(node: Location, ctx: Context) -> str:
+    return _variable(node, ctx)
+
+@expression_rule(UnOp)
+def _expression_unop(node: UnOp, ctx: Context) -> str:
+    expr = _expression(node.expr, ctx)
+
+    if is_array(ctx.types.get(node)):
+        return f'_aunop({node.op!r}, {expr})'
+
+    match node.op:
+        case '-': return f'(-{expr})'
+        case '!': return f'(not {expr})'
+        case _: return expr
+
+@expression_rule(BinOp)
+def _expression_binop(node: BinOp, ctx: Context) -> str:
+    left = _expression(node.left, ctx)
+    right = _expression(node.right, ctx)
+
+    p_type = ctx.types.get(node)
+    if is_array(p_type):
+        return f'_abinop({node.op!r}, {element_type(p_type)!r}, {left}, {right})'
+
+    match node.op:
+        case '&&': return f'({left} and {right})'
+        case '||': return f'({left} or {right})'
+        case '/' if p_type == 'int': return f'_idiv({left}, {right})'
+        case '/' if p_type == 'float': return f'_fdiv({left}, {right})'
+        case '/': return f'_div({left}, {right})'
+        case op: return f'({left} {op} {right})'
+
+@expression_rule(FunctionCall)
+def _expression_functioncall(node: FunctionCall, ctx: Context) -> str:
+    args = ', '.join( _argument(a, ctx) for a in node.args )
+    return f'{ctx.tier.getName(node.function)}({args})'
+
+def _argument(node: Expression, ctx: Context) -> str:
+    expr = _expression(node, ctx)
+    if isinstance(node, Location) and is_array(ctx.types.get(node)):
+        return f'_copy({expr})'
+    return expr
+
+@expression_rule(ArrayLiteral)
+def _expression_arrayliteral(node: ArrayLiteral, ctx: Context) -> str:
+    values = ', '.join( _expression(e, ctx) for e in node.elements )
+    return f'_array({element_type(ctx.types.get(node))!r}, [{values}])'
+
+@expression_rule(Index)
+def _expression_index(node: Index, ctx: Context) -> str:
+    return f'_get({_expression(node.array, ctx)}, {_expression(node.index, ctx)}, {node.lineno})'
+
+@expression_rule(ArrayFunction)
+def _expression_arrayfunction(node: ArrayFunction, ctx: Context) -> str:
+    return f'_reduce({node.name!r}, {_expression(node.expr, ctx)})'
@@ -121,6 +121,18 @@ class _NodeVisitor:
     def visit_ReturnStatement(self, node: ReturnStatement):
         return f'return {self.visit(node.expr)};'
 
+    def visit_ArrayLiteral(self, node: ArrayLiteral):
+        return f"[{', '.join( f'{self.visit(e)}' for e in node.elements )}]"
+
+    def visit_Index(self, node: Index):
+        return f'{self.visit(node.array)}[{self.visit(node.index)}]'
+
+    def visit_IndexAssignment(self, node: IndexAssignment):
+        return f'{self.visit(node.location)}[{self.visit(node.index)}] = {self.visit(node.value)};'
+
+    def visit_ArrayFunction(self, node: ArrayFunction):
+        return f'{node.name}({self.visit(node.expr)})'
+
 
 def to_source(model):
     codes = []
@@ -53,7 +53,9 @@ class WabbitLexer(Lexer):
         LPAREN,
         RPAREN,
         LBRACE,
-        RBRACE
+        RBRACE,
+        LBRACKET,
+        RBRACKET
     }
 
     ignore = ' \t'
@@ -108,6 +110,8 @@ class WabbitLexer(Lexer):
     RPAREN = r'\)'
     LBRACE = r'{'
     RBRACE = r'}'
+    LBRACKET = r'\['
+    RBRACKET = r'\]'
 
     def error(self, t):
         print("Illegal character '%s'" % t.value[0])
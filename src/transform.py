@@ -1,42 +1,94 @@
+import copy
 from functools import singledispatch
 
 from .model import *
+from .profiler import Profile
+from .resolve import resolve_program
+from .tier import divide
 
 
-class Env:
-    def __init__(self):
-        self.stack = [{}]
+# Profile-guided thresholds: calls of a call site before its callee is
+# inlined, and mean iterations of a loop before its body is unrolled
+INLINE_CALLS = 100
+UNROLL_TRIPS = 8
+UNROLL_SIZE = 40
 
-    def newScope(self):
-        self.stack.insert(0, {})
 
-    def popScope(self):
-        self.stack.pop(0)
-
-    def createRegister(self, name: str, value: Expression):
-        self.stack[0][name] = value
+class Env:
+    def __init__(self):
+        # binding of a constant -> its folded value; bindings are unique in
+        # the program, so variables and parameters need no entry to hide
+        # constants of the same name
+        self.consts = {}
 
-    def setRegister(self, name: str, value: Expression):
-        for i in range( len(self.stack) ):
-            if self.stack[i].get(name):
-                self.stack[i][name] = value
-                break
+    def createRegister(self, location: Location, value: Expression):
+        self.consts[location.binding] = value
 
-    def getRegister(self, name: str, deep: int = -1) -> DType | None:
-        length = deep if deep < len(self.stack) and deep > -1 else len(self.stack)
-        for i in range( length ):
-            reg = self.stack[i].get(name)
-            if reg: return reg
+    def getRegister(self, location: Location) -> Expression | None:
+        # nodes the transform created have no binding
+        return self.consts.get(getattr(location, 'binding', None))
 
 
 class Context:
-    def __init__(self):
+    def __init__(self, profile: Profile | None = None, types: Types | None = None):
         self.env = Env()
-
-
-def transform_program(model):
-    ctx = Context()
-    return _transform(model, ctx)
+        self.profile = profile
+        # types of the checked model; the nodes made here carry theirs in
+        # p_type until transform_program adds them to it
+        self.types = types or Types()
+        self.functions = {}
+        self.inlined = 0
+        self.loops = 0
+
+    def typeOf(self, node: Node) -> DType | None:
+        if node in self.types.table:
+            return self.types.get(node)
+        return getattr(node, 'p_type', None)
+
+    def copy(self, node: Node) -> Node:
+        # deep copy sharing the FunctionDefinitions its calls resolved to;
+        # the copies are new nodes, so they carry their types
+        copied = copy.deepcopy(node, { id(f): f for f in self.functions.values() })
+        for original, n in zip(_nodes(node), _nodes(copied)):
+            if hasattr(n, 'p_type'):
+                n.p_type = self.typeOf(original)
+        return copied
+
+    def register(self, node: Node | None):
+        '''
+        Add the nodes made under node to the types
+        '''
+        if node is None:
+            return
+        for n in _nodes(node):
+            if n not in self.types.table:
+                self.types.set(n, getattr(n, 'p_type', None))
+
+
+def transform_program(model, profile: Profile | None = None, types: Types | None = None):
+    '''
+    Fold constants, drop dead code and replace counting loops that only
+    accumulate by their closed form. Given the profile of a training run,
+    also inline small functions at hot call sites and unroll hot loops.
+    Ifs keep their branches in place, the backends order them by the
+    same profile.
+
+    types are those check_model found for model. The result is a new
+    model, made of nodes of model and new ones whose types are added to
+    types, so pass the same types to the backends.
+    '''
+    ctx = Context(profile, types)
+    if not isinstance(model, list):
+        transformed = _transform(model, ctx)
+        ctx.register(transformed)
+        return transformed
+
+    resolve_program(model, strict=False)
+    ctx.functions = { n.name: n for n in model if isinstance(n, FunctionDefinition) }
+    transformed = [ t for t in ( _transform(n, ctx) for n in model ) if t is not None ]
+    for t in transformed:
+        ctx.register(t)
+    return transformed
 
 
 @singledispatch
@@ -58,17 +110,22 @@ def _transform_binop(node: BinOp, ctx: Context):
     left = _transform(node.left, ctx)
     right = _transform(node.right, ctx)
 
-    if not ( node.op in ['&&', '||'] and isinstance(left, Bool) ) and \
-        ( not isinstance(left, LiteralT) or not isinstance(right, LiteralT) ):
+    if node.op in ['&&', '||'] and isinstance(left, Bool):
+        # true && x is x and false && x is false; || the other way round
+        if left.value == (node.op == '&&'):
+            return right
+        return left
+
+    if not isinstance(left, LiteralT) or not isinstance(right, LiteralT):
         new_node = BinOp(node.lineno, node.op, left, right)
-        new_node.p_type = node.p_type
+        new_node.p_type = ctx.typeOf(node)
         return new_node
 
     new_value = ''
     match node.op:
         case '+': new_value = f'{repr(left.value)} + {repr(right.value)}'
         case '-': new_value = f'{repr(left.value)} - {repr(right.value)}'
-        case '/': new_value = f'{repr(left.value)} / {repr(right.value)}'
+        case '/': new_value = repr(divide(left.value, right.value))
         case '*': new_value = f'{repr(left.value)} * {repr(right.value)}'
         case '<': new_value = f'{repr(left.value)} < {repr(right.value)}'
         case '>': new_value = f'{repr(left.value)} > {repr(right.value)}'
@@ -88,7 +145,7 @@ def _transform_binop(node: BinOp, ctx: Context):
     if isinstance(left, Float):
         new_node = Float(node.lineno, eval(new_value))
 
-    new_node.p_type = node.p_type
+    new_node.p_type = ctx.typeOf(node)
     return new_node
 
 @rule(UnOp)
@@ -97,14 +154,18 @@ def _transform_unop(node: UnOp, ctx: Context):
 
     if not isinstance(expr, LiteralT):
         if (node.op in ['+', '-']):
-            return BinOp(
+            dtype = ctx.typeOf(node)
+            dtype = element_type(dtype) if is_array(dtype) else ctx.typeOf(node.expr)
+            new_node = BinOp(
                 node.lineno,
                 node.op,
-                Integer(node.lineno, 0) if node.expr.p_type == 'int' else Float(node.lineno, 0),
-                node.expr
+                Integer(node.lineno, 0, 'int') if dtype == 'int' else Float(node.lineno, 0.0, 'float'),
+                expr
             )
+            new_node.p_type = ctx.typeOf(node)
+            return new_node
         new_node = UnOp(node.lineno, node.op, expr)
-        new_node.p_type = node.p_type
+        new_node.p_type = ctx.typeOf(node)
         return new_node
 
     if node.op == '-':
@@ -118,7 +179,7 @@ def _transform_unop(node: UnOp, ctx: Context):
     if isinstance(expr, Float): new_node = Float(node.lineno, eval(new_value))
     if isinstance(expr, Bool): new_node = Bool(node.lineno, eval(new_value))
 
-    new_node.p_type = node.p_type
+    new_node.p_type = ctx.typeOf(node)
 
     return new_node
 
@@ -126,12 +187,13 @@ def _transform_unop(node: UnOp, ctx: Context):
 def _transform_print_statement(node: PrintStatement, ctx: Context):
     return PrintStatement(
         node.lineno,
-        _transform(node.expr, ctx)
+        _transform(node.expr, ctx),
+        ctx.typeOf(node)
     )
 
 @rule(Location)
 def _transform_location(node: Location, ctx: Context):
-    value = ctx.env.getRegister(node.name)
+    value = ctx.env.getRegister(node)
     return value if not value == None else node
 
 @rule(VarDefinition)
@@ -139,7 +201,7 @@ def _transform_location(node: Location, ctx: Context):
 def _interpret_definition(node: VarDefinition | ConstDefinition, ctx: Context):
     if node.value:
         value = _transform(node.value, ctx)
-        dtype = node.value.p_type
+        dtype = ctx.typeOf(node.value)
     else:
         value = None
         dtype = node.dtype
@@ -147,19 +209,45 @@ def _interpret_definition(node: VarDefinition | ConstDefinition, ctx: Context):
     if isinstance(node, VarDefinition):
         return VarDefinition(node.lineno, node.location, value, dtype)
     else:
-        ctx.env.createRegister(node.location.name, value)
+        ctx.env.createRegister(node.location, value)
         return None
 
 @rule(AssignmentStatement)
 def _transform_assignmentstatement(node: AssignmentStatement, ctx: Context):
     value = _transform(node.value, ctx)
-    location = _transform_location(node.location, ctx)
+    return AssignmentStatement(node.lineno, node.location, value)
 
-    if isinstance(location, Location):
-        return AssignmentStatement(node.lineno, node.location, value)
-    else:
-        ctx.env.setRegister(location, value)
-        return None
+@rule(IndexAssignment)
+def _transform_indexassignment(node: IndexAssignment, ctx: Context):
+    index = _transform(node.index, ctx)
+    value = _transform(node.value, ctx)
+    return IndexAssignment(node.lineno, node.location, index, value, ctx.typeOf(node))
+
+@rule(ArrayLiteral)
+def _transform_arrayliteral(node: ArrayLiteral, ctx: Context):
+    elements = [ _transform(e, ctx) for e in node.elements ]
+    return ArrayLiteral(node.lineno, elements, ctx.typeOf(node))
+
+def _is_constant(node: Expression) -> bool:
+    return isinstance(node, ArrayLiteral) and all( isinstance(e, LiteralT) for e in node.elements )
+
+@rule(Index)
+def _transform_index(node: Index, ctx: Context):
+    array = _transform(node.array, ctx)
+    index = _transform(node.index, ctx)
+
+    # constant arrays are replaced by their literal, which folds
+    if _is_constant(array) and isinstance(index, Integer):
+        return copy.copy(array.elements[index.value])
+    return Index(node.lineno, array, index, ctx.typeOf(node))
+
+@rule(ArrayFunction)
+def _transform_arrayfunction(node: ArrayFunction, ctx: Context):
+    expr = _transform(node.expr, ctx)
+
+    if node.name == 'len' and (isinstance(expr, Location) or _is_constant(expr)):
+        return Integer(node.lineno, array_size(ctx.typeOf(node.expr)), 'int')
+    return ArrayFunction(node.lineno, node.name, expr, ctx.typeOf(node))
 
 @rule(IfStatement)
 def _transform_ifstatement(node: IfStatement, ctx: Context):
@@ -187,6 +275,10 @@ def _transform_ifstatement(node: IfStatement, ctx: Context):
     else:
         if block_if:
             return IfStatement(node.lineno, cmp, block_if, block_else)
+        elif block_else:
+            negated = UnOp(node.lineno, '!', cmp)
+            negated.p_type = 'bool'
+            return IfStatement(node.lineno, negated, block_else)
         else:
             return None
 
@@ -197,8 +289,25 @@ def _transform_whilestatement(node: WhileStatement, ctx: Context):
 
     if isinstance(cmp, Bool) and not cmp.value:
         return None
-    else:
-        return WhileStatement(node.lineno, cmp, body)
+
+    closed = _closed_form(cmp, body, ctx)
+    if closed:
+        return closed
+
+    body = body or BlockStatement(node.lineno, [])
+    if ctx.profile and ctx.profile.trips(node.lineno) >= UNROLL_TRIPS and \
+            _size(body) <= UNROLL_SIZE:
+        # while c { b } runs as while c { b; if !c { break; } b }, which
+        # checks the condition at the same points
+        negated = UnOp(node.lineno, '!', ctx.copy(cmp))
+        negated.p_type = 'bool'
+        body = BlockStatement(node.lineno, [
+            body,
+            IfStatement(node.lineno, negated, BlockStatement(node.lineno, [Break(node.lineno)])),
+            ctx.copy(body),
+        ])
+
+    return WhileStatement(node.lineno, cmp, body)
 
 @rule(Break)
 @rule(Continue)
@@ -207,8 +316,6 @@ def _interpret_breakcontinue(node: Break | Continue, ctx: Context):
 
 @rule(CompoundExpression)
 def _transform_compoundexpression(node: CompoundExpression, ctx: Context):
-    ctx.env.newScope()
-
     insts = []
     for inst in node.instructions[:-1]:
         inst_t = _transform(inst, ctx)
@@ -219,8 +326,6 @@ def _transform_compoundexpression(node: CompoundExpression, ctx: Context):
 
     inst_t = _transform( node.instructions[-1], ctx )
 
-    ctx.env.popScope()
-
     # if isinstance(inst_t, LiteralT):
     #     return inst_t
     # elif isinstance(inst_t, Expression):
@@ -232,8 +337,6 @@ def _transform_compoundexpression(node: CompoundExpression, ctx: Context):
 
 @rule(BlockStatement)
 def _transform_blockstatement(node: BlockStatement, ctx: Context):
-    ctx.env.newScope()
-
     insts = []
     for inst in node.instructions:
         inst_t = _transform(inst, ctx)
@@ -244,8 +347,248 @@ def _transform_blockstatement(node: BlockStatement, ctx: Context):
         else:
             insts.append(inst_t)
 
-    ctx.env.popScope()
     if len(insts) == 0:
         return None
     else:
-        return BlockStatement(node.lineno, insts)
\ No newline at end of file
+        return BlockStatement(node.lineno, insts)
+
+@rule(FunctionDefinition)
+def _transform_functiondefinition(node: FunctionDefinition, ctx: Context):
+    body = _transform_blockstatement(node.body, ctx)
+
+    return FunctionDefinition(node.lineno, node.name, node.params, node.ret,
+                              body or BlockStatement(node.lineno, []))
+
+@rule(FunctionCall)
+def _transform_functioncall(node: FunctionCall, ctx: Context):
+    args = [ _transform(a, ctx) for a in node.args ]
+
+    function = ctx.functions.get(node.name)
+    if function and ctx.profile and \
+            ctx.profile.callsAt(node.lineno, node.name) >= INLINE_CALLS:
+        inlined = _inline(function, args, node, ctx)
+        if inlined:
+            return inlined
+
+    return FunctionCall(node.lineno, node.name, args, ctx.typeOf(node))
+
+@rule(ReturnStatement)
+def _transform_returnstatement(node: ReturnStatement, ctx: Context):
+    expr = _transform(node.expr, ctx) if node.expr is not None else None
+    return ReturnStatement(node.lineno, expr, ctx.typeOf(node))
+
+
+def _inline(function: FunctionDefinition, args: list[Expression], node: FunctionCall, ctx: Context):
+    '''
+    Replace a call of a function whose body is return <expr>, where expr
+    only uses the parameters, by { var p = arg; ...; expr }
+    '''
+    body = function.body.instructions
+    if len(body) != 1 or not isinstance(body[0], ReturnStatement) or body[0].expr is None:
+        return None
+
+    params = { p.name: p for p in function.params }
+
+    # fold the constants of the callee, whose bindings can't clash with
+    # those of the call site
+    expr = _transform(ctx.copy(body[0].expr), ctx)
+
+    if not _only_uses(expr, params):
+        return None
+
+    ctx.inlined += 1
+    names = { name: f'_{function.name}_{name}_{ctx.inlined}' for name in params }
+
+    instructions = []
+    for p, a in zip(function.params, args):
+        location = Location(node.lineno, names[p.name], p.dtype)
+        instructions.append( VarDefinition(node.lineno, location, a, p.dtype) )
+
+    for n in _nodes(expr):
+        if isinstance(n, Location):
+            n.name = names[n.name]
+    instructions.append(expr)
+
+    return CompoundExpression(node.lineno, instructions, ctx.typeOf(node))
+
+def _nodes(node: Node):
+    yield node
+    for value in vars(node).values():
+        # skip the callee the resolver gives calls
+        if isinstance(value, FunctionDefinition):
+            continue
+        if isinstance(value, Node):
+            yield from _nodes(value)
+        elif isinstance(value, list):
+            for v in value:
+                if isinstance(v, Node):
+                    yield from _nodes(v)
+
+def _only_uses(expr: Expression, params: dict) -> bool:
+    for n in _nodes(expr):
+        if isinstance(n, Location) and n.name not in params:
+            return False
+        if not isinstance(n, Location | LiteralT | UnOp | BinOp):
+            return False
+    return True
+
+def _size(node: Node) -> int:
+    return sum( 1 for _ in _nodes(node) )
+
+
+# Loop idioms: a loop like
+#
+#   while i < n { s = s + i; c = c + k; p = p * k; i = i + 1; }
+#
+# where n and k don't change in the loop runs its body trips times, a
+# number known on entry, so the accumulators have a closed form. It only
+# uses + - * and exact halving, so ints wrap around in each backend just
+# like the loop would; float sums round differently and are left alone.
+
+def _int(lineno: int, value: int) -> Integer:
+    return Integer(lineno, value, 'int')
+
+def _var(lineno: int, name: str) -> Location:
+    return Location(lineno, name, 'int')
+
+def _op(lineno: int, op: str, left: Expression, right: Expression) -> BinOp:
+    return BinOp(lineno, op, left, right, 'int')
+
+def _invariant(expr: Expression, assigned: set[str]) -> bool:
+    for n in _nodes(expr):
+        if isinstance(n, Location) and n.name in assigned:
+            return False
+        if not isinstance(n, Location | LiteralT | UnOp | BinOp):
+            return False
+    return True
+
+def _counting_loop(cmp: Expression, body: BlockStatement | None, ctx: Context):
+    '''
+    Split a loop into (counter, <, < or <=, bound, step, updates) when it
+    counts up by a constant step and otherwise only accumulates. Each
+    update is (statement, op, operand, after) where after tells whether it
+    runs after the counter is stepped.
+    '''
+    if not isinstance(cmp, BinOp) or cmp.op not in ['<', '<=', '>', '>=']:
+        return None
+    if cmp.op in ['<', '<=']:
+        (counter, bound, op) = (cmp.left, cmp.right, cmp.op)
+    else:
+        (counter, bound, op) = (cmp.right, cmp.left, '<' if cmp.op == '>' else '<=')
+    if not isinstance(counter, Location) or ctx.typeOf(counter) != 'int' or not body:
+        return None
+
+    instructions = body.instructions
+    if not all( isinstance(s, AssignmentStatement) and isinstance(s.value, BinOp) for s in instructions ):
+        return None
+    assigned = { s.location.name for s in instructions }
+    if len(assigned) != len(instructions) or not _invariant(bound, assigned):
+        return None
+
+    step = None
+    updates = []
+    for s in instructions:
+        (name, value) = (s.location.name, s.value)
+        if ctx.typeOf(s.location) != 'int':
+            return None
+
+        if isinstance(value.left, Location) and value.left.name == name:
+            operand = value.right
+        elif value.op != '-' and isinstance(value.right, Location) and value.right.name == name:
+            operand = value.left
+        else:
+            return None
+
+        if name == counter.name:
+            if value.op != '+' or not isinstance(operand, Integer) or operand.value < 1:
+                return None
+            step = operand.value
+        elif value.op not in ['+', '-', '*']:
+            return None
+        elif isinstance(operand, Location) and operand.name == counter.name and value.op != '*':
+            updates.append( (s, value.op, operand, step is not None) )
+        elif _invariant(operand, assigned):
+            updates.append( (s, value.op, operand, False) )
+        else:
+            return None
+
+    if step is None:
+        return None
+    return (counter, op, bound, step, updates)
+
+def _closed_form(cmp: Expression, body: BlockStatement | None, ctx: Context):
+    loop = _counting_loop(cmp, body, ctx)
+    if not loop:
+        return None
+    (counter, op, bound, step, updates) = loop
+
+    lineno = cmp.lineno
+    ctx.loops += 1
+    trips = f'_trips_{ctx.loops}'
+    n = lambda: _var(lineno, trips)
+    i = lambda: _var(lineno, counter.name)
+
+    # the loop runs at least once here, so trips >= 1
+    span = _op(lineno, '-', ctx.copy(bound), i())
+    if op == '<=' or step > 1:
+        span = _op(lineno, '+', span, _int(lineno, step if op == '<=' else step - 1))
+    if step > 1:
+        span = _op(lineno, '/', span, _int(lineno, step))
+    instructions = [ VarDefinition(lineno, _var(lineno, trips), span, 'int') ]
+
+    for (s, op, operand, after) in updates:
+        location = _var(lineno, s.location.name)
+        if op == '*':
+            power = _power(lineno, operand, n, ctx, instructions)
+            value = _op(lineno, '*', location, power)
+        elif isinstance(operand, Location) and operand.name == counter.name:
+            # the counter takes trips values from i (i + step when stepped
+            # first), step apart
+            steps = _triangle(lineno, n)
+            if after:
+                steps = _op(lineno, '+', steps, n())
+            if step > 1:
+                steps = _op(lineno, '*', _int(lineno, step), steps)
+            total = _op(lineno, '+', _op(lineno, '*', n(), i()), steps)
+            value = _op(lineno, op, location, total)
+        else:
+            value = _op(lineno, op, location, _op(lineno, '*', n(), ctx.copy(operand)))
+        instructions.append( AssignmentStatement(lineno, s.location, value, 'int') )
+
+    steps = _op(lineno, '*', n(), _int(lineno, step)) if step > 1 else n()
+    instructions.append( AssignmentStatement(lineno, counter, _op(lineno, '+', i(), steps), 'int') )
+
+    return IfStatement(lineno, ctx.copy(cmp), BlockStatement(lineno, instructions))
+
+def _triangle(lineno: int, n) -> Expression:
+    '''
+    n * (n - 1) / 2 as h * (n - 1 + (n - 2 * h)) with h = n / 2, which only
+    divides n itself, so it agrees with the loop when ints wrap around
+    '''
+    h = lambda: _op(lineno, '/', n(), _int(lineno, 2))
+    rest = _op(lineno, '-', n(), _op(lineno, '*', _int(lineno, 2), h()))
+    return _op(lineno, '*', h(), _op(lineno, '+', _op(lineno, '-', n(), _int(lineno, 1)), rest))
+
+def _power(lineno: int, base: Expression, n, ctx: Context, instructions: list) -> Location:
+    '''
+    Emit base ** trips by repeated squaring, in log2(trips) steps
+    '''
+    ctx.loops += 1
+    names = [ f'_{name}_{ctx.loops}' for name in ['base', 'exp', 'power'] ]
+    (b, e, r) = ( (lambda name=name: _var(lineno, name)) for name in names )
+    instructions += [
+        VarDefinition(lineno, b(), ctx.copy(base), 'int'),
+        VarDefinition(lineno, e(), n(), 'int'),
+        VarDefinition(lineno, r(), _int(lineno, 1), 'int'),
+    ]
+
+    odd = BinOp(lineno, '!=', _op(lineno, '*', _op(lineno, '/', e(), _int(lineno, 2)), _int(lineno, 2)), e(), 'bool')
+    positive = BinOp(lineno, '>', e(), _int(lineno, 0), 'bool')
+    instructions.append( WhileStatement(lineno, positive, BlockStatement(lineno, [
+        IfStatement(lineno, odd, BlockStatement(lineno, [
+            AssignmentStatement(lineno, r(), _op(lineno, '*', r(), b()), 'int'),
+        ])),
+        AssignmentStatement(lineno, b(), _op(lineno, '*', b(), b()), 'int'),
+        AssignmentStatement(lineno, e(), _op(lineno, '/', e(), _int(lineno, 2)), 'int'),
+    ])) )
+    return r()
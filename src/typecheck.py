@@ -1,6 +1,16 @@
+import hashlib
+import io
+import os
+import pickle
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import get_args
 from functools import singledispatch
 
 from .model import *
+from .scan import CODES, Tokens, scan
+from .parse import WabbitParser, array_builtins
+from .resolve import LOCAL, resolve_program
 
 
 ScopeType = Literal["global", "function", "while", "if", "else", "compoundexpression"]
@@ -15,62 +25,94 @@ class EnvRegister:
         self._dtype = value
 
 
+class Diagnostic:
+    '''
+    An error found by the checker, at lineno of the file at path when it
+    came from one
+    '''
+    def __init__(self, lineno: int, message: str, path: str | None = None):
+        self.lineno = lineno
+        self.message = message
+        self.path = path
+
+    def __repr__(self):
+        return f'Diagnostic({self.lineno!r}, {self.message!r})'
+
+    def __str__(self):
+        prefix = f'{self.path}:' if self.path else ''
+        return f'{prefix}{self.lineno}: {self.message}'
+
+    def __eq__(self, other):
+        return isinstance(other, Diagnostic) and \
+            (self.lineno, self.message, self.path) == (other.lineno, other.message, other.path)
+
+
 class Env:
     def __init__(self):
-        self.stack = [{}]
+        # errors found so far, in the order of the program
+        self.diagnostics: list[Diagnostic] = []
+        self.types = Types()
+        # binding -> EnvRegister, the bindings given by resolve_program
+        self.registers = {}
         self.scopes: list[ScopeType] = [ "global" ]
+        # how many scopes of each type are open
+        self.depth = { scope: 0 for scope in get_args(ScopeType) }
         self.functions = {}
         self.returnType = None
         self.returnLineno = None
         self.expectRetType = None
 
-    def newScope(self):
-        self.stack.insert(0, {})
-
-    def popScope(self, popScope: bool = True):
-        self.stack.pop(0)
-        if popScope: self.scopes.pop()
-
-    def createRegister(self, name: str, mut: bool, dtype: DType | tuple):
-        self.stack[0][name] = EnvRegister(mut, dtype)
-
-    def setRegister(self, name: str, dtype: DType | tuple):
-        for i in range( len(self.stack) ):
-            reg: EnvRegister = self.stack[i].get(name)
-            if reg:
-                reg.setDtype(dtype)
-                self.stack[i][name] = reg
-                break
+    def error(self, lineno: int, msg: str):
+        self.diagnostics.append( Diagnostic(lineno, msg) )
+
+    def snapshot(self) -> 'Env':
+        '''
+        A new Env that sees the globals and functions defined so far, to
+        check a function body on its own
+        '''
+        env = Env()
+        env.types = self.types
+        env.registers = dict(self.registers)
+        env.functions = dict(self.functions)
+        return env
+
+    def setType(self, node: Node, dtype: DType | None):
+        self.types.set(node, dtype)
+
+    def getType(self, node: Node) -> DType | None:
+        return self.types.get(node)
+
+    def createRegister(self, binding: int, mut: bool, dtype: DType | tuple):
+        self.registers[binding] = EnvRegister(mut, dtype)
+
+    def setRegister(self, binding: int, dtype: DType | tuple):
+        reg: EnvRegister = self.registers.get(binding)
+        if reg:
+            reg.setDtype(dtype)
+
+    def isMutable(self, binding: int) -> bool:
+        reg: EnvRegister = self.registers.get(binding)
+        if reg:
+            return reg._mut
+
+    def getRegister(self, binding: int | None) -> DType | tuple | None:
+        # a binding is registered once the checker reaches its definition
+        reg: EnvRegister = self.registers.get(binding)
+        if reg:
+            return reg._dtype, True
 
-    def isMutable(self, name) -> bool:
-        for i in range( len(self.stack) ):
-            reg: EnvRegister = self.stack[i].get(name)
-            if reg:
-                return reg._mut
-
-    def getRegister(self, name: str, deep: int = -1) -> DType | tuple | None:
-        length = deep if deep < len(self.stack) and deep > -1 else len(self.stack)
-        for i in range( length ):
-            reg: EnvRegister = self.stack[i].get(name)
-            if reg:
-                return reg._dtype, True
-            
     def setTypeScope(self, value: ScopeType):
         self.scopes.append(value)
+        self.depth[value] += 1
+
+    def popTypeScope(self):
+        self.depth[self.scopes.pop()] -= 1
 
     def getInLoop(self):
-        length = len(self.scopes) - 1
-        for i in range( length ):
-            if self.scopes[length - i] == "while":
-                return True
-        return False
+        return self.depth["while"] > 0
 
     def getInFunction(self):
-        length = len(self.scopes) - 1
-        for i in range( length ):
-            if self.scopes[length - i] == "function":
-                return True
-        return False
+        return self.depth["function"] > 0
 
     def setReturnType(self, rtype: DType, lineno: int):
         self.returnType = rtype
@@ -89,23 +131,328 @@ class Env:
     def getFunction(self, name):
         return self.functions.get(name)
 
-has_errors = False
+class _Entry:
+    def __init__(self, lineno: int, tree: bytes, names: list[str], calls: list[str],
+                 dependencies: tuple, errors: list[tuple[int, str]], types: list):
+        # the checked FunctionDefinition, pickled, and its line
+        self.lineno = lineno
+        self.tree = tree
+        # the types of its nodes, in the order _nodes gives them
+        self.types = types
+        # globals it names and functions it calls, and what the checker
+        # knew of them
+        self.names = names
+        self.calls = calls
+        self.dependencies = dependencies
+        # its errors, with lines relative to the function
+        self.errors = errors
+
+class CheckCache:
+    '''
+    Bounded LRU cache of checked FunctionDefinitions, for check_source. A
+    function whose tokens are unchanged, and whose globals and callees have
+    the same types as when it was checked, is neither parsed nor checked
+    again: its checked model is loaded from the cache and its errors are
+    reported again.
+    '''
+    VERSION = 2
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        # fingerprint of the tokens -> _Entry
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f'CheckCache(hits={self.hits}, misses={self.misses}, size={len(self.entries)}/{self.maxsize})'
+
+    def get(self, key: bytes) -> _Entry | None:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def set(self, key: bytes, entry: _Entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+def save_cache(path: str, cache: CheckCache):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as file:
+        pickle.dump( (CheckCache.VERSION, cache.entries), file, pickle.HIGHEST_PROTOCOL )
+    os.replace(tmp, path)
+
+def load_cache(path: str, maxsize: int = 4096) -> CheckCache:
+    '''
+    The cache saved at path, or an empty one when there is none or it was
+    written by another version
+    '''
+    cache = CheckCache(maxsize)
+    try:
+        with open(path, 'rb') as file:
+            (version, entries) = pickle.load(file)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        return cache
+    if version == CheckCache.VERSION:
+        cache.entries = entries
+    return cache
+
+
+def check_model(model, executor=None) -> tuple[list[Diagnostic], Types]:
+    '''
+    Check model and return its errors, in the order of the program, and
+    the types of its nodes, which aren't written into them. The nodes only
+    get the bindings of resolve_program, as every backend gives them.
+    The top-level statements and the function signatures are checked
+    first, in order; each function body then only needs what was defined
+    before it, so the bodies are independent. executor.map runs them when
+    given: a ThreadPoolExecutor fills in the table of types in place,
+    any other one, such as a ProcessPoolExecutor, gets each body pickled
+    and sends its errors and types back.
+    '''
+    resolve_program(model, strict=False)
+    env = Env()
 
-def error(lineno: int, msg: str):
-    global has_errors
-    print(f"{lineno}: {msg}")
-    has_errors = True
+    # errors of the first pass, and the Envs of the bodies, in order
+    parts = []
+    bodies = []
+    for n in model:
+        start = len(env.diagnostics)
+        if isinstance(n, FunctionDefinition):
+            if _check_signature(n, env):
+                bodies.append( (n, env.snapshot()) )
+                parts += [ env.diagnostics[start:], bodies[-1][1] ]
+                continue
+        else:
+            _check(n, env)
+        parts.append( env.diagnostics[start:] )
+
+    if bodies and (executor is None or isinstance(executor, ThreadPoolExecutor)):
+        (nodes, envs) = zip(*bodies)
+        run = executor.map if executor else map
+        list( run(_check_body, nodes, envs) )
+    elif bodies:
+        for (n, body) in bodies:
+            # the worker starts its own table, sharing none of the model
+            body.types = Types()
+        trees = [ _dump(n) for (n, _) in bodies ]
+        results = executor.map(_check_apart, trees, [ body for (_, body) in bodies ])
+        for ((n, body), (diagnostics, types)) in zip(bodies, results):
+            body.diagnostics = diagnostics
+            for (node, dtype) in zip(_nodes(n), types):
+                env.types.set(node, dtype)
+
+    diagnostics = []
+    for part in parts:
+        diagnostics += part.diagnostics if isinstance(part, Env) else part
+    return diagnostics, env.types
 
 def check_program(model):
-    global has_errors
-    
-    has_errors = False
+    '''
+    Check model, printing its errors. Returns whether it checked, the
+    model and its Types, which the backends take as types.
+    '''
+    (diagnostics, types) = check_model(model)
+    for d in diagnostics:
+        print(d)
+    return not diagnostics, model, types
+
+def check_source(source: str, cache: CheckCache | None = None) -> tuple[list[Diagnostic], list, Types]:
+    '''
+    Parse and check source, returning its errors, model and the Types of
+    the model. The errors start with those of the lexer, whose arrays feed
+    the parser a token at a time. With a cache, the functions found in it
+    are not parsed or checked again, and the others are added to it.
+    '''
+    tokens = scan(source)
+    errors = [ Diagnostic(lineno, message) for (lineno, message) in tokens.errors ]
+    builtins = array_builtins(tokens.functions())
+    chunks = _chunks(tokens) if cache is not None else None
+    items = _parse_chunks(tokens, chunks, builtins, cache) if chunks is not None else None
+    if items is None:
+        model = WabbitParser().parse(tokens, builtins)
+        (diagnostics, types) = check_model(model)
+        return errors + diagnostics, model, types
+
+    model = [ node for (node, _, _) in items ]
+    resolve_program(model, strict=False)
     env = Env()
-    for n in model:
-        _check(n, env)
-    return not has_errors, model
+    # name -> binding of the globals checked so far
+    defined = {}
+    for (node, key, entry) in items:
+        if key is not None:
+            _check_function(node, key, entry, env, defined, cache)
+            continue
+        _check(node, env)
+        if isinstance(node, VarDefinition | ConstDefinition):
+            defined[node.location.name] = node.location.binding
+    return errors + env.diagnostics, model, env.types
+
+def _chunks(tokens: Tokens) -> list[tuple[bool, int, int]] | None:
+    '''
+    Split tokens into the top-level function definitions and the runs of
+    statements between them, as (is_function, first, last) with last
+    excluded. None when braces don't balance.
+    '''
+    (func, lbrace, rbrace) = (CODES['FUNC'], CODES['LBRACE'], CODES['RBRACE'])
+    chunks = []
+    first = 0
+    depth = 0
+    function = False
+    for (i, kind) in enumerate(tokens.kinds):
+        if depth == 0 and kind == func:
+            if i > first:
+                chunks.append( (False, first, i) )
+            (first, function) = (i, True)
+        elif kind == lbrace:
+            depth += 1
+        elif kind == rbrace:
+            depth -= 1
+            if depth < 0:
+                return None
+            if depth == 0 and function:
+                chunks.append( (True, first, i + 1) )
+                (first, function) = (i + 1, False)
+
+    if depth != 0 or function:
+        return None
+    if first < len(tokens):
+        chunks.append( (False, first, len(tokens)) )
+    return chunks
+
+def _parse_chunks(tokens: Tokens, chunks: list[tuple[bool, int, int]], builtins: set[str],
+                  cache: CheckCache) -> list[tuple] | None:
+    '''
+    The top-level nodes as (node, key, entry), where key is the fingerprint
+    of a function and entry what the cache has for it. None on a syntax
+    error, which the caller reports by parsing everything at once.
+    '''
+    parser = WabbitParser()
+    failed = []
+    parser.error = failed.append
+
+    items = []
+    for (function, first, last) in chunks:
+        key = _fingerprint(tokens, first, last, builtins) if function else None
+        entry = cache.get(key) if function else None
+        if entry is not None:
+            items.append( (_load(entry, tokens.linenos[first]), key, entry) )
+            continue
+
+        nodes = parser.parse(tokens.tokens(first, last), builtins)
+        if failed:
+            return None
+        if function and len(nodes) == 1 and isinstance(nodes[0], FunctionDefinition):
+            items.append( (nodes[0], key, None) )
+        else:
+            items += [ (n, None, None) for n in nodes ]
+    return items
+
+def _fingerprint(tokens: Tokens, first: int, last: int, builtins: set[str]) -> bytes:
+    # the tokens, with lines relative to the function, which go into its
+    # errors, and the array builtins, which decide what its calls parse to
+    base = tokens.linenos[first]
+    text = repr(( sorted(builtins), [ (tokens.kind(i), tokens.value(i), tokens.linenos[i] - base)
+                                      for i in range(first, last) ] ))
+    return hashlib.sha256(text.encode('utf-8')).digest()
+
+def _check_function(node: FunctionDefinition, key: bytes, entry: _Entry | None,
+                    env: Env, defined: dict, cache: CheckCache):
+    hit = entry is not None and _dependencies(entry.names, entry.calls, env, defined) == entry.dependencies
+    if not hit:
+        (names, calls) = _names(node)
+        dependencies = _dependencies(names, calls, env, defined)
+
+    if not _check_signature(node, env):
+        return
+
+    if hit:
+        cache.hits += 1
+        for (lineno, msg) in entry.errors:
+            env.error(node.lineno + lineno if lineno else lineno, msg)
+        for (n, dtype) in zip(_nodes(node), entry.types):
+            env.types.set(n, dtype)
+        return
+
+    cache.misses += 1
+    start = len(env.diagnostics)
+    _check_body(node, env)
+    errors = [ (d.lineno - node.lineno if d.lineno else d.lineno, d.message) for d in env.diagnostics[start:] ]
+    types = [ env.types.get(n) for n in _nodes(node) ]
+    cache.set(key, _Entry(node.lineno, _dump(node), names, calls, dependencies, errors, types))
+
+def _nodes(node: Node):
+    yield node
+    for value in vars(node).values():
+        # skip the callee the resolver gives calls
+        if isinstance(value, FunctionDefinition):
+            continue
+        if isinstance(value, Node):
+            yield from _nodes(value)
+        elif isinstance(value, list):
+            for v in value:
+                if isinstance(v, Node):
+                    yield from _nodes(v)
+
+def _names(node: FunctionDefinition) -> tuple[list[str], list[str]]:
+    # definitions depend on the globals too, as redefining one is an error
+    names = set()
+    calls = set()
+    for n in _nodes(node):
+        if isinstance(n, Location) and n.frame != LOCAL:
+            names.add(n.name)
+        elif isinstance(n, VarDefinition | ConstDefinition):
+            names.add(n.location.name)
+        elif isinstance(n, FunctionCall):
+            calls.add(n.name)
+    return (sorted(names), sorted(calls))
+
+def _dependencies(names: list[str], calls: list[str], env: Env, defined: dict) -> tuple:
+    '''
+    What checking a function reads besides its own tokens: the type and
+    mutability of the globals it names, and the signatures of the
+    functions it calls
+    '''
+    def state(name: str):
+        binding = defined.get(name)
+        return (env.getRegister(binding), env.isMutable(binding)) if binding is not None else None
+
+    return ( tuple( state(name) for name in names ), tuple( env.getFunction(name) for name in calls ) )
+
+class _Pickler(pickle.Pickler):
+    # the functions that calls were resolved to aren't part of the tree;
+    # resolve_program sets them again
+    def persistent_id(self, obj):
+        if isinstance(obj, FunctionDefinition) and obj is not self.root:
+            return obj.name
+        return None
+
+class _Unpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        return None
+
+def _dump(node: FunctionDefinition) -> bytes:
+    file = io.BytesIO()
+    pickler = _Pickler(file, pickle.HIGHEST_PROTOCOL)
+    pickler.root = node
+    pickler.dump(node)
+    return file.getvalue()
+
+def _load(entry: _Entry, lineno: int) -> FunctionDefinition:
+    node = _Unpickler(io.BytesIO(entry.tree)).load()
+    if lineno != entry.lineno:
+        for n in _nodes(node):
+            if n.lineno:
+                n.lineno += lineno - entry.lineno
+    return node
 
 def _binops(left: DType, op: BinOpType, right: DType) -> DType | None:
+    if is_array(left) or is_array(right):
+        return _array_binops(left, op, right)
+
     if left != right:
         return None
     
@@ -125,7 +472,23 @@ def _binops(left: DType, op: BinOpType, right: DType) -> DType | None:
 
     return None
 
+def _array_binops(left: DType, op: BinOpType, right: DType) -> DType | None:
+    '''
+    Arithmetic is element-wise, between arrays of the same type or an
+    array and a value of its element type
+    '''
+    array = left if is_array(left) else right
+    element = element_type(array)
+    if op not in ['+', '-', '*', '/'] or element not in ['int', 'float']:
+        return None
+    if left not in [array, element] or right not in [array, element]:
+        return None
+    return array
+
 def _unops(op: BinOpType, expr: DType) -> DType | None:
+    if is_array(expr) and element_type(expr) in ['int', 'float'] and op in ['+', '-']:
+        return expr
+
     match expr:
         case 'int':
             if op in ['+', '-']: return 'int'
@@ -139,6 +502,8 @@ def _unops(op: BinOpType, expr: DType) -> DType | None:
 def _dtype(dtype: DType) -> DType | None:
     if dtype in ['int', 'float', 'char', 'bool', 'unit']:
         return dtype
+    elif is_array(dtype) and element_type(dtype) in ArrayElementTypes and array_size(dtype) > 0:
+        return dtype
     else:
         return None
 
@@ -161,7 +526,7 @@ def _check_literal(node: LiteralT, env: Env):
     if isinstance(node, Bool): dtype = "bool"
     if isinstance(node, Unit): dtype = "unit"
 
-    node.p_type = dtype
+    env.setType(node, dtype)
     return dtype
 
 @rule(BinOp)
@@ -171,9 +536,9 @@ def _check_binop(node: BinOp, env: Env):
 
     result_type = _binops(left_type, node.op, right_type)
     if not result_type:
-        error(node.lineno, f"Unsupported operation: {left_type} {node.op} {right_type}")
+        env.error(node.lineno, f"Unsupported operation: {left_type} {node.op} {right_type}")
 
-    node.p_type = 'bool' if node.op in ['<', '>', '<=', '>=', '==', '!=', '&&', '||'] else right_type
+    env.setType(node, 'bool' if node.op in ['<', '>', '<=', '>=', '==', '!=', '&&', '||'] else result_type or right_type)
 
     return result_type
 
@@ -183,29 +548,29 @@ def _check_unop(node: UnOp, env: Env):
 
     result_type = _unops(node.op, expr_type)
     if not result_type:
-        error(node.lineno, f"Unsupported operation: {node.op}{expr_type}")
+        env.error(node.lineno, f"Unsupported operation: {node.op}{expr_type}")
 
-    node.p_type = expr_type
+    env.setType(node, expr_type)
 
     return result_type
 
 @rule(PrintStatement)
 def _check_print_statement(node: PrintStatement, env: Env):
     ty = _check(node.expr, env)
-    node.p_type = ty
+    env.setType(node, ty)
 
-    if ty not in [*DataTypes, None]:
-        error(node.lineno, f"Unsupported type {ty!r} with print")    
+    if ty not in [*DataTypes, None] and not is_array(ty):
+        env.error(node.lineno, f"Unsupported type {ty!r} with print")    
 
 @rule(Location)
 def _check_location(node: Location, env: Env):
-    register = env.getRegister(node.name)
+    register = env.getRegister(node.binding)
     if not register:
-        error(node.lineno, f"{node.name} not defined!")
+        env.error(node.lineno, f"{node.name} not defined!")
 
-    node.p_type = register[0] if register else None
+    env.setType(node, register[0] if register else None)
 
-    return node.p_type
+    return env.getType(node)
 
 @rule(VarDefinition)
 @rule(ConstDefinition)
@@ -214,11 +579,11 @@ def _check_definition(node: VarDefinition | ConstDefinition, env: Env):
 
     has_error = False
     if name in ['break', 'const', 'continue', 'else', 'enum', 'import', 'false', 'func', 'if', 'let', 'match', 'return', 'struct', 'true', 'while', 'var']:
-        error(node.lineno, f"{name} is a reserved word in wabbit language!")
+        env.error(node.lineno, f"{name} is a reserved word in wabbit language!")
         has_error = True
 
-    if not has_error and env.getRegister(node.location.name):
-        error(node.lineno, f"{node.location.name} already defined!")
+    if not has_error and node.redefines:
+        env.error(node.lineno, f"{node.location.name} already defined!")
         has_error = True
 
     if node.value:
@@ -229,126 +594,138 @@ def _check_definition(node: VarDefinition | ConstDefinition, env: Env):
     if not dtype:
         has_error = True
     elif not _dtype(dtype):
-        error(node.lineno, f'{dtype} is not a valid type')
+        env.error(node.lineno, f'{dtype} is not a valid type')
         has_error = True
 
     if not has_error and node.value and node.dtype and dtype != node.dtype:
-        error(node.lineno, f"Type error in initialization. {node.dtype} != {dtype}")
+        env.error(node.lineno, f"Type error in initialization. {node.dtype} != {dtype}")
 
-    env.createRegister(name, isinstance(node, VarDefinition), dtype)
+    env.createRegister(node.location.binding, isinstance(node, VarDefinition), dtype)
 
 @rule(AssignmentStatement)
 def _check_assignmentstatement(node: AssignmentStatement, env: Env):
     loc_type = _check(node.location, env)
     val_type = _check(node.value, env)
 
-    node.p_type = val_type
+    env.setType(node, val_type)
 
     has_error = False
-    if not has_error and not env.isMutable(node.location.name):
-        error(node.lineno, "Can't assign to const")
+    if not has_error and not env.isMutable(node.location.binding):
+        env.error(node.lineno, "Can't assign to const")
         has_error = True
 
     if not has_error and loc_type != val_type:
-        error(node.lineno, f"Type error in assignment. {loc_type} != {val_type}")
+        env.error(node.lineno, f"Type error in assignment. {loc_type} != {val_type}")
 
 @rule(IfStatement)
 def _check_ifstatement(node: IfStatement, env: Env):
     cmp_type = _check(node.cmp, env)
     if cmp_type != 'bool':
-        error(node.lineno, f"if test must be bool. Got {cmp_type}")
+        env.error(node.lineno, f"if test must be bool. Got {cmp_type}")
 
     env.setTypeScope('if')
     b_type = _check_blockstatement(node.block_if, env)
+    env.popTypeScope()
 
     if node.block_else:
         env.setTypeScope('else')
         _check_blockstatement(node.block_else, env)
+        env.popTypeScope()
 
-    node.p_type = b_type
+    env.setType(node, b_type)
 
 @rule(WhileStatement)
 def _check_whilestatement(node: WhileStatement, env: Env):
     cmp_type = _check(node.cmp, env)
     if cmp_type and cmp_type != 'bool':
-        error(node.lineno, f"while test must be bool. Got {cmp_type}")
+        env.error(node.lineno, f"while test must be bool. Got {cmp_type}")
 
     env.setTypeScope('while')
     _check(node.body, env)
+    env.popTypeScope()
 
 @rule(Break)
 @rule(Continue)
 def _interpret_breakcontinue(node: Break | Continue, env: Env):
     if not env.getInLoop():
-        error(node.lineno, f"{'break' if isinstance(node, Break) else 'continue'} used outside of while loop")
+        env.error(node.lineno, f"{'break' if isinstance(node, Break) else 'continue'} used outside of while loop")
 
 @rule(CompoundExpression)
 def _check_compoundexpression(node: CompoundExpression, env: Env):
     env.setTypeScope('compoundexpression')
-    env.newScope()
 
     for inst in node.instructions[:-1]:
         _check(inst, env)
 
     r_type = _check(node.instructions[-1], env)
 
-    env.popScope()
+    env.popTypeScope()
 
-    node.p_type = r_type
+    env.setType(node, r_type)
 
     return r_type;
 
 @rule(BlockStatement)
 def _check_blockstatement(node: BlockStatement, env: Env):
-    env.newScope()
-
     has_error = False
     for inst in node.instructions:
         _check(inst, env)
 
         ret_type, ret_lineno = env.getReturnType()
         if not has_error and ret_lineno and ret_type != env.expectRetType:
-            error(ret_lineno, f"Type error in return")
+            env.error(ret_lineno, f"Type error in return")
             has_error = True
 
     if isinstance(node.instructions[-1], LiteralT):
-        node.p_type = node.instructions[-1].p_type
+        env.setType(node, env.getType(node.instructions[-1]))
     else:
-        node.p_type = None
+        env.setType(node, None)
 
-    env.popScope(False)
-
-    return node.p_type
+    return env.getType(node)
 
 @rule(FunctionParam)
 def _check_functionparam(node: FunctionParam, env: Env):
-    env.createRegister(node.name, True, node.dtype)
+    env.createRegister(node.binding, True, node.dtype)
     return (node.dtype, )
 
 @rule(FunctionDefinition)
 def _check_functiondefinition(node: FunctionDefinition, env: Env):
+    if _check_signature(node, env):
+        _check_body(node, env)
+
+def _check_signature(node: FunctionDefinition, env: Env) -> bool:
+    '''
+    Check the return type and declare the function; False when its body
+    can't be checked
+    '''
     if not _dtype(node.ret):
-        error(node.lineno, f'{node.ret} is not a valid type')
-        return
+        env.error(node.lineno, f'{node.ret} is not a valid type')
+        return False
 
     if env.getInFunction():
-        error(node.lineno, f'Nested functions are not supported')
-        return
+        env.error(node.lineno, f'Nested functions are not supported')
+        return False
+
+    env.setFunction(node.name, tuple( p.dtype for p in node.params ) + (node.ret, ))
+    return True
+
+def _check_apart(tree: bytes, env: Env) -> tuple[list[Diagnostic], list]:
+    # check the body of a function pickled by _dump, in another process;
+    # its types come back in the order _nodes gives them
+    node = _Unpickler(io.BytesIO(tree)).load()
+    _check_body(node, env)
+    return env.diagnostics, [ env.types.get(n) for n in _nodes(node) ]
 
-    env.newScope()
+def _check_body(node: FunctionDefinition, env: Env):
     env.setTypeScope('function')
 
-    dtype = ()
     for p in node.params:
-        dtype += _check_functionparam(p, env)
-    dtype += (node.ret, )
+        _check_functionparam(p, env)
 
     env.expectRetType = node.ret
-    env.setFunction(node.name, dtype)
-
     _check_blockstatement(node.body, env)
 
-    env.popScope()
+    env.popTypeScope()
     env.expectRetType = None
 
 @rule(FunctionCall)
@@ -357,7 +734,7 @@ def _check_functioncall(node: FunctionCall, env: Env):
 
     has_error = False
     if not function_type:
-        error(node.lineno, f'{node.name} not defined!')
+        env.error(node.lineno, f'{node.name} not defined!')
         has_error = True
 
     if has_error: return None
@@ -371,23 +748,23 @@ def _check_functioncall(node: FunctionCall, env: Env):
         argstype += (_check(a, env),)
 
     if len(params_type) != len(argstype):
-        error(node.lineno, f"Wrong # arguments. Expected {len(params_type)}.")
+        env.error(node.lineno, f"Wrong # arguments. Expected {len(params_type)}.")
         has_error = True
 
     if not has_error:
         for i in range( len(params_type) ):
             if params_type[i] != argstype[i]:
-                error(node.lineno, f"Type error in argument {i+1}. Expected {params_type[i]}")
+                env.error(node.lineno, f"Type error in argument {i+1}. Expected {params_type[i]}")
                 break
 
-    node.p_type = return_type
+    env.setType(node, return_type)
 
     return return_type
 
 @rule(ReturnStatement)
 def _check_returnstatement(node: ReturnStatement, env: Env):
     if not env.getInFunction():
-        error(node.lineno, 'Return used outside of function')
+        env.error(node.lineno, 'Return used outside of function')
         return None
 
     dtype = 'unit'
@@ -396,4 +773,75 @@ def _check_returnstatement(node: ReturnStatement, env: Env):
 
     env.setReturnType(dtype, node.lineno)
 
-    return dtype
\ No newline at end of file
+    return dtype
+
+@rule(ArrayLiteral)
+def _check_arrayliteral(node: ArrayLiteral, env: Env):
+    types = [ _check(e, env) for e in node.elements ]
+
+    dtype = types[0]
+    if dtype not in ArrayElementTypes:
+        env.error(node.lineno, f"Arrays of {dtype} are not supported")
+        return None
+    if any( t != dtype for t in types ):
+        env.error(node.lineno, f"Array elements must have the same type. Expected {dtype}")
+        return None
+
+    env.setType(node, array_type(len(types), dtype))
+    return env.getType(node)
+
+def _check_index(dtype: DType | None, index: Expression, lineno: int, env: Env) -> bool:
+    index_type = _check(index, env)
+    if not dtype:
+        return False
+    if not is_array(dtype):
+        env.error(lineno, f"{dtype} is not an array")
+        return False
+    if index_type != 'int':
+        env.error(lineno, f"Array index must be int. Got {index_type}")
+        return False
+    if isinstance(index, Integer) and not 0 <= index.value < array_size(dtype):
+        env.error(lineno, f"Index {index.value} out of range for {dtype}")
+        return False
+    return True
+
+@rule(Index)
+def _check_index_expression(node: Index, env: Env):
+    dtype = _check(node.array, env)
+    if not _check_index(dtype, node.index, node.lineno, env):
+        return None
+
+    env.setType(node, element_type(dtype))
+    return env.getType(node)
+
+@rule(IndexAssignment)
+def _check_indexassignment(node: IndexAssignment, env: Env):
+    dtype = _check(node.location, env)
+    val_type = _check(node.value, env)
+    if not _check_index(dtype, node.index, node.lineno, env):
+        return
+
+    env.setType(node, element_type(dtype))
+    if not env.isMutable(node.location.binding):
+        env.error(node.lineno, "Can't assign to const")
+    elif val_type != env.getType(node):
+        env.error(node.lineno, f"Type error in assignment. {env.getType(node)} != {val_type}")
+
+@rule(ArrayFunction)
+def _check_arrayfunction(node: ArrayFunction, env: Env):
+    dtype = _check(node.expr, env)
+    if not dtype:
+        return None
+    if not is_array(dtype):
+        env.error(node.lineno, f"{node.name} expects an array. Got {dtype}")
+        return None
+
+    if node.name == 'len':
+        env.setType(node, 'int')
+    elif element_type(dtype) in ['int', 'float']:
+        env.setType(node, element_type(dtype))
+    else:
+        env.error(node.lineno, f"Unsupported operation: {node.name}({dtype})")
+        return None
+
+    return env.getType(node)
@@ -0,0 +1,494 @@
+from array import array
+from functools import singledispatch
+
+from .model import *
+from .resolve import resolve_program
+from .interp import inf_int, inf_float, valueType, formatValue
+from .output import Output, BufferedOutput
+
+
+# Opcodes. Every instruction is an (opcode, argument) pair of the code array.
+(
+    CONST,                  # push consts[arg]
+    LOAD_LOCAL,             # push frame[arg]
+    STORE_LOCAL,            # frame[arg] = pop
+    LOAD_GLOBAL,            # push globals[arg]
+    STORE_GLOBAL,           # globals[arg] = pop
+    ADD,
+    SUB,
+    MUL,
+    IDIV,
+    FDIV,
+    DIV,                    # division of an unchecked model
+    LT,
+    GT,
+    LE,
+    GE,
+    EQ,
+    NE,
+    NEG,
+    NOT,
+    JUMP,                   # pc = arg
+    JUMP_IF_FALSE,          # pc = arg if not pop
+    JUMP_IF_FALSE_OR_POP,   # &&: keep the left operand if it decides
+    JUMP_IF_TRUE_OR_POP,    # ||
+    POP,
+    PRINT,
+    PRINT_BOOL,
+    PRINT_CHAR,
+    CALL,                   # call functions[arg] with its arguments on the stack
+    RETURN,
+    HALT,
+) = range(30)
+
+OPNAMES = [
+    'CONST', 'LOAD_LOCAL', 'STORE_LOCAL', 'LOAD_GLOBAL', 'STORE_GLOBAL',
+    'ADD', 'SUB', 'MUL', 'IDIV', 'FDIV', 'DIV',
+    'LT', 'GT', 'LE', 'GE', 'EQ', 'NE', 'NEG', 'NOT',
+    'JUMP', 'JUMP_IF_FALSE', 'JUMP_IF_FALSE_OR_POP', 'JUMP_IF_TRUE_OR_POP',
+    'POP', 'PRINT', 'PRINT_BOOL', 'PRINT_CHAR', 'CALL', 'RETURN', 'HALT',
+]
+
+
+class Code:
+    '''
+    Bytecode of a function, or of the top-level statements
+    '''
+    def __init__(self, name: str, nparams: int = 0):
+        self.name = name
+        self.nparams = nparams
+        self.locals = []
+        self.code = array('i')
+
+    def __len__(self):
+        return len(self.code) // 2
+
+    def emit(self, op: int, arg: int = 0) -> int:
+        self.code.append(op)
+        self.code.append(arg)
+        return len(self.code) - 2
+
+    def label(self) -> int:
+        return len(self.code)
+
+    def patch(self, at: int, target: int):
+        self.code[at + 1] = target
+
+
+class Program:
+    def __init__(self):
+        self.consts = []
+        self.functions: list[Code] = []
+        self.names: dict[str, int] = {}
+        self.toplevel = Code('<toplevel>')
+        self.nglobals = 0
+
+    def instructions(self) -> int:
+        return len(self.toplevel) + sum( len(f) for f in self.functions )
+
+
+class Context:
+    def __init__(self, program: Program, types: Types | None = None):
+        self.program = program
+        self.types = types or Types()
+        self.code = program.toplevel
+        self._consts = {}
+        self._functions = {}
+
+        # jumps of the innermost loop to patch, and where it starts
+        self.breaks = None
+        self.cmp_label = None
+
+    def const(self, value) -> int:
+        key = (type(value), value)
+        if key not in self._consts:
+            self._consts[key] = len(self.program.consts)
+            self.program.consts.append(value)
+        return self._consts[key]
+
+    def getFunction(self, node: FunctionDefinition) -> int:
+        if node not in self._functions:
+            self._functions[node] = len(self.program.functions)
+            self.program.functions.append( Code(node.name, len(node.params)) )
+        return self._functions[node]
+
+
+def compile_program(model: list[Node], types: Types | None = None) -> Program:
+    '''
+    Lower the model into bytecode for the VM. types are those check_model
+    found for the model.
+    '''
+    program = Program()
+    program.nglobals = resolve_program(model)
+
+    ctx = Context(program, types)
+    for n in model:
+        _statement(n, ctx)
+
+    # the top-level statements end by running main
+    if 'main' in program.names:
+        ctx.code.emit(CALL, program.names['main'])
+        ctx.code.emit(RETURN)
+    else:
+        ctx.code.emit(HALT)
+
+    return program
+
+def run_program(program: Program, out: Output | None = None):
+    return VM(program, out).run()
+
+
+class VM:
+    '''
+    Runs a program, printing to out, a BufferedOutput on sys.stdout by
+    default, so that many VMs in one process keep their output apart
+    '''
+    def __init__(self, program: Program, out: Output | None = None):
+        self.program = program
+        self.out = out if out is not None else BufferedOutput()
+        self.globals = [None] * program.nglobals
+        # number of instructions executed so far
+        self.steps = 0
+        self.done = False
+        self.result = None
+
+        # the top-level code goes after the functions
+        self.codes = [ _dispatchable(f.code) for f in program.functions ]
+        self.codes.append( _dispatchable(program.toplevel.code) )
+
+        # (function, pc, frame, stack, calls) where execution continues
+        self.state = (len(program.functions), 0, self.globals, [], [])
+
+    def run(self):
+        '''
+        Run the top-level statements and then main, returning its value
+        '''
+        try:
+            while not self.done:
+                self.resume()
+        finally:
+            self.out.flush()
+        return self.result
+
+    def resume(self, limit: int | None = None) -> bool:
+        '''
+        Continue running for about limit more instructions, or until the
+        end. The budget is checked on backward jumps and calls, so a slice
+        overshoots by at most one loop body. Returns True once finished.
+
+        Wabbit calls don't recurse on the Python stack: CALL saves the
+        caller in calls and RETURN resumes it, so recursion depth is
+        bounded only by memory.
+        '''
+        (fn, pc, frame, stack, calls) = self.state
+        consts = self.program.consts
+        functions = self.program.functions
+        codes = self.codes
+        glob = self.globals
+        write = self.out.write
+
+        code = codes[fn]
+        push = stack.append
+        pop = stack.pop
+        steps = 0
+        if limit is None:
+            limit = float('inf')
+
+        while True:
+            op = code[pc]
+            arg = code[pc + 1]
+            pc += 2
+            steps += 1
+
+            if op == LOAD_LOCAL:
+                push(frame[arg])
+            elif op == CONST:
+                push(consts[arg])
+            elif op == STORE_LOCAL:
+                frame[arg] = pop()
+            elif op == JUMP_IF_FALSE:
+                if not pop(): pc = arg
+            elif op == JUMP:
+                pc = arg
+                if steps >= limit: break
+            elif op == ADD:
+                b = pop(); stack[-1] = stack[-1] + b
+            elif op == SUB:
+                b = pop(); stack[-1] = stack[-1] - b
+            elif op == MUL:
+                b = pop(); stack[-1] = stack[-1] * b
+            elif op == LT:
+                b = pop(); stack[-1] = stack[-1] < b
+            elif op == GT:
+                b = pop(); stack[-1] = stack[-1] > b
+            elif op == LE:
+                b = pop(); stack[-1] = stack[-1] <= b
+            elif op == GE:
+                b = pop(); stack[-1] = stack[-1] >= b
+            elif op == EQ:
+                b = pop(); stack[-1] = stack[-1] == b
+            elif op == NE:
+                b = pop(); stack[-1] = stack[-1] != b
+            elif op == LOAD_GLOBAL:
+                push(glob[arg])
+            elif op == STORE_GLOBAL:
+                glob[arg] = pop()
+            elif op == CALL:
+                callee = functions[arg]
+                base = len(stack) - callee.nparams
+                calls.append( (fn, pc, frame, base) )
+                frame = stack[base:]
+                del stack[base:]
+                frame += callee.locals
+                fn = arg
+                code = codes[fn]
+                pc = 0
+                if steps >= limit: break
+            elif op == RETURN:
+                if not calls:
+                    self.result = pop()
+                    self.done = True
+                    break
+                value = pop()
+                (fn, pc, frame, base) = calls.pop()
+                code = codes[fn]
+                del stack[base:]
+                push(value)
+            elif op == IDIV:
+                b = pop(); stack[-1] = int(stack[-1] / b) if b != 0 else inf_int
+            elif op == FDIV:
+                b = pop(); stack[-1] = stack[-1] / b if b != 0 else inf_float
+            elif op == DIV:
+                b = pop()
+                if valueType(stack[-1]) == 'int':
+                    stack[-1] = int(stack[-1] / b) if b != 0 else inf_int
+                else:
+                    stack[-1] = stack[-1] / b if b != 0 else inf_float
+            elif op == NEG:
+                stack[-1] = -stack[-1]
+            elif op == NOT:
+                stack[-1] = not stack[-1]
+            elif op == JUMP_IF_FALSE_OR_POP:
+                if not stack[-1]: pc = arg
+                else: pop()
+            elif op == JUMP_IF_TRUE_OR_POP:
+                if stack[-1]: pc = arg
+                else: pop()
+            elif op == POP:
+                pop()
+            elif op == PRINT:
+                write(formatValue(pop(), None))
+            elif op == PRINT_BOOL:
+                write(formatValue(pop(), 'bool'))
+            elif op == PRINT_CHAR:
+                write(formatValue(pop(), 'char'))
+            elif op == HALT:
+                self.done = True
+                break
+            else:
+                raise RuntimeError(f"Bad opcode {op}")
+
+        self.steps += steps
+        self.state = (fn, pc, frame, stack, calls)
+        if self.done:
+            self.out.flush()
+        return self.done
+
+
+def _dispatchable(code: array | memoryview):
+    # lists are faster to index than arrays, but the code of a loaded .wbc
+    # file is run in place so that it isn't copied out of the mapping
+    if isinstance(code, memoryview):
+        return code
+    return code.tolist()
+
+
+def disassemble(program: Program) -> str:
+    lines = []
+    for function in [ program.toplevel, *program.functions ]:
+        lines.append(f'{function.name}:')
+        code = function.code
+        for pc in range(0, len(code), 2):
+            op, arg = code[pc], code[pc + 1]
+            text = f'    {pc:5} {OPNAMES[op]:22} {arg}'
+            if op == CONST:
+                text += f' ({program.consts[arg]!r})'
+            lines.append(text)
+    return '\n'.join(lines)
+
+
+def _statement(node: Node, ctx: Context):
+    _compile(node, ctx)
+    if isinstance(node, Expression):
+        ctx.code.emit(POP)
+
+def _store(node: Location, ctx: Context):
+    ctx.code.emit(STORE_LOCAL if node.frame else STORE_GLOBAL, node.slot)
+
+
+@singledispatch
+def _compile(node: Node, ctx: Context):
+    raise RuntimeError(f"Can't compile {node}")
+
+rule = _compile.register
+
+@rule(Integer)
+@rule(Float)
+@rule(Char)
+@rule(Bool)
+@rule(Unit)
+def _compile_literal(node: LiteralT, ctx: Context):
+    ctx.code.emit(CONST, ctx.const(node.value))
+
+@rule(Break)
+def _compile_break(node: Break, ctx: Context):
+    ctx.breaks.append( ctx.code.emit(JUMP) )
+
+@rule(Continue)
+def _compile_continue(node: Continue, ctx: Context):
+    ctx.code.emit(JUMP, ctx.cmp_label)
+
+@rule(PrintStatement)
+def _compile_print(node: PrintStatement, ctx: Context):
+    _compile(node.expr, ctx)
+    match ctx.types.get(node):
+        case 'bool': ctx.code.emit(PRINT_BOOL)
+        case 'char': ctx.code.emit(PRINT_CHAR)
+        case _: ctx.code.emit(PRINT)
+
+@rule(UnOp)
+def _compile_unop(node: UnOp, ctx: Context):
+    _compile(node.expr, ctx)
+    match node.op:
+        case '-': ctx.code.emit(NEG)
+        case '!': ctx.code.emit(NOT)
+
+@rule(BinOp)
+def _compile_binop(node: BinOp, ctx: Context):
+    _compile(node.left, ctx)
+
+    if node.op in ['&&', '||']:
+        jump = ctx.code.emit(JUMP_IF_FALSE_OR_POP if node.op == '&&' else JUMP_IF_TRUE_OR_POP)
+        _compile(node.right, ctx)
+        ctx.code.patch(jump, ctx.code.label())
+        return
+
+    _compile(node.right, ctx)
+    p_type = ctx.types.get(node)
+
+    match node.op:
+        case '+': ctx.code.emit(ADD)
+        case '-': ctx.code.emit(SUB)
+        case '*': ctx.code.emit(MUL)
+        case '<': ctx.code.emit(LT)
+        case '>': ctx.code.emit(GT)
+        case '<=': ctx.code.emit(LE)
+        case '>=': ctx.code.emit(GE)
+        case '==': ctx.code.emit(EQ)
+        case '!=': ctx.code.emit(NE)
+        case '/' if p_type == 'int': ctx.code.emit(IDIV)
+        case '/' if p_type == 'float': ctx.code.emit(FDIV)
+        case '/': ctx.code.emit(DIV)
+
+@rule(Location)
+def _compile_location(node: Location, ctx: Context):
+    ctx.code.emit(LOAD_LOCAL if node.frame else LOAD_GLOBAL, node.slot)
+
+@rule(VarDefinition)
+@rule(ConstDefinition)
+def _compile_definition(node: VarDefinition | ConstDefinition, ctx: Context):
+    if node.value:
+        _compile(node.value, ctx)
+    elif is_array(node.dtype):
+        raise RuntimeError(f"{node.lineno}: Can't compile arrays, use interpret_program")
+    else:
+        ctx.code.emit(CONST, ctx.const('()' if node.dtype == 'unit' else None))
+    _store(node.location, ctx)
+
+@rule(ArrayLiteral)
+@rule(Index)
+@rule(IndexAssignment)
+@rule(ArrayFunction)
+def _compile_array(node: Expression | IndexAssignment, ctx: Context):
+    raise RuntimeError(f"{node.lineno}: Can't compile arrays, use interpret_program")
+
+@rule(AssignmentStatement)
+def _compile_assignment(node: AssignmentStatement, ctx: Context):
+    _compile(node.value, ctx)
+    _store(node.location, ctx)
+
+@rule(BlockStatement)
+def _compile_blockstatement(node: BlockStatement, ctx: Context):
+    for inst in node.instructions:
+        _statement(inst, ctx)
+
+@rule(IfStatement)
+def _compile_ifstatement(node: IfStatement, ctx: Context):
+    _compile(node.cmp, ctx)
+    jump_else = ctx.code.emit(JUMP_IF_FALSE)
+    _compile_blockstatement(node.block_if, ctx)
+
+    if node.block_else:
+        jump_end = ctx.code.emit(JUMP)
+        ctx.code.patch(jump_else, ctx.code.label())
+        _compile_blockstatement(node.block_else, ctx)
+        ctx.code.patch(jump_end, ctx.code.label())
+    else:
+        ctx.code.patch(jump_else, ctx.code.label())
+
+@rule(WhileStatement)
+def _compile_whilestatement(node: WhileStatement, ctx: Context):
+    breaks, cmp_label = ctx.breaks, ctx.cmp_label
+    ctx.breaks = []
+    ctx.cmp_label = ctx.code.label()
+
+    _compile(node.cmp, ctx)
+    ctx.breaks.append( ctx.code.emit(JUMP_IF_FALSE) )
+    _compile_blockstatement(node.body, ctx)
+    ctx.code.emit(JUMP, ctx.cmp_label)
+
+    for jump in ctx.breaks:
+        ctx.code.patch(jump, ctx.code.label())
+
+    ctx.breaks, ctx.cmp_label = breaks, cmp_label
+
+@rule(CompoundExpression)
+def _compile_compoundexpression(node: CompoundExpression, ctx: Context):
+    for inst in node.instructions[:-1]:
+        _statement(inst, ctx)
+
+    last = node.instructions[-1]
+    _compile(last, ctx)
+    if not isinstance(last, Expression):
+        ctx.code.emit(CONST, ctx.const(None))
+
+@rule(FunctionDefinition)
+def _compile_functiondefinition(node: FunctionDefinition, ctx: Context):
+    index = ctx.getFunction(node)
+    ctx.program.names[node.name] = index
+
+    function = ctx.program.functions[index]
+    function.locals = node.locals
+
+    saved = (ctx.code, ctx.breaks, ctx.cmp_label)
+    ctx.code, ctx.breaks, ctx.cmp_label = function, None, None
+
+    _compile_blockstatement(node.body, ctx)
+    function.emit(CONST, ctx.const('()'))
+    function.emit(RETURN)
+
+    ctx.code, ctx.breaks, ctx.cmp_label = saved
+
+@rule(FunctionCall)
+def _compile_functioncall(node: FunctionCall, ctx: Context):
+    for a in node.args:
+        _compile(a, ctx)
+    ctx.code.emit(CALL, ctx.getFunction(node.function))
+
+@rule(ReturnStatement)
+def _compile_returnstatement(node: ReturnStatement, ctx: Context):
+    if node.expr is not None:
+        _compile(node.expr, ctx)
+    else:
+        ctx.code.emit(CONST, ctx.const('()'))
+    ctx.code.emit(RETURN)
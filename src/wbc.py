@@ -0,0 +1,296 @@
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from .tokenize import tokenize
+from .parse import WabbitParser
+from .typecheck import check_program
+from .vm import (Code, Program, compile_program, OPNAMES, CONST, LOAD_LOCAL, STORE_LOCAL,
+                 LOAD_GLOBAL, STORE_GLOBAL, JUMP, JUMP_IF_FALSE, JUMP_IF_FALSE_OR_POP,
+                 JUMP_IF_TRUE_OR_POP, CALL, RETURN, HALT)
+
+
+# Precompiled program files (.wbc), the VM counterpart of .pyc files.
+#
+#   header    magic, version, sha256 of the source
+#   consts    count, then a tag byte and a payload per constant
+#   globals   size of the global frame
+#   names     count, then (function name, function index)
+#   code      toplevel and then every function: name, nparams, nlocals
+#             and its instructions as little-endian int32, 4-byte aligned
+#
+# Bump VERSION whenever the layout or the vm opcodes change.
+
+MAGIC = b'WBC\x00'
+VERSION = 2
+
+_HEADER = struct.Struct('<4sH32s')
+
+_NONE, _INT, _FLOAT, _BOOL, _STR, _BIGINT = range(6)
+
+
+def source_hash(source: str) -> bytes:
+    return hashlib.sha256(source.encode('utf-8')).digest()
+
+
+class _Writer:
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def write(self, data: bytes):
+        self.parts.append(data)
+        self.size += len(data)
+
+    def pack(self, fmt: str, *values):
+        self.write(struct.pack(fmt, *values))
+
+    def string(self, text: str):
+        data = text.encode('utf-8')
+        self.pack('<I', len(data))
+        self.write(data)
+
+    def align(self):
+        self.write(b'\x00' * (-self.size % 4))
+
+    def code(self, function: Code):
+        self.string(function.name)
+        self.pack('<III', function.nparams, len(function.locals), len(function.code))
+        self.align()
+
+        code = array('i', function.code)
+        if sys.byteorder != 'little':
+            code.byteswap()
+        self.write(code.tobytes())
+
+
+class _Reader:
+    def __init__(self, buffer: memoryview):
+        self.buffer = buffer
+        self.offset = 0
+
+    def unpack(self, fmt: str):
+        values = struct.unpack_from(fmt, self.buffer, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return values
+
+    def string(self) -> str:
+        (size, ) = self.unpack('<I')
+        if self.offset + size > len(self.buffer):
+            raise struct.error('truncated string')
+        text = str(self.buffer[self.offset:self.offset + size], 'utf-8')
+        self.offset += size
+        return text
+
+    def align(self):
+        self.offset += -self.offset % 4
+
+    def code(self) -> Code:
+        name = self.string()
+        (nparams, nlocals, size) = self.unpack('<III')
+        self.align()
+
+        # every local is stored by at least one instruction
+        if self.offset + size * 4 > len(self.buffer) or nlocals > size:
+            raise struct.error('truncated code')
+
+        function = Code(name, nparams)
+        function.locals = [None] * nlocals
+
+        data = self.buffer[self.offset:self.offset + size * 4]
+        if sys.byteorder == 'little':
+            # the instructions stay in the mapped file
+            function.code = data.cast('i')
+        else:
+            function.code = array('i', data.tobytes())
+            function.code.byteswap()
+        self.offset += size * 4
+
+        return function
+
+
+def dump_program(program: Program, source: str) -> bytes:
+    '''
+    Encode a compiled program, tagged with the hash of its source
+    '''
+    out = _Writer()
+    out.write(_HEADER.pack(MAGIC, VERSION, source_hash(source)))
+
+    out.pack('<I', len(program.consts))
+    for value in program.consts:
+        if value is None:
+            out.pack('<B', _NONE)
+        elif isinstance(value, bool):
+            out.pack('<B?', _BOOL, value)
+        elif isinstance(value, int) and -2**63 <= value < 2**63:
+            out.pack('<Bq', _INT, value)
+        elif isinstance(value, int):
+            out.pack('<B', _BIGINT)
+            out.string(str(value))
+        elif isinstance(value, float):
+            out.pack('<Bd', _FLOAT, value)
+        else:
+            out.pack('<B', _STR)
+            out.string(value)
+
+    out.pack('<I', program.nglobals)
+
+    out.pack('<I', len(program.names))
+    for name, index in program.names.items():
+        out.string(name)
+        out.pack('<I', index)
+
+    out.pack('<I', len(program.functions))
+    out.code(program.toplevel)
+    for function in program.functions:
+        out.code(function)
+
+    return b''.join(out.parts)
+
+
+def load_buffer(buffer, source: str | None = None) -> Program | None:
+    '''
+    Decode a program from a buffer. Returns None when it was written by
+    another version, is truncated or corrupt or, if source is given, is
+    from a different source. Every instruction is checked here, so the VM
+    can run the code without checking its operands.
+    '''
+    buffer = memoryview(buffer)
+    if len(buffer) < _HEADER.size:
+        return None
+
+    (magic, version, digest) = _HEADER.unpack_from(buffer)
+    if magic != MAGIC or version != VERSION:
+        return None
+    if source is not None and digest != source_hash(source):
+        return None
+
+    try:
+        return _decode(buffer)
+    except (struct.error, UnicodeDecodeError, ValueError):
+        return None
+
+def _decode(buffer: memoryview) -> Program | None:
+    data = _Reader(buffer)
+    data.offset = _HEADER.size
+
+    program = Program()
+
+    (count, ) = data.unpack('<I')
+    for _ in range(count):
+        (tag, ) = data.unpack('<B')
+        if tag == _NONE: value = None
+        elif tag == _INT: (value, ) = data.unpack('<q')
+        elif tag == _FLOAT: (value, ) = data.unpack('<d')
+        elif tag == _BOOL: (value, ) = data.unpack('<?')
+        elif tag == _STR: value = data.string()
+        elif tag == _BIGINT: value = int(data.string())
+        else: return None
+        program.consts.append(value)
+
+    (program.nglobals, ) = data.unpack('<I')
+
+    (count, ) = data.unpack('<I')
+    for _ in range(count):
+        name = data.string()
+        (program.names[name], ) = data.unpack('<I')
+
+    (count, ) = data.unpack('<I')
+    program.toplevel = data.code()
+    for _ in range(count):
+        program.functions.append( data.code() )
+
+    if any( index >= count for index in program.names.values() ):
+        raise ValueError('bad function index')
+    # the top-level code runs in the global frame
+    _verify(program.toplevel, program, program.nglobals)
+    for function in program.functions:
+        _verify(function, program, function.nparams + len(function.locals))
+
+    return program
+
+_JUMPS = (JUMP, JUMP_IF_FALSE, JUMP_IF_FALSE_OR_POP, JUMP_IF_TRUE_OR_POP)
+
+def _verify(function: Code, program: Program, frame: int):
+    '''
+    Raise ValueError unless every opcode of function is known and its
+    operand is in range, and its code can't run past its end
+    '''
+    code = function.code
+    size = len(code)
+    if size % 2 or size == 0 or code[size - 2] not in (RETURN, HALT, JUMP):
+        raise ValueError(f'bad code in {function.name}')
+
+    # opcode -> what its operand must be less than
+    limits = {
+        CONST: len(program.consts),
+        LOAD_LOCAL: frame, STORE_LOCAL: frame,
+        LOAD_GLOBAL: program.nglobals, STORE_GLOBAL: program.nglobals,
+        CALL: len(program.functions),
+    }
+    for jump in _JUMPS:
+        limits[jump] = size
+
+    for pc in range(0, size, 2):
+        (op, arg) = (code[pc], code[pc + 1])
+        if not 0 <= op < len(OPNAMES):
+            raise ValueError(f'bad opcode {op} in {function.name}')
+        limit = limits.get(op)
+        if limit is not None and not 0 <= arg < limit:
+            raise ValueError(f'bad operand {arg} of {OPNAMES[op]} in {function.name}')
+        if op in _JUMPS and arg % 2:
+            raise ValueError(f'bad jump {arg} in {function.name}')
+
+
+def save_program(path: str, program: Program, source: str):
+    data = dump_program(program, source)
+
+    # write aside and rename, so concurrent loaders never see half a file
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as file:
+        file.write(data)
+    os.replace(tmp, path)
+
+
+def load_program(path: str, source: str | None = None) -> Program | None:
+    '''
+    Memory-map a .wbc file and decode it. The code of every function is
+    a view into the mapping, which stays open while the program is alive;
+    the VM runs it from there without copying it.
+    '''
+    try:
+        with open(path, 'rb') as file:
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # missing or empty file
+        return None
+
+    program = load_buffer(mapping, source)
+    if program:
+        program.buffer = mapping
+    return program
+
+
+def compile_file(path: str) -> Program | None:
+    '''
+    Load path's precompiled .wbc file, or run the front end on the source
+    and write it. Returns None when the source doesn't type check.
+    '''
+    with open(path, encoding='utf-8') as file:
+        source = file.read()
+
+    cached = os.path.splitext(path)[0] + '.wbc'
+    program = load_program(cached, source)
+    if program:
+        return program
+
+    ok, model, types = check_program( WabbitParser().parse( tokenize(source) ) )
+    if not ok:
+        return None
+
+    program = compile_program(model, types)
+    save_program(cached, program, source)
+    return program
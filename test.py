@@ -31,16 +31,16 @@ for i in range( len(examples[:3]) ):
     interpret_program(res)
     continue
 
-    ok, res_ch = check_program(res)
+    ok, res_ch, types = check_program(res)
     continue
 
     if ok:
-        res_tm = transform_program(res_ch)
+        res_tm = transform_program(res_ch, types=types)
         print( res_tm )
         print( to_source(res_tm) )
         continue
 
-        mod = generate_program(res_ch)
+        mod = generate_program(res_ch, types=types)
         wabbit_wasm = encode_module(mod.module)
         print(wabbit_wasm)
         with open('wasm/out.wasm', 'wb') as file:
@@ -0,0 +1,45 @@
+from src.typecheck import check_source
+from src.interp import interpret_program
+from src.output import CollectOutput
+
+
+def run(source: str, **options) -> str:
+    (errors, model, types) = check_source(source)
+    assert not errors
+    out = CollectOutput()
+    interpret_program(model, out=out, types=types, **options)
+    return out.getvalue()
+
+
+def test_unary_plus_copies_the_array():
+    source = '''
+    func main() int {
+        var a [3]int = [1, 2, 3];
+        var b = +a;
+        b[0] = 99;
+        print a;
+        print b;
+        return 0;
+    }
+    '''
+    expected = '[1, 2, 3]\n[99, 2, 3]\n'
+    assert run(source, tiered=False) == expected
+    assert run(source) == expected
+
+def test_unary_plus_copies_the_array_in_compiled_code():
+    # f runs often enough to be compiled by the tier
+    source = '''
+    var a [3]int = [1, 2, 3];
+    func f(n int) int {
+        var b = +a;
+        b[0] = n;
+        return b[0];
+    }
+    func main() int {
+        var i = 0;
+        while i < 300 { f(i); i = i + 1; }
+        print a;
+        return 0;
+    }
+    '''
+    assert run(source) == '[1, 2, 3]\n'
@@ -0,0 +1,36 @@
+from src.typecheck import check_source
+from src.interp import interpret_program, interpret_closures
+from src.output import CollectOutput
+from src import vm, pyast
+
+
+MAIN_WITHOUT_RETURN = '''
+func f() int {
+    return 5;
+}
+func main() int {
+    f();
+}
+'''
+
+def check(source: str):
+    (errors, model, types) = check_source(source)
+    assert not errors
+    return model, types
+
+
+def test_main_without_return_gives_unit():
+    (model, types) = check(MAIN_WITHOUT_RETURN)
+    out = CollectOutput()
+    assert interpret_program(model, out=out, types=types) == '()'
+    assert interpret_program(model, tiered=False, out=out, types=types) == '()'
+    assert interpret_closures(model, out=out, types=types) == '()'
+    assert vm.run_program(vm.compile_program(model, types), out) == '()'
+    assert pyast.run_program(model, types) == '()'
+
+def test_main_returns_its_value():
+    (model, types) = check(MAIN_WITHOUT_RETURN.replace('f();', 'return f() + 1;'))
+    out = CollectOutput()
+    assert interpret_program(model, out=out, types=types) == 6
+    assert interpret_closures(model, out=out, types=types) == 6
+    assert vm.run_program(vm.compile_program(model, types), out) == 6
@@ -0,0 +1,33 @@
+import pytest
+
+from src.scan import scan
+from src.tokenize import tokenize
+from src.typecheck import check_source
+
+
+def tokens(toks):
+    return [ (t.type, t.value, t.lineno, t.index, t.end) for t in toks ]
+
+def printed(errors) -> str:
+    # the errors as WabbitLexer prints them
+    return ''.join(f'{lineno} : {message}\n' if not message.startswith('Illegal') else f'{message}\n'
+                   for (lineno, message) in errors)
+
+
+@pytest.mark.parametrize('source', [
+    '/*',
+    'var x = 1;\n/* print x;\nprint 2;',
+    'print 1; /* a */ print @;\n/* b\n*/ /* c\n@ d',
+    "print 'a; /* '",
+    '/*/ @',
+])
+def test_unterminated_comment_is_scanned_as_tokenize_does(source, capsys):
+    expected = tokens(tokenize(source))
+    output = capsys.readouterr().out
+    result = scan(source)
+    assert tokens(result) == expected
+    assert printed(result.errors) == output
+
+def test_unterminated_comment_is_reported_at_its_line():
+    (errors, _, _) = check_source('print 1;\n\n/* print 2;\nprint 3;')
+    assert [ str(e) for e in errors ] == ['3: Unterminated comment']
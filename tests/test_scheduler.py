@@ -0,0 +1,23 @@
+import asyncio
+import io
+
+import pytest
+
+from src.typecheck import check_source
+from src.vm import compile_program
+from src.output import BufferedOutput
+from src.scheduler import run_async, BudgetExceeded
+
+
+def compiled(source: str):
+    (errors, model, types) = check_source(source)
+    assert not errors
+    return compile_program(model, types)
+
+
+def test_output_is_flushed_when_the_budget_runs_out():
+    program = compiled('print 1; print 2; var x = 0; while true { x = x + 1; }')
+    stream = io.StringIO()
+    with pytest.raises(BudgetExceeded):
+        asyncio.run(run_async(program, slice=100, max_steps=1000, out=BufferedOutput(stream)))
+    assert stream.getvalue() == '1\n2\n'
@@ -0,0 +1,36 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from src.tokenize import tokenize
+from src.parse import WabbitParser
+from src.typecheck import check_model, _nodes
+
+
+SOURCE = '''
+var g = 1;
+func f(a int) int {
+    var x = a + g;
+    return x * 2.0;
+}
+func h() bool {
+    return f(1) > 2;
+}
+func main() int {
+    print h();
+    return 1 + true;
+}
+'''
+
+def checked(executor):
+    model = WabbitParser().parse(tokenize(SOURCE))
+    (diagnostics, types) = check_model(model, executor)
+    return [ str(d) for d in diagnostics ], [ types.get(n) for top in model for n in _nodes(top) ]
+
+
+def test_executors_check_like_one_thread():
+    expected = checked(None)
+    assert expected[0] == ['5: Unsupported operation: int * float', '5: Type error in return',
+                           '12: Unsupported operation: int + bool', '12: Type error in return']
+    with ThreadPoolExecutor(2) as executor:
+        assert checked(executor) == expected
+    with ProcessPoolExecutor(2) as executor:
+        assert checked(executor) == expected
@@ -0,0 +1,58 @@
+import struct
+
+from src.typecheck import check_source
+from src.vm import compile_program, CALL, CONST, JUMP, LOAD_LOCAL
+from src.wbc import dump_program, load_buffer
+
+
+SOURCE = '''
+func f(n int) int {
+    var m = n * 2;
+    return m;
+}
+func main() int {
+    var i = 0;
+    while i < 3 { print f(i); i = i + 1; }
+    return 0;
+}
+'''
+
+def compiled():
+    (errors, model, types) = check_source(SOURCE)
+    assert not errors
+    return compile_program(model, types)
+
+def patched(program, function: str, op: int, arg: int) -> bytes:
+    # replace the operand of the first op instruction of a function
+    code = program.functions[program.names[function]].code
+    at = list(code[::2]).index(op) * 2
+    code[at + 1] = arg
+    return dump_program(program, SOURCE)
+
+
+def test_load_round_trip():
+    program = load_buffer(dump_program(compiled(), SOURCE), SOURCE)
+    assert program is not None
+    assert list(program.toplevel.code) == list(compiled().toplevel.code)
+
+def test_load_rejects_bad_operands():
+    cases = [
+        ('main', CONST, 1000),
+        ('main', CALL, 7),
+        ('main', JUMP, 10**6),
+        ('main', JUMP, 1),
+        ('f', LOAD_LOCAL, 5),
+    ]
+    for (function, op, arg) in cases:
+        program = compiled()
+        assert load_buffer(patched(program, function, op, arg), SOURCE) is None, (op, arg)
+
+def test_load_rejects_bad_opcode():
+    program = compiled()
+    program.functions[0].code[0] = 99
+    assert load_buffer(dump_program(program, SOURCE), SOURCE) is None
+
+def test_load_rejects_truncated_code():
+    program = compiled()
+    del program.functions[0].code[-2:]
+    assert load_buffer(dump_program(program, SOURCE), SOURCE) is None